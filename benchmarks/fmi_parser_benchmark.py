@@ -0,0 +1,63 @@
+# coding=utf-8
+# Compares the streaming FMI WFS parser to the previous xmltodict based parsing.
+#
+# Run from the repository root: python -m benchmarks.fmi_parser_benchmark
+import os
+import timeit
+import tracemalloc
+from decimal import Decimal
+
+import arrow
+import xmltodict
+
+import config
+from poller_helpers import TempTs
+from states.auto_pipeline_pipes.fmi import iter_wfs_temps
+
+FIXTURES = os.path.join(os.path.dirname(__file__), '..', 'states', 'auto_pipeline_pipes', 'fixtures')
+
+
+def xmltodict_parse(content):
+    wfs_member = xmltodict.parse(content).get('wfs:FeatureCollection', {}).get('wfs:member')
+
+    return [
+        TempTs(
+            Decimal(t['BsWfs:BsWfsElement']['BsWfs:ParameterValue']),
+            arrow.get(t['BsWfs:BsWfsElement']['BsWfs:Time']).to(config.TIMEZONE)
+        )
+        for t
+        in wfs_member
+        if t['BsWfs:BsWfsElement']['BsWfs:ParameterValue'] != 'NaN'
+    ]
+
+
+def streaming_parse(content):
+    return list(iter_wfs_temps(content))
+
+
+def peak_memory(func, content):
+    tracemalloc.start()
+    func(content)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def run():
+    for name in ('fmi_forecast.xml', 'fmi_temperature.xml', 'fmi_dew_point.xml'):
+        with open(os.path.join(FIXTURES, name), 'rb') as f:
+            content = f.read()
+
+        assert xmltodict_parse(content) == streaming_parse(content)
+
+        print('%s (%d bytes)' % (name, len(content)))
+
+        for func in (xmltodict_parse, streaming_parse):
+            number = 200
+            seconds = min(timeit.repeat(lambda: func(content), number=number, repeat=3)) / number
+            print('  %-16s %8.3f ms  peak %7.1f KiB' % (
+                func.__name__, seconds * 1000, peak_memory(func, content) / 1024.0))
+
+
+if __name__ == '__main__':
+    run()
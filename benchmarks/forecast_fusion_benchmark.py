@@ -0,0 +1,50 @@
+# coding=utf-8
+# Compares the time grid forecast fusion to the previous positional fusion, which dropped heads of the lists
+# until they started at the same time and then zipped them by position. With mixed resolutions the positional
+# fusion pairs values of different times and gives fewer slots, so the times are not directly comparable.
+#
+# Run from the repository root: python -m benchmarks.forecast_fusion_benchmark
+import itertools
+import timeit
+from decimal import Decimal
+
+import arrow
+
+from poller_helpers import TempTs, fuse_forecasts, median
+
+
+def positional_fusion(list_of_temps):
+    list_of_temps = [list(temps) for temps in list_of_temps]
+
+    def first_timestamps():
+        return [temps[0][1] for temps in list_of_temps]
+
+    while first_timestamps()[1:] != first_timestamps()[:-1]:
+        del min(list_of_temps, key=lambda temps: temps[0][1])[0]
+
+    return [median(temps) for temps in itertools.zip_longest(*list_of_temps)]
+
+
+def forecast(start, hours, step_hours):
+    return [TempTs(Decimal(h % 17) / 2, start.shift(hours=h)) for h in range(0, hours, step_hours)]
+
+
+def run():
+    start = arrow.get('2017-08-18T15:00:00+03:00')
+
+    for offset_hours in (0, 24, 200):
+        # Hourly source and a source that is hourly for two days and 6-hourly after that, like yr.no
+        hourly = forecast(start.shift(hours=-offset_hours), 48 + offset_hours, 1)
+        mixed = forecast(start, 48, 1) + forecast(start.shift(hours=48), 192, 6)
+        sources = [hourly, mixed]
+
+        print('offset %d h (%d points)' % (offset_hours, len(hourly) + len(mixed)))
+
+        for func in (positional_fusion, fuse_forecasts):
+            number = 50
+            seconds = min(timeit.repeat(lambda: func(sources), number=number, repeat=3)) / number
+            print('  %-18s %8.3f ms' % (func.__name__, seconds * 1000))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,50 @@
+# coding=utf-8
+# Measures the import time of the poller and the auto pipeline with python -X importtime in fresh interpreters.
+#
+# Run from the repository root: python -m benchmarks.startup_benchmark
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+MODULES = ('poller', 'states.auto_pipeline')
+RUNS = 5
+TOP = 10
+
+
+def import_times(module: str) -> dict:
+    # Cumulative import time in microseconds of module and of each module imported by it. Modules imported by
+    # site at interpreter startup are left out.
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+                            cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+                            check=True)
+    lines = []
+
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        # import time: <self us> | <cumulative us> | <indented module>
+        _, cumulative, name = line.split('|')
+        lines.append((len(name) - len(name.lstrip()), name.strip(), int(cumulative)))
+
+    # Children are listed before their parent with a deeper indentation
+    end = max(i for i, (_, name, _) in enumerate(lines) if name == module)
+    level = lines[end][0]
+    start = end
+    while start > 0 and lines[start - 1][0] > level:
+        start -= 1
+
+    return {name: cumulative for _, name, cumulative in lines[start:end + 1]}
+
+
+def run():
+    for module in MODULES:
+        best = min((import_times(module) for _ in range(RUNS)), key=lambda times: times[module])
+        print('import %s: %.1f ms (best of %d)' % (module, best[module] / 1000, RUNS))
+
+        for name, cumulative in sorted(best.items(), key=lambda item: -item[1])[1:TOP + 1]:
+            print('    %-40s %8.1f ms' % (name, cumulative / 1000))
+
+
+if __name__ == '__main__':
+    run()
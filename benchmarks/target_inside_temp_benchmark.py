@@ -0,0 +1,45 @@
+# coding=utf-8
+# Compares the Decimal and float versions of the target inside temperature cooling simulation.
+#
+# Run from the repository root: python -m benchmarks.target_inside_temp_benchmark
+import timeit
+from decimal import Decimal
+
+import arrow
+
+import config
+from poller_helpers import TempTs
+from states.auto_pipeline_pipes.get_target_inside_temperature import inside_temp_at_start, forecast_arrays, \
+    inside_temp_at_start_float
+
+
+def run():
+    start = arrow.get('2018-11-25T12:00:00+02:00')
+    allowed_min = config.ALLOWED_MINIMUM_INSIDE_TEMP
+    cooling_rate = config.COOLING_RATE_PER_HOUR_PER_TEMPERATURE_DIFF
+
+    for forecast_hours, buffer_hours in ((48, 38), (63, 80), (63, 200)):
+        valid_forecast = [
+            TempTs(Decimal(-10) - Decimal(i % 7) / 2, start.shift(hours=i)) for i in range(forecast_hours)]
+        end_ts = start.shift(hours=buffer_hours)
+
+        def decimal_version():
+            return inside_temp_at_start(valid_forecast, end_ts, allowed_min)
+
+        def float_version():
+            epochs, temps = forecast_arrays(valid_forecast)
+            return inside_temp_at_start_float(
+                epochs, temps, end_ts.float_timestamp, float(allowed_min), float(cooling_rate))
+
+        diff = abs(float(decimal_version()) - float_version())
+
+        print('forecast %d h, buffer %d h, difference %.2e' % (forecast_hours, buffer_hours, diff))
+
+        for func in (decimal_version, float_version):
+            number = 200
+            seconds = min(timeit.repeat(func, number=number, repeat=3)) / number
+            print('  %-16s %8.3f ms' % (func.__name__, seconds * 1000))
+
+
+if __name__ == '__main__':
+    run()
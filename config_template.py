@@ -7,19 +7,28 @@ SHEET_KEY = ''
 MESSAGE_SHEET_INDEX = 4
 MESSAGE_SHEET_CELL = 'A1'
 INSIDE_SHEET_TITLE = 'some title'
+SHEET_TIMEOUT = 120
+MESSAGE_SHEET_POLL_SECONDS = 60 * 15  # also when the auto cycle is longer
+# Local low latency message sources, empty to disable
+MESSAGE_SOCKET_PATH = ''
+MESSAGE_FILE = ''
 FMI_LOCATION = 'tampere'
 OPEN_WEATHER_MAP_KEY = ''
 OPEN_WEATHER_MAP_LOCATION = ''
 YR_NO_LOCATION = 'Finland/Western_Finland/Tampere'
 SMARTTHINGS_INSIDE_DEVICE_IDS = ["...", "..."]
+IR_REMOTE = 'ilp'
 SMARTTHINGS_TOKEN = "..."
 OUTSIDE_TEMP_ENDPOINT = "https://1234.execute-api.eu-north-1.amazonaws.com/..."
 STORAGE_ROOT_URL = "https://1234.execute-api.eu-north-1.amazonaws.com/..."
+STORAGE_BATCH_SIZE = 20
+STORAGE_QUEUE_MAX_ITEMS = 5000  # oldest queued uploads are dropped above this, about 50 days of cycles
 EMAIL_ADDRESSES = []
+EMAIL_COALESCE_SECONDS = 60 * 10  # emails within this time after the previous one are sent as one digest
 HEALTHCHECK_URL_CRON = ''
 HEALTHCHECK_URL_MESSAGE = ''
 CACHE_TIMES = {
-    'fmi': {
+    'fmi_observations': {
         'if_ok': 15,
         'if_failed': 120,
     },
@@ -36,14 +45,36 @@ CACHE_TIMES = {
         'if_failed': 120,
     },
 }
+REQUEST_CACHE_MAX_ENTRIES = 50
+CYCLE_LOG_FILE = 'cycles.bin'
+HTTP_TIMEOUT = (10, 60)  # connect and read timeouts in seconds
+HTTP_POOL_CONNECTIONS = 10  # number of hosts to keep pools for
+HTTP_POOL_MAXSIZE = 4  # connections per host
+HTTP_RETRIES = 2
+HTTP_BACKOFF_FACTOR = 5
+FETCH_DEADLINE_SECONDS = 90
+METRICS_FILE = 'metrics.json'  # per pipe wall time histogram and counters, rewritten every cycle
+METRICS_HISTORY = 96  # cycles
+PROFILE_CYCLES = 0  # cProfile this many cycles after start
+PROFILE_FILE = 'profile-%d.prof'
 ALLOWED_MINIMUM_INSIDE_TEMP = Decimal(1)
 MINIMUM_INSIDE_TEMP = Decimal('3.5')
 COOLING_RATE_PER_HOUR_PER_TEMPERATURE_DIFF = Decimal('0.015')
+TARGET_INSIDE_TEMP_FLOAT = True  # float math instead of Decimal in target inside temperature calculation
 
 CONTROLLER_P = Decimal(2)
 CONTROLLER_I = Decimal(2)
 CONTROLLER_D = Decimal(25)
 
+# Auto cycle period. Short when the controller output is about to cross the on/off boundary, long when the house is
+# stable and the forecast is flat.
+AUTO_CYCLE_MIN_SECONDS = 60 * 5
+AUTO_CYCLE_SECONDS = 60 * 15  # without inside temperature; two times this is the maximum if the forecast isn't flat
+AUTO_CYCLE_MAX_SECONDS = 60 * 60
+AUTO_CYCLE_HEATING_MAX_SECONDS = 60 * 20  # inside temperature changes fastest while heating
+AUTO_CYCLE_FLAT_FORECAST_CHANGE = Decimal(3)  # max forecast change in the next 6 hours
+AUTO_CYCLE_TRANSITION_BAND = Decimal('0.1')  # controller output distance from off
+
 
 def cooling_time_buffer_func(outside_temp):
     a = 0
@@ -53,3 +84,8 @@ def cooling_time_buffer_func(outside_temp):
 
 
 COOLING_TIME_BUFFER = cooling_time_buffer_func  # hours
+
+# Several heat pumps from one process. Each unit is a dict with a unique name and any of remote,
+# inside_device_ids, minimum_inside_temp, controller_p, controller_i, controller_d and cycle_log_file. Missing values
+# default to the values above. Empty for the single unit mode. See units.py.
+UNITS = []
@@ -0,0 +1,4 @@
+import os
+
+# Keep tests away from the real db.sqlite in the working directory
+os.environ.setdefault('ILP_COMMANDER_DB', ':memory:')
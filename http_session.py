@@ -0,0 +1,109 @@
+# coding=utf-8
+# Shared HTTP session. Kept out of poller_helpers so that requests is imported on the first request instead of at
+# startup.
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+import config
+import metrics
+
+
+class _CountingConnectionPoolMixin:
+    def _get_conn(self, *args, **kwargs):
+        HttpSession.count('requests')
+        return super()._get_conn(*args, **kwargs)
+
+    def _new_conn(self):
+        HttpSession.count('new_connections')
+        return super()._new_conn()
+
+
+class _CountingHTTPConnectionPool(_CountingConnectionPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class _CountingHTTPSConnectionPool(_CountingConnectionPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class _CountingRetry(Retry):
+    def increment(self, *args, **kwargs):
+        metrics.count('retries')
+        return super().increment(*args, **kwargs)
+
+
+class _CountingHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _CountingHTTPConnectionPool,
+            'https': _CountingHTTPSConnectionPool,
+        }
+
+
+class HttpSession:
+    _session = None
+    _lock = threading.Lock()
+
+    # Cumulative over the whole process, so they survive pool eviction and reset()
+    _stats = {'requests': 0, 'new_connections': 0}
+    _stats_lock = threading.Lock()
+
+    @classmethod
+    def session(cls) -> requests.Session:
+        with cls._lock:
+            if not cls._session:
+                cls._session = cls._create_session()
+            return cls._session
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            if cls._session:
+                cls._session.close()
+            cls._session = None
+
+    @classmethod
+    def _create_session(cls) -> requests.Session:
+        adapter = _CountingHTTPAdapter(
+            pool_connections=config.HTTP_POOL_CONNECTIONS,
+            pool_maxsize=config.HTTP_POOL_MAXSIZE,
+            max_retries=cls._retry_policy())
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    @staticmethod
+    def _retry_policy() -> Retry:
+        # Default allowed methods don't include POST, so POSTs are retried only on connection errors,
+        # i.e. when nothing was sent yet. Read errors and error statuses are retried only for GETs.
+        return _CountingRetry(
+            total=config.HTTP_RETRIES,
+            backoff_factor=config.HTTP_BACKOFF_FACTOR,
+            status_forcelist=(500, 502, 503, 504),
+            raise_on_status=False,
+        )
+
+    @classmethod
+    def count(cls, name):
+        with cls._stats_lock:
+            cls._stats[name] += 1
+
+    @classmethod
+    def reset_stats(cls):
+        with cls._stats_lock:
+            for name in cls._stats:
+                cls._stats[name] = 0
+
+    @classmethod
+    def connection_stats(cls) -> dict:
+        with cls._stats_lock:
+            stats = dict(cls._stats)
+
+        stats['reused_connections'] = max(stats['requests'] - stats['new_connections'], 0)
+        return stats
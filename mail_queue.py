@@ -0,0 +1,97 @@
+# coding=utf-8
+import time
+from collections import OrderedDict
+from typing import List, Tuple
+
+from pony import orm
+
+import config
+from poller_helpers import EmailItem, logger, send_email, time_str, db_session
+from workers import BackgroundWorker
+
+
+class MailQueue(BackgroundWorker):
+    # Durable queue of outbound emails. Emails are stored to DB and sent by the worker so that SMTP never blocks
+    # the control loop and queued emails survive restarts. After an email is sent to an address, the emails to it
+    # within the next EMAIL_COALESCE_SECONDS are sent together as one digest.
+
+    name = 'mail-queue'
+    min_backoff = 30
+    max_backoff = 60 * 30
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.backoff = 0
+        self.last_sent_at = {}
+
+    def put(self, subject: str, message: str):
+        if not config.EMAIL_ADDRESSES:
+            return
+
+        with db_session:
+            for address in config.EMAIL_ADDRESSES:
+                EmailItem(address=address, subject=subject, message=message)
+        self.start()
+
+        # While backing off or coalescing the worker sends on its own schedule
+        if not self.backoff and any(self.last_sent_at.get(address, 0) + config.EMAIL_COALESCE_SECONDS <= time.time()
+                                    for address in config.EMAIL_ADDRESSES):
+            self.wake()
+
+    def work(self):
+        with db_session:
+            pending = OrderedDict()
+            for item in orm.select(i for i in EmailItem).order_by(EmailItem.id):
+                pending.setdefault(item.address, []).append((item.id, item.subject, item.message, item.ts))
+
+        wait_times = []
+        failed = False
+
+        for address, items in pending.items():
+            wait_time = self.last_sent_at.get(address, 0) + config.EMAIL_COALESCE_SECONDS - time.time()
+            if wait_time > 0:
+                wait_times.append(wait_time)
+                continue
+
+            subject, message = digest(items)
+
+            try:
+                send_email(address, subject, message)
+            except Exception as e:
+                logger.exception(e)
+                failed = True
+                continue
+
+            self.last_sent_at[address] = time.time()
+            ids = [item_id for item_id, _, _, _ in items]
+
+            with db_session:
+                EmailItem.select(lambda i: i.id in ids).delete(bulk=True)
+
+            logger.debug('Sent %d emails to %s', len(ids), address)
+
+        if failed:
+            self.backoff = min(max(self.backoff * 2, self.min_backoff), self.max_backoff)
+            logger.info('Sending email failed, retrying in %d secs', self.backoff)
+            return min([self.backoff] + wait_times)
+
+        self.backoff = 0
+
+        return min(wait_times) if wait_times else None
+
+
+def digest(items: List[Tuple[int, str, str, str]]) -> Tuple[str, str]:
+    # Subject and message of one email from queued (id, subject, message, ts) items
+    if len(items) == 1:
+        _, subject, message, _ = items[0]
+        return subject, message
+
+    subjects = OrderedDict.fromkeys(subject for _, subject, _, _ in items)
+    subject = '%s (%d)' % (', '.join(subjects), len(items))
+    message = '\n\n'.join('%s %s\n%s' % (time_str(ts), item_subject, item_message)
+                          for _, item_subject, item_message, ts in items)
+
+    return subject, message
+
+
+mail_queue = MailQueue()
@@ -0,0 +1,115 @@
+from pony import orm
+
+from mail_queue import MailQueue
+from poller_helpers import EmailItem, db_session
+
+
+def clear_queue():
+    with db_session:
+        EmailItem.select().delete(bulk=True)
+
+
+def queue_count():
+    with db_session:
+        return orm.count(i for i in EmailItem)
+
+
+def test_burst_is_sent_as_digest(mocker):
+    mocker.patch('config.EMAIL_ADDRESSES', ['a@example.com', 'b@example.com'])
+    mocker.patch('config.EMAIL_COALESCE_SECONDS', 600)
+    mock_send = mocker.patch('mail_queue.send_email')
+    mocker.patch('mail_queue.MailQueue.start')
+    now = mocker.patch('mail_queue.time.time', return_value=1000.0)
+    clear_queue()
+
+    queue = MailQueue()
+    queue.put('Send IR', 'heat_20')
+
+    # The first email is sent right away
+    assert queue.work() is None
+    assert mock_send.call_count == 2
+    mock_send.assert_called_with('b@example.com', 'Send IR', 'heat_20')
+
+    queue.put('Status', 'no forecast')
+    queue.put('Status', 'ok')
+    queue.put('Send IR', 'off')
+
+    now.return_value = 1100.0
+    assert queue.work() == 500.0
+    assert mock_send.call_count == 2
+    assert queue_count() == 6
+
+    now.return_value = 1600.0
+    assert queue.work() is None
+    assert mock_send.call_count == 4
+    assert queue_count() == 0
+
+    address, subject, message = mock_send.call_args[0]
+    assert address == 'b@example.com'
+    assert subject == 'Status, Send IR (3)'
+    assert message.index('no forecast') < message.index('ok') < message.index('off')
+
+
+def test_send_failure_keeps_emails(mocker):
+    mocker.patch('config.EMAIL_ADDRESSES', ['a@example.com'])
+    mock_send = mocker.patch('mail_queue.send_email', side_effect=ConnectionRefusedError())
+    mocker.patch('mail_queue.MailQueue.start')
+    clear_queue()
+
+    queue = MailQueue()
+    queue.put('Status', 'ok')
+
+    assert queue.work() == MailQueue.min_backoff
+    assert queue.work() == MailQueue.min_backoff * 2
+    assert queue_count() == 1
+
+    # Emails left in DB are sent by a new queue, e.g. after restart
+    mock_send.side_effect = None
+    assert MailQueue().work() is None
+    mock_send.assert_called_with('a@example.com', 'Status', 'ok')
+    assert mock_send.call_count == 3
+    assert queue_count() == 0
+
+
+def test_email_does_not_send_in_caller(mocker):
+    mocker.patch('config.EMAIL_ADDRESSES', ['a@example.com'])
+    mock_send = mocker.patch('mail_queue.send_email')
+    mock_start = mocker.patch('mail_queue.MailQueue.start')
+    mocker.patch('poller_helpers.actually_send_ir_signal')
+    clear_queue()
+
+    from poller_helpers import send_ir_signal, Commands
+    send_ir_signal(Commands.heat20)
+
+    assert mock_send.call_count == 0
+    assert mock_start.call_count == 1
+    assert queue_count() == 1
+    clear_queue()
+
+
+def test_put_does_not_wake_while_backing_off_or_coalescing(mocker):
+    mocker.patch('config.EMAIL_ADDRESSES', ['a@example.com'])
+    mocker.patch('config.EMAIL_COALESCE_SECONDS', 600)
+    mock_send = mocker.patch('mail_queue.send_email', side_effect=ConnectionRefusedError())
+    mocker.patch('mail_queue.MailQueue.start')
+    mock_wake = mocker.patch('mail_queue.MailQueue.wake')
+    now = mocker.patch('mail_queue.time.time', return_value=1000.0)
+    clear_queue()
+
+    queue = MailQueue()
+    queue.put('Status', 'ok')
+    assert mock_wake.call_count == 1
+
+    assert queue.work() == MailQueue.min_backoff
+    queue.put('Status', 'still failing')
+    assert mock_wake.call_count == 1
+
+    mock_send.side_effect = None
+    assert queue.work() is None
+    queue.put('Send IR', 'heat_20')
+    assert mock_wake.call_count == 1
+
+    now.return_value = 1600.0
+    queue.put('Send IR', 'off')
+    assert mock_wake.call_count == 2
+    clear_queue()
@@ -0,0 +1,106 @@
+# coding=utf-8
+# Local message sources. Messages are the same JSON documents that are written to the message sheet cell,
+# e.g. {"command": "auto"} or {"command": "set temp", "param": {"temp": 20}}. All sources, including the sheet
+# worker, put messages to the shared inbox which get_most_recent_message waits on.
+import json
+import os
+import queue
+import socketserver
+import threading
+
+import config
+from poller_helpers import logger
+from workers import BackgroundWorker
+
+inbox = queue.Queue()
+
+
+def put_message(message: str, messages: queue.Queue = inbox) -> bool:
+    try:
+        if not isinstance(json.loads(message), dict):
+            raise ValueError('Not an object')
+    except ValueError as e:
+        logger.warning('Invalid message %r: %s', message, e)
+        return False
+
+    messages.put(message)
+    return True
+
+
+class UnixSocketSource:
+    # One message per connection: echo '{"command": "auto"}' | nc -U <MESSAGE_SOCKET_PATH>
+
+    def __init__(self, path: str, messages: queue.Queue = inbox) -> None:
+        self.path = path
+        self.messages = messages
+        self.server = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+        source = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                message = self.rfile.read().decode('utf-8').strip()
+                ok = put_message(message, source.messages)
+                self.wfile.write(b'ok\n' if ok else b'invalid\n')
+
+        self.server = socketserver.ThreadingUnixStreamServer(self.path, Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='message-socket', daemon=True).start()
+        logger.info('Listening messages in %s', self.path)
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+            os.remove(self.path)
+
+
+class WatchedFileSource(BackgroundWorker):
+    # Each non-empty line appended to the file is a message. The file is claimed by renaming it before reading so
+    # that lines appended meanwhile go to a new file. A last line without newline is kept for the next poll.
+
+    name = 'message-file'
+    interval = 0.5
+
+    def __init__(self, path: str, messages: queue.Queue = inbox) -> None:
+        super().__init__()
+        self.path = path
+        self.reading_path = path + '.reading'
+        self.messages = messages
+        self.unfinished_line = ''
+
+    def work(self):
+        try:
+            # A claimed file left from a previous run is read first
+            if not os.path.exists(self.reading_path):
+                if os.path.getsize(self.path) == 0:
+                    return self.interval
+                os.rename(self.path, self.reading_path)
+
+            with open(self.reading_path, 'r') as f:
+                content = f.read()
+            os.remove(self.reading_path)
+        except FileNotFoundError:
+            return self.interval
+
+        lines = (self.unfinished_line + content).split('\n')
+        self.unfinished_line = lines.pop()
+
+        for line in lines:
+            if line.strip():
+                put_message(line.strip(), self.messages)
+
+        return self.interval
+
+
+def start_message_sources():
+    if config.MESSAGE_SOCKET_PATH:
+        UnixSocketSource(config.MESSAGE_SOCKET_PATH).start()
+
+    if config.MESSAGE_FILE:
+        WatchedFileSource(config.MESSAGE_FILE).start()
@@ -0,0 +1,67 @@
+import os
+import queue
+import socket
+import time
+
+from message_sources import UnixSocketSource, WatchedFileSource, put_message
+
+
+def test_put_message_rejects_invalid():
+    messages = queue.Queue()
+
+    assert not put_message('not json', messages)
+    assert not put_message('[1, 2]', messages)
+    assert put_message('{"command": "auto"}', messages)
+
+    assert messages.get_nowait() == '{"command": "auto"}'
+    assert messages.empty()
+
+
+def test_unix_socket_source(tmpdir):
+    messages = queue.Queue()
+    path = str(tmpdir.join('messages.sock'))
+    source = UnixSocketSource(path, messages)
+    source.start()
+
+    try:
+        start = time.time()
+
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(path)
+        client.sendall(b'{"command": "auto"}\n')
+        client.shutdown(socket.SHUT_WR)
+        assert client.recv(16) == b'ok\n'
+        client.close()
+
+        assert messages.get(timeout=1) == '{"command": "auto"}'
+        assert time.time() - start < 1
+    finally:
+        source.stop()
+
+    assert not os.path.exists(path)
+
+
+def test_watched_file_source(tmpdir):
+    messages = queue.Queue()
+    path = tmpdir.join('messages')
+    source = WatchedFileSource(str(path), messages)
+
+    source.work()
+    assert messages.empty()
+
+    path.write('{"command": "turn off"}\n\n{"command": "auto"}\n')
+    assert source.work() == WatchedFileSource.interval
+
+    assert messages.get_nowait() == '{"command": "turn off"}'
+    assert messages.get_nowait() == '{"command": "auto"}'
+    assert not path.exists()
+
+    # Unfinished line waits for the rest of it
+    path.write('{"command": ')
+    source.work()
+    assert messages.empty()
+
+    path.write('"auto"}\n')
+    source.work()
+    assert messages.get_nowait() == '{"command": "auto"}'
+    assert messages.empty()
@@ -0,0 +1,152 @@
+# coding=utf-8
+# Per pipe instrumentation of AutoPipeline. Counters (cache hits, bytes, retries) are attributed to the pipe
+# that is running in the current thread. Functions run in other threads for a pipe are wrapped with bind().
+import cProfile
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from typing import Optional
+
+import config
+
+HISTOGRAM_BUCKETS = (0.01, 0.1, 0.5, 1, 5, 10, 30, 60)  # upper bounds in seconds, last bucket is +inf
+COUNTERS = ('cache_hits', 'cache_misses', 'bytes_downloaded', 'retries')
+
+_local = threading.local()
+
+
+class PipeStats:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.wall_seconds = 0.0
+        self._lock = threading.Lock()
+        self.counters = dict.fromkeys(COUNTERS, 0)
+
+    def count(self, counter: str, amount: int = 1):
+        with self._lock:
+            self.counters[counter] += amount
+
+
+class PipeHistory:
+    # Rolling window of the last samples of one pipe
+
+    def __init__(self, size: int) -> None:
+        self.samples = deque(maxlen=size)
+
+    def add(self, stats: PipeStats):
+        self.samples.append((stats.wall_seconds, stats.counters))
+
+    def summary(self) -> dict:
+        wall_times = sorted(wall_seconds for wall_seconds, _ in self.samples)
+        histogram = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        for wall_seconds in wall_times:
+            histogram[bisect_left(HISTOGRAM_BUCKETS, wall_seconds)] += 1
+
+        return OrderedDict([
+            ('count', len(wall_times)),
+            ('mean_seconds', sum(wall_times) / len(wall_times)),
+            ('p50_seconds', percentile(wall_times, 50)),
+            ('p95_seconds', percentile(wall_times, 95)),
+            ('max_seconds', wall_times[-1]),
+            ('histogram', OrderedDict(
+                ('<=%ss' % bucket if bucket is not None else '>%ss' % HISTOGRAM_BUCKETS[-1], histogram[i])
+                for i, bucket in enumerate(HISTOGRAM_BUCKETS + (None,)))),
+        ] + [(counter, sum(counters[counter] for _, counters in self.samples)) for counter in COUNTERS])
+
+
+def percentile(sorted_values: list, percent: int) -> float:
+    index = min(len(sorted_values) - 1, int(round(percent / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class PipeMetrics:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.history = OrderedDict()
+
+    def add(self, stats: PipeStats):
+        with self._lock:
+            if stats.name not in self.history:
+                self.history[stats.name] = PipeHistory(config.METRICS_HISTORY)
+            self.history[stats.name].add(stats)
+
+    def summary(self) -> dict:
+        with self._lock:
+            return OrderedDict((name, history.summary()) for name, history in self.history.items())
+
+    def write(self, path: str):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+        os.replace(tmp_path, path)
+
+
+pipe_metrics = PipeMetrics()
+
+
+def current() -> Optional[PipeStats]:
+    return getattr(_local, 'stats', None)
+
+
+def count(counter: str, amount: int = 1):
+    stats = current()
+    if stats is not None:
+        stats.count(counter, amount)
+
+
+@contextmanager
+def measure_pipe(name: str, metrics: PipeMetrics = pipe_metrics):
+    stats = PipeStats(name)
+    previous, _local.stats = current(), stats
+    start = time.perf_counter()
+    try:
+        yield stats
+    finally:
+        stats.wall_seconds = time.perf_counter() - start
+        _local.stats = previous
+        metrics.add(stats)
+
+
+def bind(func):
+    # Attributes counters of func to the pipe that is running when bind is called, also in other threads
+    stats = current()
+
+    @wraps(func)
+    def bound(*args, **kwargs):
+        previous, _local.stats = current(), stats
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.stats = previous
+
+    return bound
+
+
+class CycleProfiler:
+    # Profiles the next PROFILE_CYCLES cycles with cProfile, one stats file per cycle
+
+    def __init__(self) -> None:
+        self.remaining = config.PROFILE_CYCLES
+
+    @contextmanager
+    def profile(self):
+        if self.remaining <= 0:
+            yield
+            return
+
+        self.remaining -= 1
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(config.PROFILE_FILE % int(time.time()))
+
+
+cycle_profiler = CycleProfiler()
@@ -0,0 +1,68 @@
+import json
+import threading
+
+import metrics
+from metrics import PipeMetrics, measure_pipe, bind, count
+
+
+def test_measure_pipe_counters():
+    pipe_metrics = PipeMetrics()
+
+    with measure_pipe('pipe', pipe_metrics) as stats:
+        count('cache_hits')
+        count('bytes_downloaded', 100)
+
+        thread = threading.Thread(target=bind(lambda: count('retries', 2)))
+        thread.start()
+        thread.join()
+
+    count('cache_hits')  # outside of any pipe
+
+    assert stats.counters == {'cache_hits': 1, 'cache_misses': 0, 'bytes_downloaded': 100, 'retries': 2}
+    assert stats.wall_seconds > 0
+    assert metrics.current() is None
+
+
+def test_pipe_metrics_summary(mocker, tmpdir):
+    mocker.patch('config.METRICS_HISTORY', 3)
+    pipe_metrics = PipeMetrics()
+
+    for i in range(5):
+        with measure_pipe('pipe', pipe_metrics):
+            count('cache_misses')
+
+    summary = pipe_metrics.summary()['pipe']
+    assert summary['count'] == 3
+    assert summary['cache_misses'] == 3
+    assert summary['histogram']['<=0.01s'] == 3
+    assert summary['max_seconds'] >= summary['p50_seconds']
+
+    path = str(tmpdir.join('metrics.json'))
+    pipe_metrics.write(path)
+    with open(path) as f:
+        assert json.load(f)['pipe']['count'] == 3
+
+
+def test_bytes_downloaded_in_get_url(mocker):
+    from poller_helpers import get_url
+
+    session = mocker.patch('http_session.HttpSession.session')
+    session.return_value.get.return_value.content = b'12345'
+
+    with measure_pipe('pipe', PipeMetrics()) as stats:
+        get_url('http://localhost/')
+
+    assert stats.counters['bytes_downloaded'] == 5
+
+
+def test_cycle_profiler(mocker, tmpdir):
+    mocker.patch('config.PROFILE_CYCLES', 1)
+    mocker.patch('config.PROFILE_FILE', str(tmpdir.join('profile-%d.prof')))
+    profiler = metrics.CycleProfiler()
+
+    with profiler.profile():
+        sum(range(100))
+    with profiler.profile():
+        sum(range(100))
+
+    assert len(tmpdir.listdir()) == 1
@@ -1,11 +1,26 @@
 # coding=utf-8
+import config
+from mail_queue import mail_queue
+from message_sources import start_message_sources
 from poller_helpers import logger, have_valid_time
 from states.read_last_message_from_db import ReadLastMessageFromDB
+from upload_queue import upload_queue
 
 
 def run():
     have_valid_time(5 * 60)
 
+    # Uploads and sends items left in the queues before restart
+    upload_queue.start()
+    mail_queue.start()
+    start_message_sources()
+
+    if config.UNITS:
+        from unit_scheduler import UnitScheduler
+        from units import configured_units
+
+        UnitScheduler(configured_units()).run()
+
     state_klass = ReadLastMessageFromDB
     payload = None
 
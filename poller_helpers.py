@@ -1,26 +1,25 @@
 # coding=utf-8
 import datetime
-import itertools
 import json
 import logging
 import os
 import platform
-import smtplib
+import threading
 import time
+from array import array
+from bisect import bisect_right
 from decimal import Decimal, ROUND_HALF_UP
-from email.mime.text import MIMEText
 from functools import wraps, total_ordering
 from subprocess import Popen, PIPE
-from typing import NamedTuple, List, Optional, Tuple
+from typing import NamedTuple, List, Optional, Tuple, Iterable
 
 import arrow
-import pygsheets
 import pytz
-import requests
 from pony import orm
 from retry import retry
 
 import config
+import metrics
 
 logger = logging.getLogger('poller')
 handler = logging.FileHandler('poller.log')
@@ -32,7 +31,68 @@ logger.info('----- START -----')
 
 
 TempTs = NamedTuple("TempTs", [('temp', Decimal), ('ts', arrow.Arrow)])
-Forecast = NamedTuple("Forecast", [('temps', List[TempTs]), ('ts', arrow.Arrow)])
+
+
+class Forecast:
+    # Forecast temperatures in time order as parallel arrays of epoch seconds and temperatures instead of TempTs
+    # with arrow objects. Prefix sums of the temperatures make window means O(1). Iterating or temps gives TempTs for
+    # callers that need them. ts is the time of the forecast.
+
+    __slots__ = ('epochs', 'values', 'ts', 'tzinfo', '_sums')
+
+    def __init__(self, temps: Iterable[TempTs], ts: arrow.Arrow) -> None:
+        self.epochs = array('d')
+        self.values = []  # Decimal temperatures
+        self.ts = ts
+        self.tzinfo = ts.tzinfo if ts else None
+        self._sums = [Decimal(0)]
+
+        for temp in temps:
+            self.epochs.append(temp.ts.float_timestamp)
+            self.values.append(temp.temp)
+            self._sums.append(self._sums[-1] + temp.temp)
+            self.tzinfo = temp.ts.tzinfo
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __bool__(self) -> bool:
+        # A forecast without temperatures is still a forecast
+        return True
+
+    def __getitem__(self, i: int) -> TempTs:
+        return TempTs(self.values[i], arrow.Arrow.fromtimestamp(self.epochs[i], self.tzinfo))
+
+    def __iter__(self):
+        for i in range(len(self.values)):
+            yield self[i]
+
+    def __repr__(self):
+        return 'Forecast(%d temps, ts=%s)' % (len(self), self.ts)
+
+    @property
+    def temps(self) -> List[TempTs]:
+        return list(self)
+
+    def mean(self, start: int = 0, end: Optional[int] = None) -> Optional[Decimal]:
+        # Mean of the temperatures in slice start:end
+        start, end, _ = slice(start, end).indices(len(self.values))
+        if end <= start:
+            return None
+        return (self._sums[end] - self._sums[start]) / (end - start)
+
+    def index_after(self, epoch: float) -> int:
+        # Index of the first temperature after epoch
+        return bisect_right(self.epochs, epoch)
+
+    def after(self, epoch: float) -> 'Forecast':
+        i = self.index_after(epoch)
+        forecast = Forecast([], self.ts)
+        forecast.epochs = self.epochs[i:]
+        forecast.values = self.values[i:]
+        forecast.tzinfo = self.tzinfo
+        forecast._sums = [s - self._sums[i] for s in self._sums[i:]]
+        return forecast
 
 
 @total_ordering
@@ -74,6 +134,13 @@ class Commands:
     heat28 = Command('heat_28__fan_high__swing_down', Decimal(28))
     heat30 = Command('heat_30__fan_high__swing_down', Decimal(30))
 
+    @staticmethod
+    def from_command_string(command_string: str) -> Optional[Command]:
+        for command in vars(Commands).values():
+            if isinstance(command, Command) and command.command_string == command_string:
+                return command
+        return None
+
     @staticmethod
     def command_from_controller(
             value: Decimal, inside_temp: Decimal, outside_temp: Optional[Decimal]) -> Command:
@@ -146,6 +213,34 @@ class SavedState(db.Entity):
     json = orm.Required(str)
 
 
+class CachedRequest(db.Entity):
+    name = orm.PrimaryKey(str)
+
+    # Use str here because pony uses str() to convert datetime before insert.
+    # That puts datetime in wrong format to DB.
+    stale_after_if_ok = orm.Required(str)
+    stale_after_if_failed = orm.Required(str)
+    content = orm.Required(orm.LongStr)
+
+
+class UploadItem(db.Entity):
+    data = orm.Required(orm.LongStr)
+
+    # Use str here because pony uses str() to convert datetime before insert.
+    # That puts datetime in wrong format to DB.
+    ts = orm.Required(str, default=lambda: arrow.utcnow().isoformat())
+
+
+class EmailItem(db.Entity):
+    address = orm.Required(str)
+    subject = orm.Required(str)
+    message = orm.Required(orm.LongStr)
+
+    # Use str here because pony uses str() to convert datetime before insert.
+    # That puts datetime in wrong format to DB.
+    ts = orm.Required(str, default=lambda: arrow.utcnow().isoformat())
+
+
 with db.set_perms_for(CommandLog):
     orm.perm('view', group='anybody')
 
@@ -158,42 +253,78 @@ with db.set_perms_for(SavedState):
     orm.perm('view', group='anybody')
 
 
-db.bind('sqlite', 'db.sqlite', create_db=True)
-db.generate_mapping(create_tables=True)
+with db.set_perms_for(CachedRequest):
+    orm.perm('view', group='anybody')
+
+
+with db.set_perms_for(UploadItem):
+    orm.perm('view', group='anybody')
+
+
+with db.set_perms_for(EmailItem):
+    orm.perm('view', group='anybody')
+
 
+_db_lock = threading.Lock()
+
+
+def init_db():
+    # Bound on first use instead of at import to keep startup and tests that don't use the DB fast
+    with _db_lock:
+        if db.provider is None:
+            db.bind('sqlite', os.environ.get('ILP_COMMANDER_DB', 'db.sqlite'), create_db=True)
+            db.generate_mapping(create_tables=True)
+
+
+class _DbSession:
+    # orm.db_session that initializes the DB first
+
+    def __enter__(self):
+        init_db()
+        return orm.db_session.__enter__()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return orm.db_session.__exit__(exc_type, exc_val, exc_tb)
+
+
+db_session = _DbSession()
+
+
+def send_email(address, subject, message):
+    import smtplib
+    from email.mime.text import MIMEText
+
+    mime_text = MIMEText(message.encode('utf-8'), 'plain', 'utf-8')
+    mime_text['Subject'] = subject
+    mime_text['From'] = address
+    mime_text['To'] = address
 
-@retry(tries=6, delay=3)
-def send_email(address, mime_text):
     s = smtplib.SMTP('localhost')
     s.sendmail(address, [address], mime_text.as_string())
     s.quit()
 
 
 def email(subject, message):
+    # Queued to DB and sent by a background worker so that a slow or down MTA never blocks the caller
+    from mail_queue import mail_queue
 
-    for address in config.EMAIL_ADDRESSES:
+    mail_queue.put(subject, message)
 
-        mime_text = MIMEText(message.encode('utf-8'), 'plain', 'utf-8')
-        mime_text['Subject'] = subject
-        mime_text['From'] = address
-        mime_text['To'] = address
-
-        try:
-            send_email(address, mime_text)
-        except Exception as e:
-            logger.exception(e)
 
+def send_ir_signal(command: Command, extra_info: Optional[list] = None, send_command_email: bool = True,
+                   remote: Optional[str] = None):
+    if remote is None:
+        remote = config.IR_REMOTE
 
-def send_ir_signal(command: Command, extra_info: Optional[list] = None, send_command_email: bool = True):
     if extra_info is None:
         extra_info = []
 
-    logger.info(str(command))
+    logger.info(ir_log_command(remote, command))
 
-    message = '\n'.join([time_str(), str(command)] + extra_info)
+    message = '\n'.join([time_str(), ir_log_command(remote, command)] + extra_info)
 
     try:
-        actually_send_ir_signal(command)
+        actually_send_ir_signal(command, remote)
     except IOError as e:
         logger.exception(e)
         message += '\nirsend: %s' % type(e).__name__
@@ -215,10 +346,22 @@ def get_now_isoformat():
     return datetime.datetime.utcnow().replace(tzinfo=pytz.utc, microsecond=0).isoformat()
 
 
+def epoch_to_arrow(epoch) -> arrow.Arrow:
+    # Internal times are epoch seconds, see states.pipeline_context.now
+    return arrow.Arrow.fromtimestamp(epoch, pytz.timezone(config.TIMEZONE))
+
+
+def ir_log_command(remote: str, command) -> str:
+    # IRSendLog has no remote column so commands to other than the default remote are logged as "<remote> <command>"
+    if remote == config.IR_REMOTE:
+        return str(command)
+    return '%s %s' % (remote, command)
+
+
 @retry(tries=2, delay=5)
-def actually_send_ir_signal(command: Command):
+def actually_send_ir_signal(command: Command, remote: str):
     try:
-        p = Popen(['irsend', 'SEND_ONCE', 'ilp', str(command)], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        p = Popen(['irsend', 'SEND_ONCE', remote, str(command)], stdin=PIPE, stdout=PIPE, stderr=PIPE)
         output, err = p.communicate('')
         if p.returncode != 0:
             logger.warning('%d: %s - %s' % (p.returncode, output, err))
@@ -232,8 +375,8 @@ def actually_send_ir_signal(command: Command):
     except Exception as e:
         logger.exception(e)
     else:
-        with orm.db_session:
-            IRSendLog(command=str(command))
+        with db_session:
+            IRSendLog(command=ir_log_command(remote, command))
 
 
 def timing(f):
@@ -247,81 +390,67 @@ def timing(f):
     return timing_wrap
 
 
-def get_most_recent_message(once=False) -> dict:
-
-    logger.info('Start polling messages')
-
-    while True:
-        most_recent_message = get_message_from_sheet()
-
-        if most_recent_message:
-            break
-        else:
-            sleep_time = 60 * 15
-            logger.info('Sleeping %d %s', sleep_time, 'secs')
-            time.sleep(sleep_time)
+class InitPygsheets:
+    # Google Sheets client and worksheet handles. The sheet worker owns one, see sheet_worker.SheetWorker.
 
-        if once:
-            most_recent_message = get_message_from_sheet()
-            break
+    def __init__(self) -> None:
+        self._sh = None
+        self._worksheets = {}
 
-    if most_recent_message:
-        message_dict = json.loads(most_recent_message)
-        command = message_dict.get('command')
-
-        if command:
-            with orm.db_session:
-                param = message_dict.get('param')
-                if param is None:
-                    param = ''
-                else:
-                    param = json.dumps(param)
-
-                CommandLog(command=command, param=param)
-        else:
-            message_dict = {}
-    else:
-        message_dict = {}
-
-    return message_dict
+    def init_pygsheets(self):
 
+        if not self._sh:
+            try:
+                self._get_work_sheet()
+            except Exception as e:
+                logger.exception(e)
+                self._sh = None
 
-class InitPygsheets:
-    _sh = None
+        return self._sh
 
-    @classmethod
-    def init_pygsheets(cls):
+    def worksheet(self, index_or_title):
+        # Worksheet handles are cached until reset_pygsheets so that they are not looked up every cycle
+        sh = self.init_pygsheets()
 
-        if not cls._sh:
+        if sh and index_or_title not in self._worksheets:
             try:
-                cls._get_work_sheet()
+                if isinstance(index_or_title, int):
+                    self._worksheets[index_or_title] = sh[index_or_title]
+                else:
+                    self._worksheets[index_or_title] = sh.worksheet_by_title(index_or_title)
             except Exception as e:
                 logger.exception(e)
-                cls._sh = None
+                self.reset_pygsheets()
 
-        return cls._sh
+        return self._worksheets.get(index_or_title)
 
-    @classmethod
-    def reset_pygsheets(cls):
+    def reset_pygsheets(self):
         logger.info('Reset pygsheets')
-        cls._sh = None
+        self._sh = None
+        self._worksheets = {}
 
-    @classmethod
     @retry(tries=3, delay=30)
     @timing
-    def _get_work_sheet(cls):
+    def _get_work_sheet(self):
+        # pygsheets is slow to import and only needed in the sheet worker thread
+        import pygsheets
+
         logger.info('Init pygsheets')
         gc = pygsheets.authorize(
             outh_file=config.SHEET_OAUTH_FILE,
             outh_nonlocal=True,
             no_cache=True)
-        cls._sh = gc.open_by_key(config.SHEET_KEY)
+        self._sh = gc.open_by_key(config.SHEET_KEY)
 
 
-@retry(tries=3, delay=10)
 def get_url(url, headers=None):
+    from http_session import HttpSession
+
     logger.debug(url)
-    return requests.get(url, timeout=60, headers=headers)
+    result = HttpSession.session().get(url, timeout=config.HTTP_TIMEOUT, headers=headers)
+    metrics.count('bytes_downloaded', len(result.content))
+    logger.debug('HTTP connections: %s', HttpSession.connection_stats())
+    return result
 
 
 @timing
@@ -345,18 +474,26 @@ def get_from_smartthings(device_id):
     return temp, ts
 
 
-@retry(tries=3, delay=10)
-def post_url(url, data):
-    logger.debug(url)
-
+def json_dumps(data) -> str:
     def decimal_default(obj):
         if isinstance(obj, Decimal):
             return str(obj)
         raise TypeError
 
-    dumps = json.dumps(data, default=decimal_default)
+    return json.dumps(data, default=decimal_default)
+
+
+def post_url(url, data):
+    logger.debug(url)
+
+    from http_session import HttpSession
+
+    dumps = json_dumps(data)
     logger.debug(dumps)
-    return requests.post(url, data=dumps, timeout=60)
+    result = HttpSession.session().post(url, data=dumps, timeout=config.HTTP_TIMEOUT)
+    metrics.count('bytes_downloaded', len(result.content))
+    logger.debug('HTTP connections: %s', HttpSession.connection_stats())
+    return result
 
 
 def get_from_lambda_url(url):
@@ -378,57 +515,66 @@ def get_from_lambda_url(url):
     return temp, ts
 
 
+def sheet_range(wks, cell):
+    return "'%s'!%s" % (wks.title.replace("'", "''"), cell)
+
+
 @timing
-def get_message_from_sheet() -> str:
-    sh = InitPygsheets.init_pygsheets()
+def sync_message_sheet(sheets: InitPygsheets, log_msg: Optional[str] = None, read_message: bool = True) -> str:
+    # Message cell read is one batch get. Log cell write and message cell clear are one batch update.
+    import pygsheets
+
+    wks = sheets.worksheet(config.MESSAGE_SHEET_INDEX)
     cell_value = ''
-    cell = config.MESSAGE_SHEET_CELL
+    message_range = log_range = None
 
-    if sh:
+    if wks:
         try:
-            wks = sh[config.MESSAGE_SHEET_INDEX]
-            cell_value = wks.cell(cell).value_unformatted
+            values = wks.client.service.spreadsheets().values()
+            message_range = sheet_range(wks, config.MESSAGE_SHEET_CELL)
+            log_range = sheet_range(wks, 'B2')
+
+            if read_message:
+                value_ranges = values.batchGet(
+                    spreadsheetId=wks.spreadsheet.id,
+                    ranges=[message_range],
+                    valueRenderOption='UNFORMATTED_VALUE').execute().get('valueRanges', [])
+                cell_values = value_ranges[0].get('values') if value_ranges else None
+                cell_value = str(cell_values[0][0]) if cell_values and cell_values[0] else ''
+
+            data = []
             if cell_value:
-                wks.update_cell(cell, '')
+                data.append({'range': message_range, 'values': [['']]})
+            if log_msg is not None:
+                data.append({'range': log_range, 'values': [[log_msg]]})
+
+            if data:
+                values.batchUpdate(
+                    spreadsheetId=wks.spreadsheet.id,
+                    body={'valueInputOption': 'USER_ENTERED', 'data': data}).execute()
 
-            get_url(config.HEALTHCHECK_URL_MESSAGE)
+            if read_message:
+                get_url(config.HEALTHCHECK_URL_MESSAGE)
 
         except (pygsheets.exceptions.RequestError, ConnectionError):
             pass
         except Exception as e:
             logger.exception(e)
-            InitPygsheets.reset_pygsheets()
+            sheets.reset_pygsheets()
 
     return cell_value
 
 
 @timing
-def write_log_to_sheet(command: Command, extra_info: list):
-    sh = InitPygsheets.init_pygsheets()
-    cell = 'B2'
-
-    msg = '\n'.join([str(command), time_str()] + extra_info)
-
-    if sh:
-        try:
-            wks = sh[config.MESSAGE_SHEET_INDEX]
-            wks.update_cell(cell, msg)
-        except (pygsheets.exceptions.RequestError, ConnectionError):
-            pass
-        except Exception as e:
-            logger.exception(e)
-            InitPygsheets.reset_pygsheets()
+def get_temp_from_sheet(sheets: InitPygsheets, sheet_title) -> Tuple[Optional[Decimal], Optional[str]]:
+    import pygsheets
 
-
-@timing
-def get_temp_from_sheet(sheet_title) -> Tuple[Optional[Decimal], Optional[str]]:
-    sh = InitPygsheets.init_pygsheets()
+    wks = sheets.worksheet(sheet_title)
 
     temp, ts = None, None
 
-    if sh:
+    if wks:
         try:
-            wks = sh.worksheet_by_title(sheet_title)
             ts_and_temp = wks.range('B2:C2')[0]
             if len(ts_and_temp) == 2:
                 ts, temp = ts_and_temp
@@ -438,7 +584,7 @@ def get_temp_from_sheet(sheet_title) -> Tuple[Optional[Decimal], Optional[str]]:
             logger.exception(e)
         except Exception as e:
             logger.exception(e)
-            InitPygsheets.reset_pygsheets()
+            sheets.reset_pygsheets()
 
     return temp, ts
 
@@ -448,15 +594,9 @@ def median(data):
     is_list_of_temps = all(d is None or isinstance(d[0], Decimal) and isinstance(d[1], arrow.Arrow) for d in data)
 
     if not is_list_of_temps:
-        list_of_temps = make_tempts_lists_start_same(data)
-
-        temp = [
-            median(d)
-            for d
-            in itertools.zip_longest(*list_of_temps)
-        ]
+        temp = fuse_forecasts([d[0] for d in data if d is not None])
         if temp:
-            ts = temp[0][1]
+            ts = temp[0].ts
         else:
             ts = None
     else:
@@ -478,27 +618,60 @@ def median(data):
     return temp, ts
 
 
-def list_items_equal(lst):
-    return lst[1:] == lst[:-1]
+FUSION_MAX_STEP = datetime.timedelta(hours=1)
+_MICROSECOND = datetime.timedelta(microseconds=1)
 
 
-def make_tempts_lists_start_same(data):
-    list_of_temps = list(list(zip(*data))[0])
-    list_of_first_timestamps = get_list_of_first_timestamps(list_of_temps)
+def fuse_forecasts(forecasts: List[List[TempTs]]) -> List[TempTs]:
+    # Resamples the forecasts onto a common time grid with linear interpolation and takes the median of each slot.
+    # The grid starts when all forecasts have started, ends when the last one ends and has the finest spacing of the
+    # forecasts, at most an hour. Forecasts are sorted by time. Linear in the number of points and slots.
+    forecasts = [f for f in forecasts if f]
+    if not forecasts:
+        return []
 
-    while not list_items_equal(list_of_first_timestamps):
-        list_index_to_delete_from = min(enumerate(list_of_temps), key=lambda x: x[1][0][1])[0]
-        del list_of_temps[list_index_to_delete_from][0]
-        list_of_first_timestamps = get_list_of_first_timestamps(list_of_temps)
+    start = max((f[0].ts for f in forecasts))
 
-    return list_of_temps
+    # Times as integer microseconds from the grid start
+    series = [([(t.ts - start) // _MICROSECOND for t in f], [t.temp for t in f]) for f in forecasts]
 
+    step = FUSION_MAX_STEP // _MICROSECOND
+    for offsets, _ in series:
+        for previous, offset in zip(offsets, offsets[1:]):
+            if offset > previous:
+                step = min(step, offset - previous)
 
-def get_list_of_first_timestamps(list_of_temps):
-    try:
-        return [l[0][1] for l in list_of_temps]
-    except IndexError:
-        return []
+    slot_count = max(offsets[-1] for offsets, _ in series) // step + 1
+    slots = [[] for _ in range(slot_count)]
+
+    for offsets, temps in series:
+        i = 0
+        for slot, values in enumerate(slots):
+            offset = slot * step
+            if offset > offsets[-1]:
+                break
+
+            while i + 1 < len(offsets) and offsets[i + 1] <= offset:
+                i += 1
+
+            if offsets[i] == offset:
+                values.append(temps[i])
+            else:
+                fraction = Decimal(offset - offsets[i]) / Decimal(offsets[i + 1] - offsets[i])
+                values.append(decimal_round(temps[i] + (temps[i + 1] - temps[i]) * fraction, 2))
+
+    fused = []
+
+    for slot, values in enumerate(slots):
+        values.sort()
+        n = len(values)
+        if n % 2 == 1:
+            temp = values[n // 2]
+        else:
+            temp = (values[n // 2 - 1] + values[n // 2]) / 2
+        fused.append(TempTs(temp, start + slot * step * _MICROSECOND))
+
+    return fused
 
 
 def decimal_round(value, decimals=1) -> Optional[Decimal]:
@@ -1,9 +1,14 @@
+import http.server
+import socketserver
+import threading
+
 import arrow
 from decimal import Decimal
 
 from freezegun import freeze_time
 
-from poller_helpers import median, send_ir_signal, Commands, TempTs
+from http_session import HttpSession
+from poller_helpers import median, send_ir_signal, Commands, TempTs, get_url, fuse_forecasts, Forecast
 
 
 def test_median():
@@ -37,6 +42,62 @@ def test_median_list_of_temps():
     assert result_ts == ts1
 
 
+def test_fuse_forecasts_aligns_sources_by_time():
+    ts = arrow.get('2017-08-18T15:00:00+03:00')
+
+    # Hourly source starting later and 3-hourly source starting earlier
+    hourly = [TempTs(Decimal(t), ts.shift(hours=h)) for h, t in [(1, 10), (2, 11), (3, 12), (4, 13), (5, 14)]]
+    three_hourly = [TempTs(Decimal(t), ts.shift(hours=h)) for h, t in [(0, 5), (3, 8), (6, 11)]]
+
+    result = fuse_forecasts([hourly, three_hourly])
+
+    assert [r.ts for r in result] == [ts.shift(hours=h) for h in range(1, 7)]
+    assert [r.temp for r in result] == [
+        Decimal('8.0'), Decimal('9.0'), Decimal('10.0'), Decimal('11.0'), Decimal('12.0'), Decimal('11')]
+
+
+def test_fuse_forecasts_median_of_many_sources():
+    ts = arrow.get('2017-08-18T15:00:00+03:00')
+
+    def source(offset_minutes, *temps):
+        return [TempTs(Decimal(t), ts.shift(minutes=offset_minutes, hours=h)) for h, t in enumerate(temps)]
+
+    result = fuse_forecasts([
+        source(0, 1, 2, 3),
+        source(0, 10, 20),
+        source(30, 4, 5),
+        [],
+    ])
+
+    # The second source has ended at the second slot
+    assert [r.ts for r in result] == [ts.shift(minutes=30), ts.shift(minutes=90)]
+    assert [r.temp for r in result] == [Decimal('4'), Decimal('3.75')]
+    assert fuse_forecasts([[], []]) == []
+
+
+def test_forecast():
+    ts = arrow.get('2017-08-18T15:00:00+03:00')
+    temps = [TempTs(Decimal(t), ts.shift(hours=h)) for h, t in enumerate([1, 2, 3, 6])]
+
+    forecast = Forecast(temps, ts)
+
+    assert forecast.temps == temps
+    assert forecast[-1] == temps[-1]
+    assert forecast.mean() == Decimal(3)
+    assert forecast.mean(0, 2) == Decimal('1.5')
+    assert forecast.mean(2, 100) == Decimal('4.5')
+    assert forecast.mean(4) is None
+
+    later = forecast.after(ts.shift(minutes=30).timestamp)
+    assert later.temps == temps[1:]
+    assert later.mean(0, 2) == Decimal('2.5')
+    assert forecast.index_after(ts.shift(hours=2).timestamp) == 3
+
+    # Empty forecast is still truthy like the previous NamedTuple
+    empty = forecast.after(ts.shift(hours=10).timestamp)
+    assert empty and len(empty) == 0 and empty.mean() is None
+
+
 def test_send_ir_signal_fail(mocker):
     mock_email = mocker.patch('poller_helpers.email')
     mocker.patch('time.sleep')
@@ -75,3 +136,37 @@ def test_command():
     assert Commands.off
     assert Commands.off != ''
     assert Commands.off != 234
+
+
+def test_get_url_reuses_connections():
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'ok')
+
+        def log_message(self, *args):
+            pass
+
+    class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    HttpSession.reset()
+    HttpSession.reset_stats()
+
+    try:
+        for _ in range(3):
+            assert get_url('http://127.0.0.1:%d/' % server.server_address[1]).content == b'ok'
+        assert HttpSession.connection_stats() == {'requests': 3, 'new_connections': 1, 'reused_connections': 2}
+    finally:
+        HttpSession.reset()
+        server.shutdown()
+
+    # Counters are cumulative and survive dropping the session
+    assert HttpSession.connection_stats()['reused_connections'] == 2
@@ -0,0 +1,277 @@
+# coding=utf-8
+# Offline replay of AutoPipeline against recorded outside (and optionally inside and forecast) temperatures.
+#
+# Time is simulated with the clock of the pipeline context and IR, email, sheet, storage and DB I/O is stubbed
+# out. Inside temperature is simulated with a simple house model driven by the commands the pipeline sends,
+# unless a recorded inside series is given with --recorded-inside.
+#
+# Usage: python replay.py outside.csv [--inside inside.csv] [--recorded-inside] [--forecast forecast.csv]
+#                         [--interval minutes] [--adaptive]
+# Without --recorded-inside, --inside only sets the inside temperature at start.
+# CSV rows are "<ISO 8601 timestamp>,<temperature>".
+import argparse
+import csv
+import logging
+from bisect import bisect_right
+from decimal import Decimal
+from typing import NamedTuple, List, Optional, Tuple
+from unittest import mock
+
+import arrow
+
+import config
+from poller_helpers import TempTs, Command, Commands, logger, decimal_round
+from states.auto_pipeline import AutoPipeline, get_have_valid_time
+from states.auto_pipeline_pipes import general
+from states.auto_pipeline_pipes.adjust_target_with_rh import get_dew_point
+from states.auto_pipeline_pipes.get_forecast import get_forecast, make_forecast
+from states.auto_pipeline_pipes.get_inside import get_inside
+from states.auto_pipeline_pipes.get_outside import get_outside, get_outside_measurement
+from states.auto_pipeline_pipes.helpers import forecast_mean_temperature, RequestCache
+from states.controller import Controller
+from states.pipeline_context import PipelineContext
+from units import default_unit
+
+Recording = NamedTuple('Recording', [
+    ('outside', List[TempTs]),
+    ('inside', Optional[List[TempTs]]),
+    ('forecast', Optional[List[TempTs]]),
+])
+
+Cycle = NamedTuple('Cycle', [
+    ('ts', arrow.Arrow),
+    ('inside_temp', Optional[Decimal]),
+    ('outside_temp', Decimal),
+    ('target_inside_temp', Decimal),
+    ('command', Command),
+])
+
+ReplayResult = NamedTuple('ReplayResult', [
+    ('commands', List[Tuple[arrow.Arrow, Command]]),
+    ('cycles', List[Cycle]),
+    ('compressor_starts', int),
+])
+
+
+def load_series(path) -> List[TempTs]:
+    with open(path) as f:
+        series = [TempTs(Decimal(row[1]), arrow.get(row[0])) for row in csv.reader(f) if row]
+    return sorted(series, key=lambda t: t.ts)
+
+
+class Series:
+    def __init__(self, temps: List[TempTs]) -> None:
+        self.temps = temps
+        self.epochs = [t.ts.float_timestamp for t in temps]
+
+    def at(self, ts: arrow.Arrow) -> Optional[TempTs]:
+        # Latest value at or before ts
+        i = bisect_right(self.epochs, ts.float_timestamp)
+        if i == 0:
+            return None
+        return self.temps[i - 1]
+
+    def between(self, start: arrow.Arrow, end: arrow.Arrow) -> List[TempTs]:
+        start_index = bisect_right(self.epochs, start.float_timestamp)
+        end_index = bisect_right(self.epochs, end.float_timestamp)
+        return self.temps[start_index:end_index]
+
+
+class HouseModel:
+    # Inside temperature drifts towards outside with the configured cooling rate and is pushed towards the
+    # command temperature by the heat pump.
+
+    def __init__(self, inside_temp: float, heating_rate_per_hour_per_temperature_diff: float = 0.1) -> None:
+        self.inside_temp = inside_temp
+        self.heating_rate = heating_rate_per_hour_per_temperature_diff
+        self.cooling_rate = float(config.COOLING_RATE_PER_HOUR_PER_TEMPERATURE_DIFF)
+
+    def step(self, outside_temp: float, command: Optional[Command], hours: float) -> None:
+        change = self.cooling_rate * (outside_temp - self.inside_temp)
+
+        if command is not None and command.temp is not None and command.temp > self.inside_temp:
+            change += self.heating_rate * (float(command.temp) - self.inside_temp)
+
+        self.inside_temp += change * hours
+
+
+class ReplayPipeline(AutoPipeline):
+    def __init__(self, replay: 'Replay') -> None:
+        self.replay = replay
+        self.unit = default_unit()
+        # Memory only request cache and no DB or sheet
+        self.context = PipelineContext(request_cache=RequestCache(db_session=None),
+                                       clock=lambda: replay.now.float_timestamp)
+        self.persistent_data = self.context.persistent_data
+
+    def pipeline(self) -> list:
+        replaced = {
+            general.get_controller: self.replay.get_controller,
+            get_have_valid_time: lambda **kwargs: {'have_valid_time': True},
+            get_forecast: self.replay.get_forecast,
+            get_outside_measurement: lambda **kwargs: None,
+            get_outside: self.replay.get_outside,
+            get_inside: self.replay.get_inside,
+            get_dew_point: lambda **kwargs: {'dew_point': None},  # No recorded dew point
+            general.send_to_lambda: lambda **kwargs: None,
+            general.store_cycle: lambda **kwargs: None,
+            general.write_log: lambda **kwargs: None,
+            general.save_state: lambda **kwargs: None,
+        }
+        return [replaced.get(pipe, pipe) for pipe in super().pipeline()] + [self.replay.record_cycle]
+
+    def pipe_executor(self):
+        # Sequential for reproducible results. Also the executor threads don't survive fork in sweep workers.
+        return None
+
+    def write_metrics(self):
+        pass
+
+    def wait_message(self, wait_seconds=None):
+        self.replay.next_cycle_seconds = wait_seconds
+        return {}
+
+
+class Replay:
+    def __init__(self, recording: Recording, interval_minutes: int = 15, forecast_hours: int = 48,
+                 recorded_inside: bool = False, initial_inside_temp: Optional[Decimal] = None,
+                 params: Optional[dict] = None, adaptive: bool = False) -> None:
+        # params overrides config values (e.g. CONTROLLER_P) for the duration of the replay. With adaptive the
+        # next cycle is run when the pipeline schedules it instead of every interval_minutes.
+        self.params = params or {}
+        self.outside = Series(recording.outside)
+        self.inside = Series(recording.inside) if recording.inside else None
+        self.forecast = Series(recording.forecast) if recording.forecast else self.outside
+        self.interval_minutes = interval_minutes
+        self.adaptive = adaptive
+        self.next_cycle_seconds = None
+        self.forecast_hours = forecast_hours
+        self.recorded_inside = recorded_inside and self.inside is not None
+
+        if initial_inside_temp is None:
+            first_inside = self.inside.temps[0].temp if self.inside else config.MINIMUM_INSIDE_TEMP
+            initial_inside_temp = first_inside
+
+        self.house = HouseModel(float(initial_inside_temp))
+        self.now = None
+        self.sent_commands: List[Tuple[arrow.Arrow, Command]] = []
+        self.cycles: List[Cycle] = []
+
+    def get_controller(self, persistent_data, **kwargs):
+        if 'controller' not in persistent_data:
+            controller = Controller(config.CONTROLLER_P, config.CONTROLLER_I, config.CONTROLLER_D,
+                                    clock=lambda: self.now.float_timestamp)
+            return {}, {'controller': controller}
+
+    def get_forecast(self, add_extra_info, **kwargs):
+        temps = self.forecast.between(self.now, self.now.shift(hours=self.forecast_hours))
+        if temps:
+            forecast = make_forecast(temps, self.now, True)
+        else:
+            forecast = None
+        mean_forecast = forecast_mean_temperature(forecast)
+        add_extra_info('Forecast 24 h mean: %s' % decimal_round(mean_forecast))
+        return {'forecast': forecast, 'mean_forecast': mean_forecast}
+
+    def get_outside(self, add_extra_info, mean_forecast, **kwargs):
+        outside = self.outside.at(self.now)
+        if outside is None:
+            outside = TempTs(mean_forecast if mean_forecast is not None else Decimal(-10), self.now)
+        add_extra_info('Outside temperature: %s' % outside.temp)
+        return {'outside_temp_ts': outside, 'valid_outside': True}
+
+    def get_inside(self, add_extra_info, **kwargs):
+        if self.recorded_inside:
+            recorded = self.inside.at(self.now)
+            inside_temp = recorded.temp if recorded else None
+        else:
+            inside_temp = decimal_round(Decimal(self.house.inside_temp))
+        add_extra_info('Inside temperature: %s' % inside_temp)
+        return {'inside_temp': inside_temp}
+
+    def record_cycle(self, inside_temp, outside_temp_ts, target_inside_temp, persistent_data, **kwargs):
+        command = persistent_data.get('last_command')
+        self.cycles.append(Cycle(self.now, inside_temp, outside_temp_ts.temp, target_inside_temp, command))
+
+    def send_ir_signal(self, command: Command, **kwargs):
+        self.sent_commands.append((self.now, command))
+
+    def run(self, start: Optional[arrow.Arrow] = None, end: Optional[arrow.Arrow] = None) -> ReplayResult:
+        if start is None:
+            start = self.outside.temps[0].ts
+        if end is None:
+            end = self.outside.temps[-1].ts
+
+        log_level = logger.level
+        logger.setLevel(logging.WARNING)
+
+        try:
+            with mock.patch('states.auto_pipeline_pipes.general.send_ir_signal', self.send_ir_signal), \
+                    mock.patch('states.auto_pipeline_pipes.send_status_mail.email'), \
+                    mock.patch.dict(config.__dict__, self.params):
+
+                self.now = start
+                pipeline = ReplayPipeline(self)  # Unit from the config with params
+
+                while self.now <= end:
+                    pipeline.run(None)
+
+                    if self.adaptive and self.next_cycle_seconds:
+                        interval_seconds = self.next_cycle_seconds
+                    else:
+                        interval_seconds = self.interval_minutes * 60
+
+                    cycle = self.cycles[-1]
+                    self.house.step(float(cycle.outside_temp), cycle.command, interval_seconds / 3600.0)
+                    self.now = self.now.shift(seconds=interval_seconds)
+        finally:
+            logger.setLevel(log_level)
+
+        return ReplayResult(self.sent_commands, self.cycles, count_compressor_starts(self.sent_commands))
+
+
+def count_compressor_starts(sent_commands: List[Tuple[arrow.Arrow, Command]]) -> int:
+    starts = 0
+    last_command = Commands.off
+
+    for ts, command in sent_commands:
+        if last_command == Commands.off and command != Commands.off:
+            starts += 1
+        last_command = command
+
+    return starts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay AutoPipeline against recorded temperatures')
+    parser.add_argument('outside', help='CSV of outside temperatures')
+    parser.add_argument('--inside', help='CSV of inside temperatures')
+    parser.add_argument('--forecast', help='CSV of forecast temperatures (default: outside is a perfect forecast)')
+    parser.add_argument('--recorded-inside', action='store_true',
+                        help='Use recorded inside temperatures instead of simulating them')
+    parser.add_argument('--interval', type=int, default=15, help='Cycle interval in minutes')
+    parser.add_argument('--adaptive', action='store_true', help='Use the cycle interval the pipeline schedules')
+    args = parser.parse_args()
+
+    recording = Recording(
+        outside=load_series(args.outside),
+        inside=load_series(args.inside) if args.inside else None,
+        forecast=load_series(args.forecast) if args.forecast else None,
+    )
+
+    result = Replay(recording, interval_minutes=args.interval, recorded_inside=args.recorded_inside,
+                    adaptive=args.adaptive).run()
+
+    for ts, command in result.commands:
+        print('%s %s' % (ts.to(config.TIMEZONE).format('DD.MM.YYYY HH:mm'), command))
+
+    inside_temps = [c.inside_temp for c in result.cycles if c.inside_temp is not None]
+    print('Cycles: %d' % len(result.cycles))
+    print('IR commands: %d' % len(result.commands))
+    print('Compressor starts: %d' % result.compressor_starts)
+    if inside_temps:
+        print('Inside min %s, max %s' % (min(inside_temps), max(inside_temps)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+import math
+import time
+from decimal import Decimal
+
+import arrow
+
+from poller_helpers import TempTs, Commands
+from replay import Recording, Replay
+
+
+def make_outside(days):
+    start = arrow.get('2018-01-01T00:00:00+02:00')
+    return [
+        TempTs(Decimal(str(round(-10 + 5 * math.sin(h / 24.0 * 2 * math.pi), 1))), start.shift(hours=h))
+        for h in range(days * 24 + 1)
+    ]
+
+
+def test_replay(mocker):
+    mock_send = mocker.patch('poller_helpers.actually_send_ir_signal')
+    mock_email = mocker.patch('poller_helpers.email')
+
+    recording = Recording(outside=make_outside(3), inside=None, forecast=None)
+
+    start = time.time()
+    result = Replay(recording, initial_inside_temp=Decimal(6)).run()
+
+    assert time.time() - start < 30
+    assert len(result.cycles) == 3 * 24 * 4 + 1
+    assert result.commands
+    assert result.compressor_starts >= 1
+    assert all(c.command is not None for c in result.cycles)
+    assert min(c.inside_temp for c in result.cycles) > Decimal(2)
+
+    assert mock_send.call_count == 0
+    assert mock_email.call_count == 0
+
+
+def test_replay_compressor_starts():
+    from replay import count_compressor_starts
+
+    ts = arrow.now()
+    assert count_compressor_starts([
+        (ts, Commands.heat8), (ts, Commands.heat10), (ts, Commands.off), (ts, Commands.heat8), (ts, Commands.off)
+    ]) == 2
+
+
+def test_replay_adaptive_cycle():
+    recording = Recording(outside=make_outside(6), inside=None, forecast=None)
+
+    fixed = Replay(recording, initial_inside_temp=Decimal(6)).run()
+    adaptive = Replay(recording, initial_inside_temp=Decimal(6), adaptive=True).run()
+
+    assert len(adaptive.cycles) < len(fixed.cycles) * Decimal('0.6')
+    assert adaptive.compressor_starts <= fixed.compressor_starts
+    assert min(c.inside_temp - c.target_inside_temp for c in adaptive.cycles) >= \
+        min(c.inside_temp - c.target_inside_temp for c in fixed.cycles)
@@ -0,0 +1,205 @@
+# coding=utf-8
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from decimal import Decimal
+from typing import Optional, Tuple
+
+import config
+import poller_helpers
+from message_sources import inbox
+from poller_helpers import Command, CommandLog, InitPygsheets, logger, time_str, db_session
+from workers import BackgroundWorker
+
+
+class SheetWorker(BackgroundWorker):
+    # Runs all Google Sheets I/O in its own thread so that slow API calls or pygsheets re-authorization never
+    # block the control loop. Log writes are coalesced to the latest value and polled messages are handed back
+    # through the shared message inbox. A pending log write and message polls are done together in one sheet sync.
+
+    name = 'sheet-worker'
+
+    def __init__(self, messages: queue.Queue = inbox) -> None:
+        super().__init__()
+        self.commands = queue.Queue()
+        self.messages = messages
+        self._pending_log = None
+        self._poll_futures = []
+        self._pending_lock = threading.Lock()
+        self._metrics = {}
+        self._metrics_lock = threading.Lock()
+        self.sheets = InitPygsheets()
+
+    def write_log(self, msg: str):
+        with self._pending_lock:
+            self._pending_log = (msg, time.time())
+        self._submit()
+
+    def poll_messages(self) -> Future:
+        future = Future()
+        with self._pending_lock:
+            self._poll_futures.append((future, time.time()))
+        self._submit()
+        return future
+
+    def get_temp(self, sheet_title) -> Future:
+        return self._submit(poller_helpers.get_temp_from_sheet, self.sheets, sheet_title)
+
+    def _submit(self, func=None, *args) -> Future:
+        future = Future()
+        if func is not None:
+            self.commands.put((func, args, future, time.time()))
+        self.start()
+        self.wake()
+        return future
+
+    def _sync_message_sheet(self):
+        with self._pending_lock:
+            pending_log, self._pending_log = self._pending_log, None
+            poll_futures, self._poll_futures = self._poll_futures, []
+
+        poll_futures = [(future, queued_at) for future, queued_at in poll_futures
+                        if future.set_running_or_notify_cancel()]
+
+        if pending_log is None and not poll_futures:
+            return
+
+        log_msg = None
+        queued_ats = [queued_at for _, queued_at in poll_futures]
+        if pending_log is not None:
+            log_msg = pending_log[0]
+            queued_ats.append(pending_log[1])
+        queued_at = min(queued_ats)
+
+        try:
+            message = self._measure('sync_message_sheet', queued_at, poller_helpers.sync_message_sheet,
+                                    self.sheets, log_msg, bool(poll_futures))
+        except Exception as e:
+            for future, _ in poll_futures:
+                future.set_exception(e)
+            raise
+
+        if message:
+            self.messages.put(message)
+
+        for future, _ in poll_futures:
+            future.set_result(message)
+
+    def work(self):
+        self._sync_message_sheet()
+
+        while True:
+            try:
+                func, args, future, queued_at = self.commands.get_nowait()
+            except queue.Empty:
+                break
+
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                future.set_result(self._measure(func.__name__.lstrip('_'), queued_at, func, *args))
+            except Exception as e:
+                future.set_exception(e)
+
+    def _measure(self, name, queued_at, func, *args):
+        started_at = time.time()
+        try:
+            return func(*args)
+        finally:
+            ended_at = time.time()
+            with self._metrics_lock:
+                metrics = self._metrics.setdefault(name, {
+                    'count': 0, 'total_seconds': 0.0, 'max_seconds': 0.0, 'max_queue_seconds': 0.0})
+                metrics['count'] += 1
+                metrics['total_seconds'] += ended_at - started_at
+                metrics['last_seconds'] = ended_at - started_at
+                metrics['max_seconds'] = max(metrics['max_seconds'], ended_at - started_at)
+                metrics['max_queue_seconds'] = max(metrics['max_queue_seconds'], started_at - queued_at)
+            logger.debug('Sheet %s took %.3f sec, queued %.3f sec', name, ended_at - started_at,
+                         started_at - queued_at)
+
+    def metrics(self) -> dict:
+        with self._metrics_lock:
+            return {name: dict(metrics) for name, metrics in self._metrics.items()}
+
+
+sheet_worker = SheetWorker()
+
+
+def write_log_to_sheet(command: Command, extra_info: list, worker: SheetWorker = sheet_worker):
+    worker.write_log('\n'.join([str(command), time_str()] + extra_info))
+
+
+def get_temp_from_sheet(sheet_title, worker: SheetWorker = sheet_worker) -> Tuple[Optional[Decimal], Optional[str]]:
+    try:
+        return worker.get_temp(sheet_title).result(config.SHEET_TIMEOUT)
+    except Exception as e:
+        logger.exception(e)
+        return None, None
+
+
+def _poll_message(worker: SheetWorker) -> Optional[str]:
+    try:
+        worker.poll_messages().result(config.SHEET_TIMEOUT)
+    except Exception as e:
+        logger.exception(e)
+
+    try:
+        return worker.messages.get_nowait()
+    except queue.Empty:
+        return None
+
+
+def get_most_recent_message(once=False, wait_seconds=None, worker: SheetWorker = sheet_worker) -> dict:
+
+    logger.info('Start polling messages')
+
+    if wait_seconds is None:
+        wait_seconds = config.MESSAGE_SHEET_POLL_SECONDS
+    deadline = time.time() + wait_seconds
+
+    while True:
+        most_recent_message = _poll_message(worker)
+
+        if most_recent_message:
+            break
+
+        remaining = deadline - time.time()
+        if once and remaining <= 0:
+            break
+
+        # The sheet is read at least every MESSAGE_SHEET_POLL_SECONDS also when the cycle is longer. A message from
+        # any source ends the wait early.
+        sleep_time = config.MESSAGE_SHEET_POLL_SECONDS
+        if once:
+            sleep_time = min(remaining, sleep_time)
+        logger.info('Waiting %d %s', sleep_time, 'secs')
+
+        try:
+            most_recent_message = worker.messages.get(timeout=sleep_time)
+            break
+        except queue.Empty:
+            pass
+
+    if most_recent_message:
+        message_dict = json.loads(most_recent_message)
+        command = message_dict.get('command')
+
+        if command:
+            with db_session:
+                param = message_dict.get('param')
+                if param is None:
+                    param = ''
+                else:
+                    param = json.dumps(param)
+
+                CommandLog(command=command, param=param)
+        else:
+            message_dict = {}
+    else:
+        message_dict = {}
+
+    return message_dict
@@ -0,0 +1,100 @@
+import queue
+import time
+from unittest.mock import Mock
+
+from poller_helpers import sync_message_sheet, InitPygsheets
+from sheet_worker import SheetWorker, get_most_recent_message, sheet_worker
+
+
+def test_log_writes_are_coalesced(mocker):
+    mocker.patch('sheet_worker.SheetWorker.start')
+    mock_sync = mocker.patch('poller_helpers.sync_message_sheet', return_value='')
+
+    worker = SheetWorker()
+    worker.write_log('first')
+    worker.write_log('second')
+    worker.write_log('third')
+    worker.work()
+    worker.work()
+
+    mock_sync.assert_called_once_with(worker.sheets, 'third', False)
+    assert worker.metrics()['sync_message_sheet']['count'] == 1
+
+
+def test_log_write_and_polls_share_one_sync(mocker):
+    mocker.patch('sheet_worker.SheetWorker.start')
+    mock_sync = mocker.patch('poller_helpers.sync_message_sheet', return_value='{"command": "auto"}')
+
+    worker = SheetWorker(messages=queue.Queue())
+    worker.write_log('log')
+    poll1 = worker.poll_messages()
+    poll2 = worker.poll_messages()
+    worker.work()
+
+    mock_sync.assert_called_once_with(worker.sheets, 'log', True)
+    assert poll1.result(0) == poll2.result(0) == '{"command": "auto"}'
+    assert worker.messages.get_nowait() == '{"command": "auto"}'
+
+
+def test_slow_sheet_does_not_block_log_writes(mocker):
+    def slow_sync(log_msg, read_message):
+        time.sleep(0.5)
+
+    mocker.patch('poller_helpers.sync_message_sheet', side_effect=slow_sync)
+
+    worker = SheetWorker()
+    start = time.time()
+    worker.write_log('msg')
+    assert time.time() - start < 0.1
+
+    worker.stop(timeout=1)
+
+
+def test_get_most_recent_message(mocker):
+    mocker.patch('poller_helpers.sync_message_sheet', return_value='{"command": "auto"}')
+    try:
+        assert get_most_recent_message(once=True) == {'command': 'auto'}
+        assert sheet_worker.metrics()['sync_message_sheet']['count'] >= 1
+    finally:
+        sheet_worker.stop(timeout=1)
+
+
+def test_sync_message_sheet_round_trips(mocker):
+    mocker.patch('poller_helpers.get_url')
+    wks = Mock(title='Messages')
+    values = wks.client.service.spreadsheets.return_value.values.return_value
+    values.batchGet.return_value.execute.return_value = {'valueRanges': [{'values': [['{"command": "auto"}']]}]}
+    mocker.patch.object(InitPygsheets, 'worksheet', return_value=wks)
+
+    assert sync_message_sheet(InitPygsheets(), 'log', True) == '{"command": "auto"}'
+
+    assert values.batchGet.call_count == 1
+    assert values.batchUpdate.call_count == 1
+    assert values.batchUpdate.call_args[1]['body']['data'] == [
+        {'range': "'Messages'!A1", 'values': [['']]},
+        {'range': "'Messages'!B2", 'values': [['log']]},
+    ]
+
+
+def test_sync_message_sheet_empty_message(mocker):
+    mocker.patch('poller_helpers.get_url')
+    wks = Mock(title='Messages')
+    values = wks.client.service.spreadsheets.return_value.values.return_value
+    values.batchGet.return_value.execute.return_value = {'valueRanges': [{}]}
+    mocker.patch.object(InitPygsheets, 'worksheet', return_value=wks)
+
+    assert sync_message_sheet(InitPygsheets(), None, True) == ''
+
+    assert values.batchGet.call_count == 1
+    assert values.batchUpdate.call_count == 0
+
+
+def test_long_wait_reads_sheet_every_poll_interval(mocker):
+    mocker.patch('config.MESSAGE_SHEET_POLL_SECONDS', 0.1)
+    mock_poll = mocker.patch('sheet_worker._poll_message', side_effect=[None, None, '{"command": "auto"}'])
+
+    start = time.time()
+    assert get_most_recent_message(once=True, wait_seconds=60) == {'command': 'auto'}
+
+    assert time.time() - start < 5
+    assert mock_poll.call_count == 3
@@ -1,61 +1,102 @@
 # coding=utf-8
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
-from poller_helpers import get_most_recent_message, have_valid_time, logger
-from states import State
-from states.auto_pipeline_pipes.adjust_target_with_rh import adjust_target_with_rh
+import config
+from metrics import cycle_profiler, measure_pipe, pipe_metrics
+from poller_helpers import have_valid_time, logger
+from sheet_worker import get_most_recent_message
+from states import State, pipeline_context
+from states.auto_pipeline_pipes.adjust_target_with_rh import adjust_target_with_rh, get_dew_point
 from states.auto_pipeline_pipes import general
 from states.auto_pipeline_pipes.get_error import get_error
 from states.auto_pipeline_pipes.get_forecast import get_forecast
 from states.auto_pipeline_pipes.get_inside import get_inside
 from states.auto_pipeline_pipes.get_next_command import get_next_command
-from states.auto_pipeline_pipes.get_outside import get_outside
+from states.auto_pipeline_pipes.get_outside import get_outside, get_outside_measurement
 from states.auto_pipeline_pipes.get_target_inside_temperature import target_inside_temp
+from states.auto_pipeline_pipes.schedule_next_cycle import schedule_next_cycle
 from states.auto_pipeline_pipes.send_status_mail import send_status_mail
+from states.pipe_graph import PipeGraph, pipe
+from states.pipeline_context import PipelineContext
+from units import Unit, default_unit
 
+_pipe_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='pipe')
 
-class AutoPipeline(State):
-    persistent_data = {}
 
-    def run(self, payload):
+@pipe(produces=('have_valid_time',))
+def get_have_valid_time(**kwargs):
+    return {'have_valid_time': have_valid_time()}
+
 
-        pipeline = [
+class AutoPipeline(State):
+    def __init__(self, unit: Optional[Unit] = None, context: Optional[PipelineContext] = None) -> None:
+        # States are created again for each cycle so the persistent data is kept in the context. Without a context
+        # the process default context is used.
+        self.unit = unit if unit is not None else default_unit()
+        self.context = context if context is not None else pipeline_context.default_context()
+        self.persistent_data = self.context.persistent_data
+
+    def pipeline(self) -> list:
+        return [
             general.get_controller,
             general.handle_payload,
-            lambda **kwargs: {'have_valid_time': have_valid_time()},
+            get_have_valid_time,
             general.get_add_extra_info,
+            get_outside_measurement,
+            get_dew_point,
+            get_inside,
             get_forecast,
             get_outside,
             target_inside_temp,
             adjust_target_with_rh,
             general.hysteresis,
-            get_inside,
             get_error,
             general.update_controller,
             get_next_command,
             send_status_mail,
             general.send_command,
+            schedule_next_cycle,
             general.send_to_lambda,
+            general.store_cycle,
             general.write_log,
-            general.save_controller_state,
+            general.save_state,
         ]
 
-        data = {'payload': payload}
+    def run(self, payload):
+        data = self.run_cycle(payload)
+        return self.wait_message(data.get('next_cycle_seconds'))
+
+    def run_cycle(self, payload) -> dict:
+        data = {'payload': payload, 'unit': self.unit}
+
+        # Pipes that don't depend on each other run in parallel, see states.pipe_graph
+        with self.context.cycle(), cycle_profiler.profile():
+            PipeGraph(self.pipeline(), self.pipe_executor()).run(data, self.persistent_data, self.call_pipe)
+
+        self.write_metrics()
+
+        return data
 
-        for pipe in pipeline:
-            logger.info('Calling %s', pipe)
-            result = pipe(persistent_data=AutoPipeline.persistent_data, **data)
-            logger.info('Call result %s: %s', pipe, result)
+    def pipe_executor(self) -> Optional[ThreadPoolExecutor]:
+        return _pipe_executor
 
-            if result:
-                if isinstance(result, tuple):
-                    new_data, new_persistent_data = result
-                else:
-                    new_data, new_persistent_data = result, {}
+    def call_pipe(self, pipe_func, data):
+        logger.info('Calling %s', pipe_func)
+        with pipeline_context.use(self.context), \
+                measure_pipe(getattr(pipe_func, '__name__', repr(pipe_func))) as stats:
+            result = pipe_func(persistent_data=self.persistent_data, **data)
+        logger.info('Call result %s (%.3f secs, %s): %s', pipe_func, stats.wall_seconds, stats.counters, result)
+        return result
 
-                data.update(new_data)
-                AutoPipeline.persistent_data.update(new_persistent_data)
+    def write_metrics(self):
+        try:
+            pipe_metrics.write(config.METRICS_FILE)
+        except IOError as e:
+            logger.exception(e)
 
-        return get_most_recent_message(once=True)
+    def wait_message(self, wait_seconds=None):
+        return get_most_recent_message(once=True, wait_seconds=wait_seconds, worker=self.context.sheet_worker)
 
     def nex(self, payload):
         from states.manual import Manual
@@ -64,7 +105,7 @@ class AutoPipeline(State):
             if payload['command'] == 'auto':
                 return AutoPipeline
             else:
-                AutoPipeline.persistent_data = {}
+                self.persistent_data.clear()
                 return Manual
         else:
             return AutoPipeline
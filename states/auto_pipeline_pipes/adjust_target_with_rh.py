@@ -3,44 +3,20 @@ from decimal import Decimal
 from typing import Tuple, Optional
 
 import arrow
-import xmltodict
 
-import config
-from poller_helpers import decimal_round, get_url, timing, logger
-from states.auto_pipeline_pipes.helpers import caching, get_temp
+from poller_helpers import decimal_round, timing, logger
+from states.auto_pipeline_pipes.fmi import fmi_observations
+from states.auto_pipeline_pipes.helpers import get_temp
+from states.pipe_graph import pipe
 
 
 @timing
-@caching(cache_name='fmi_dew_point')
 def receive_fmi_dew_point() -> Tuple[Optional[Decimal], Optional[arrow.Arrow]]:
-    dew_points = []
-    ts = None
-
-    try:
-        starttime = arrow.now().shift(hours=-3).to('UTC').format('YYYY-MM-DDTHH:mm:ss') + 'Z'
-        result = get_url(
-            'https://opendata.fmi.fi/wfs?request=getFeature&storedquery_id=fmi::observations::weather'
-            '::simple&place={place}&parameters=td&starttime={starttime}'.format(
-                place=config.FMI_LOCATION, starttime=starttime))
-    except Exception as e:
-        logger.exception(e)
-    else:
-        if result.status_code != 200:
-            logger.error('%d: %s' % (result.status_code, result.content))
-        else:
-            try:
-                wfs_member = xmltodict.parse(result.content).get('wfs:FeatureCollection', {}).get('wfs:member')
-
-                for member in wfs_member:
-                    temp_data = member.get('BsWfs:BsWfsElement')
-                    if temp_data and 'BsWfs:Time' in temp_data and 'BsWfs:ParameterValue' in temp_data:
-                        ts = arrow.get(temp_data['BsWfs:Time']).to(config.TIMEZONE)
-                        dew_points.append(Decimal(temp_data['BsWfs:ParameterValue']))
-            except (KeyError, TypeError):
-                pass
+    dew_points = fmi_observations('td')
 
     if dew_points:
-        dew_point = sum(dew_points) / len(dew_points)
+        dew_point = sum(d.temp for d in dew_points) / len(dew_points)
+        ts = dew_points[-1].ts
     else:
         dew_point = None
         ts = None
@@ -56,8 +32,15 @@ def estimate_temperature_with_rh(dew_point, rh):
     return a * (((b * dew_point) / (a + dew_point)) - rh_log) / (b + rh_log - ((b * dew_point) / (a + dew_point)))
 
 
-def adjust_target_with_rh(add_extra_info, target_inside_temp, **kwargs):
+@pipe(produces=('dew_point',))
+def get_dew_point(**kwargs):
     dew_point, ts = get_temp([receive_fmi_dew_point], max_ts_diff=6 * 60)
+    return {'dew_point': dew_point}
+
+
+@pipe(consumes=('add_extra_info', 'target_inside_temp', 'dew_point'), produces=('target_inside_temp',),
+      appends=('extra_info',))
+def adjust_target_with_rh(add_extra_info, target_inside_temp, dew_point, **kwargs):
     add_extra_info('Dew point: %s' % decimal_round(dew_point))
 
     if dew_point is not None:
@@ -0,0 +1,106 @@
+from decimal import Decimal, InvalidOperation
+from io import BytesIO
+from typing import Iterator, Optional, Tuple, Dict, List
+from xml.etree.ElementTree import iterparse, ParseError
+
+import arrow
+
+import config
+from poller_helpers import TempTs, get_url, timing, logger
+from states import pipeline_context
+from states.auto_pipeline_pipes.helpers import caching
+
+BS_WFS_NS = '{http://xml.fmi.fi/schema/wfs/2.0}'
+BS_WFS_ELEMENT = BS_WFS_NS + 'BsWfsElement'
+BS_WFS_TIME = BS_WFS_NS + 'Time'
+BS_WFS_PARAMETER_NAME = BS_WFS_NS + 'ParameterName'
+BS_WFS_PARAMETER_VALUE = BS_WFS_NS + 'ParameterValue'
+
+WFS_PARSE_ERRORS = (ParseError, InvalidOperation, arrow.parser.ParserError)
+
+
+OBSERVATION_PARAMETERS = ('temperature', 'td')
+OBSERVATION_HOURS = 3
+
+
+def iter_wfs_values(content: bytes) -> Iterator[Tuple[str, TempTs]]:
+    # Streams BsWfsElements of a "simple" stored query response as (parameter name, value) pairs. Elements are
+    # cleared as soon as they are read so that the whole document is never kept in memory. NaN values are skipped.
+
+    root = None
+
+    for event, elem in iterparse(BytesIO(content), events=('start', 'end')):
+        if root is None:
+            root = elem
+            continue
+
+        if event != 'end' or elem.tag != BS_WFS_ELEMENT:
+            continue
+
+        time_text = elem.findtext(BS_WFS_TIME)
+        value_text = elem.findtext(BS_WFS_PARAMETER_VALUE)
+        name = elem.findtext(BS_WFS_PARAMETER_NAME)
+
+        root.clear()
+
+        if time_text is None or value_text is None:
+            continue
+
+        value = Decimal(value_text)
+        if not value.is_finite():
+            continue
+
+        yield name, TempTs(value, arrow.get(time_text).to(config.TIMEZONE))
+
+
+def iter_wfs_temps(content: bytes, parameter: Optional[str] = None) -> Iterator[TempTs]:
+    for name, temp_ts in iter_wfs_values(content):
+        if parameter is None or name == parameter:
+            yield temp_ts
+
+
+@timing
+@caching(cache_name='fmi_observations')
+def receive_fmi_observations() -> Tuple[Optional[Dict[str, List[TempTs]]], Optional[arrow.Arrow]]:
+    # Temperature and dew point observations in one request. Result feeds both get_outside_measurement and
+    # get_dew_point from the same cache entry.
+
+    observations, ts = None, None
+
+    try:
+        starttime = arrow.get(pipeline_context.now() - OBSERVATION_HOURS * 3600).format('YYYY-MM-DDTHH:mm:ss') + 'Z'
+        result = get_url(
+            'https://opendata.fmi.fi/wfs?request=getFeature&storedquery_id=fmi::observations::weather'
+            '::simple&place={place}&parameters={parameters}&starttime={starttime}'.format(
+                place=config.FMI_LOCATION, parameters=','.join(OBSERVATION_PARAMETERS), starttime=starttime))
+    except Exception as e:
+        logger.exception(e)
+    else:
+        if result.status_code != 200:
+            logger.error('%d: %s' % (result.status_code, result.content))
+        else:
+            try:
+                observations = {parameter: [] for parameter in OBSERVATION_PARAMETERS}
+                for name, temp_ts in iter_wfs_values(result.content):
+                    if name in observations:
+                        observations[name].append(temp_ts)
+                        if ts is None or temp_ts.ts > ts:
+                            ts = temp_ts.ts
+            except WFS_PARSE_ERRORS as e:
+                logger.exception(e)
+                observations, ts = None, None
+
+    if ts is None:
+        observations = None
+
+    logger.info('observations:%s ts:%s', observations, ts)
+    return observations, ts
+
+
+def fmi_observations(parameter: str) -> List[TempTs]:
+    result = receive_fmi_observations()
+
+    if result and result[0]:
+        return result[0].get(parameter, [])
+    else:
+        return []
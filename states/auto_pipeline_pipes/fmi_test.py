@@ -0,0 +1,56 @@
+import os
+from decimal import Decimal
+
+import arrow
+import pytest
+from freezegun import freeze_time
+
+from states.auto_pipeline_pipes.fmi import iter_wfs_temps, WFS_PARSE_ERRORS
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES, name), 'rb') as f:
+        return f.read()
+
+
+def test_iter_wfs_temps_forecast():
+    temps = list(iter_wfs_temps(read_fixture('fmi_forecast.xml')))
+
+    # Last value in the fixture is NaN
+    assert len(temps) == 63
+    assert temps[0].ts == arrow.get('2018-11-25T12:00:00Z')
+    assert temps[0].temp == Decimal('-2.45')
+    assert all(t.temp.is_finite() for t in temps)
+
+
+def test_iter_wfs_temps_parameter_filter():
+    content = read_fixture('fmi_dew_point.xml')
+
+    assert list(iter_wfs_temps(content, parameter='temperature')) == []
+    assert len(list(iter_wfs_temps(content, parameter='td'))) == 18
+
+
+def test_iter_wfs_temps_broken_document():
+    with pytest.raises(WFS_PARSE_ERRORS):
+        list(iter_wfs_temps(b'<wfs:FeatureCollection'))
+
+
+def test_receive_fmi_observations_single_request(mocker):
+    from states.auto_pipeline_pipes.adjust_target_with_rh import receive_fmi_dew_point
+    from states.auto_pipeline_pipes.get_outside import receive_fmi_temperature
+    from states.auto_pipeline_pipes.helpers import request_cache
+
+    request_cache.reset(persistent=True)
+    result = mocker.Mock(status_code=200, content=read_fixture('fmi_observations.xml'))
+    mock_get_url = mocker.patch('states.auto_pipeline_pipes.fmi.get_url', return_value=result)
+
+    with freeze_time('2018-11-25T12:05:00Z'):
+        assert receive_fmi_temperature() == (Decimal('-2.4'), arrow.get('2018-11-25T10:00:00Z'))
+        assert receive_fmi_dew_point() == (Decimal('-4.15'), arrow.get('2018-11-25T11:50:00Z'))
+
+    assert mock_get_url.call_count == 1
+    assert 'parameters=temperature,td' in mock_get_url.call_args[0][0]
+
+    request_cache.reset(persistent=True)
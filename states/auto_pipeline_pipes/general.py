@@ -1,20 +1,27 @@
 # coding=utf-8
 import json
-import time
 from decimal import Decimal
 from json import JSONDecodeError
-from typing import Optional, Dict
+from typing import Optional, Dict, Tuple
 
 from pony import orm
 
 import config
-from poller_helpers import Commands, send_ir_signal, write_log_to_sheet, SavedState, logger, decimal_round, \
-    get_now_isoformat, TempTs, post_url
+from poller_helpers import Commands, send_ir_signal, SavedState, IRSendLog, logger, decimal_round, \
+    get_now_isoformat, TempTs, ir_log_command
+from states import pipeline_context
 from states.controller import Controller
+from states.pipe_graph import pipe, Appender
+from sheet_worker import write_log_to_sheet
+from timeseries import CycleLog, CycleRecord
+from units import Unit
+from upload_queue import upload_queue
 
 
-def send_command(persistent_data, next_command, error: Optional[Decimal], extra_info, **kwargs):
-    now = time.time()
+@pipe(consumes=('unit', 'next_command', 'error', 'extra_info', 'last_command', 'heating_start_time'),
+      produces=('last_command', 'heating_start_time'), appends=('extra_info',), serial=True)
+def send_command(unit: Unit, persistent_data, next_command, error: Optional[Decimal], extra_info, **kwargs):
+    now = pipeline_context.now()
 
     heating_start_time = persistent_data.get('heating_start_time', now)
     last_command = persistent_data.get('last_command')
@@ -40,7 +47,7 @@ def send_command(persistent_data, next_command, error: Optional[Decimal], extra_
         )
     ):
         send_command_email = from_off_to_heating or from_heating_to_off
-        send_ir_signal(next_command, extra_info=extra_info, send_command_email=send_command_email)
+        send_ir_signal(next_command, extra_info=extra_info, send_command_email=send_command_email, remote=unit.remote)
         last_command = next_command
 
     extra_info.append('Actual last command: %s' % last_command)
@@ -49,69 +56,156 @@ def send_command(persistent_data, next_command, error: Optional[Decimal], extra_
     return {'extra_info': extra_info}, {'last_command': last_command, 'heating_start_time': heating_start_time}
 
 
-def write_log(next_command, extra_info, **kwargs):
-    write_log_to_sheet(next_command, extra_info)
+@pipe(consumes=('unit', 'next_command', 'extra_info'), serial=True)
+def write_log(unit: Unit, next_command, extra_info, **kwargs):
+    if unit.name:
+        extra_info = ['Unit: %s' % unit.name] + extra_info
+    write_log_to_sheet(next_command, extra_info, pipeline_context.current().sheet_worker)
 
 
-def get_controller(persistent_data, **kwargs):
-    if 'controller' in persistent_data:
-        controller = persistent_data['controller']
-    else:
-        controller = Controller(config.CONTROLLER_P, config.CONTROLLER_I, config.CONTROLLER_D)
+# Persistent data is saved as one versioned snapshot so that a restart doesn't reset the D term or the minimum
+# heating time or resend the last command. Version 0 is the old format with only the controller integral.
+SAVED_STATE_NAME = 'Auto.state'
+SAVED_STATE_VERSION = 1
+LEGACY_SAVED_STATE_NAME = 'Auto.controller'
+
+
+def state_snapshot(persistent_data: Dict) -> dict:
+    controller = persistent_data.get('controller')
+    last_command = persistent_data.get('last_command')
+    minimum_inside_temp = persistent_data.get('minimum_inside_temp')
+
+    return {
+        'version': SAVED_STATE_VERSION,
+        'controller': controller.state() if controller is not None else None,
+        'last_command': last_command.command_string if last_command is not None else None,
+        'heating_start_time': persistent_data.get('heating_start_time'),
+        'minimum_inside_temp': str(minimum_inside_temp) if minimum_inside_temp is not None else None,
+        'last_status_email_sent': persistent_data.get('last_status_email_sent'),
+    }
+
+
+def restore_snapshot(snapshot: dict, controller: Controller, last_ir_command: Optional[str]) -> dict:
+    version = snapshot.get('version', 0)
+    restored = {'controller': controller}
+
+    if version == 0:
+        controller.integral = Decimal(snapshot['integral'])
+        return restored
+
+    if version != SAVED_STATE_VERSION:
+        logger.warning('Ignoring saved state version %s', version)
+        return restored
+
+    if snapshot['controller'] is not None:
+        controller.restore(snapshot['controller'])
+
+    # The heat pump is still in the last command unless something else, e.g. manual mode, has sent IR since
+    if snapshot['last_command'] is not None and snapshot['last_command'] == last_ir_command:
+        restored['last_command'] = Commands.from_command_string(snapshot['last_command'])
+
+    if snapshot['heating_start_time'] is not None:
+        restored['heating_start_time'] = snapshot['heating_start_time']
+
+    if snapshot['minimum_inside_temp'] is not None:
+        restored['minimum_inside_temp'] = Decimal(snapshot['minimum_inside_temp'])
+
+    if snapshot['last_status_email_sent'] is not None:
+        restored['last_status_email_sent'] = snapshot['last_status_email_sent']
+
+    return restored
+
+
+def saved_state_name(unit: Unit) -> str:
+    if unit.name:
+        return '%s.%s' % (SAVED_STATE_NAME, unit.name)
+    return SAVED_STATE_NAME
+
+
+def load_snapshot(unit: Unit) -> Tuple[Optional[dict], Optional[str]]:
+    # Saved snapshot and the command of the last IR signal sent to the unit
+    with pipeline_context.current().db_session:
+        if unit.remote == config.IR_REMOTE:
+            ir_sends = orm.select(i for i in IRSendLog if ' ' not in i.command)
+        else:
+            prefix = ir_log_command(unit.remote, '')
+            ir_sends = orm.select(i for i in IRSendLog if i.command.startswith(prefix))
 
-    if controller.is_reset():
-        with orm.db_session:
+        last_ir_send = ir_sends.order_by(orm.desc(IRSendLog.id)).first()
+        last_ir_command = last_ir_send.command.split(' ')[-1] if last_ir_send else None
+
+        names = [saved_state_name(unit)] + ([] if unit.name else [LEGACY_SAVED_STATE_NAME])
+
+        for name in names:
             # noinspection PyTypeChecker
-            saved_state = orm.select(c for c in SavedState).where(name='Auto.controller').first()
+            saved_state = orm.select(c for c in SavedState).where(name=name).first()
             if saved_state:
-                as_dict = saved_state.to_dict()
                 try:
-                    as_dict['json'] = json.loads(as_dict['json'])
-                except JSONDecodeError:
-                    pass
-                else:
-                    controller.integral = Decimal(as_dict['json']['integral'])
+                    return json.loads(saved_state.json), last_ir_command
+                except JSONDecodeError as e:
+                    logger.exception(e)
 
-    return {}, {'controller': controller}
+    return None, last_ir_command
 
 
-def handle_payload(payload, persistent_data, **kwargs):
-    if payload:
+@pipe(consumes=('unit',),
+      produces=('controller', 'last_command', 'heating_start_time', 'minimum_inside_temp', 'last_status_email_sent'))
+def get_controller(unit: Unit, persistent_data, **kwargs):
+    if 'controller' in persistent_data:
+        return {}, {'controller': persistent_data['controller']}
+
+    controller = Controller(unit.controller_p, unit.controller_i, unit.controller_d,
+                            clock=pipeline_context.current().now)
+    snapshot, last_ir_command = load_snapshot(unit)
+
+    if snapshot is None:
+        return {}, {'controller': controller}
 
-        # Reset controller D term because otherwise after changing target the slope would be big
-        persistent_data['controller'].reset_past_errors()
+    restored = restore_snapshot(snapshot, controller, last_ir_command)
+    logger.info('Restored %s', sorted(restored))
+    return {}, restored
+
+
+@pipe(consumes=('unit', 'payload', 'controller', 'minimum_inside_temp'),
+      produces=('controller', 'minimum_inside_temp'))
+def handle_payload(unit: Unit, payload, persistent_data, **kwargs):
+    if payload:
 
         if payload.get('param') and payload.get('param').get('min_inside_temp') is not None:
             minimum_inside_temp = Decimal(payload.get('param').get('min_inside_temp'))
         else:
-            minimum_inside_temp = config.MINIMUM_INSIDE_TEMP
+            minimum_inside_temp = unit.minimum_inside_temp
+
+        # Reset controller D term because otherwise after changing target the slope would be big. After a restart
+        # the payload is the last message again and the target doesn't change.
+        if minimum_inside_temp != persistent_data.get('minimum_inside_temp'):
+            persistent_data['controller'].reset_past_errors()
 
         return {}, {'minimum_inside_temp': minimum_inside_temp}
 
     elif 'minimum_inside_temp' not in persistent_data:
-        minimum_inside_temp = config.MINIMUM_INSIDE_TEMP
+        minimum_inside_temp = unit.minimum_inside_temp
         return {}, {'minimum_inside_temp': minimum_inside_temp}
 
     else:
         return None
 
 
+@pipe(produces=('add_extra_info', 'extra_info'))
 def get_add_extra_info(**kwargs):
     extra_info = []
-
-    def add_extra_info(message):
-        logger.info(message)
-        extra_info.append(message)
-
-    return {'add_extra_info': add_extra_info, 'extra_info': extra_info}
+    return {'add_extra_info': Appender('extra_info', extra_info, logger.info), 'extra_info': extra_info}
 
 
+@pipe(consumes=('add_extra_info', 'target_inside_temp'), produces=('hysteresis',), appends=('extra_info',))
 def hysteresis(add_extra_info, target_inside_temp, **kwargs):
     hyst = Decimal('0.0')
     add_extra_info('Hysteresis: %s (%s)' % (decimal_round(hyst), decimal_round(target_inside_temp + hyst)))
     return {'hysteresis': hyst}
 
 
+@pipe(consumes=('add_extra_info', 'error', 'error_without_hysteresis', 'controller'),
+      produces=('controller_output', 'controller'), appends=('extra_info',))
 def update_controller(add_extra_info, error, error_without_hysteresis, persistent_data, **kwargs):
     controller = persistent_data.get('controller')
     degrees_per_hour_slope = Decimal('0.05')
@@ -129,22 +223,31 @@ def update_controller(add_extra_info, error, error_without_hysteresis, persisten
     return {'controller_output': controller_output}
 
 
-def save_controller_state(persistent_data, **kwargs):
-    controller = persistent_data.get('controller')
-    data = json.dumps({'integral': str(controller.integral)})
-    with orm.db_session:
+@pipe(consumes=('unit', 'controller', 'controller_output', 'last_command', 'heating_start_time',
+                'minimum_inside_temp', 'last_status_email_sent', 'saved_state'),
+      produces=('saved_state',), serial=True)
+def save_state(unit: Unit, persistent_data, **kwargs):
+    data = json.dumps(state_snapshot(persistent_data))
+
+    if data == persistent_data.get('saved_state'):
+        return None
+
+    with pipeline_context.current().db_session:
         # noinspection PyTypeChecker
-        saved_state = orm.select(c for c in SavedState).where(name='Auto.controller').first()
+        saved_state = orm.select(c for c in SavedState).where(name=saved_state_name(unit)).first()
         if saved_state:
             saved_state.set(json=data)
         else:
-            SavedState(name='Auto.controller', json=data)
+            SavedState(name=saved_state_name(unit), json=data)
 
+    return {}, {'saved_state': data}
 
-def send_to_lambda(target_inside_temp: Decimal, inside_temp: Optional[Decimal], outside_temp_ts: TempTs,
+
+@pipe(consumes=('unit', 'target_inside_temp', 'inside_temp', 'outside_temp_ts', 'last_command'), serial=True)
+def send_to_lambda(unit: Unit, target_inside_temp: Decimal, inside_temp: Optional[Decimal], outside_temp_ts: TempTs,
                    persistent_data: Dict, **kwargs):
     data = {
-        'sensorId': {'S': 'controller'},
+        'sensorId': {'S': 'controller-%s' % unit.name if unit.name else 'controller'},
         'ts': {'S': get_now_isoformat()},
         'temperatures': {
             'M': {
@@ -162,4 +265,33 @@ def send_to_lambda(target_inside_temp: Decimal, inside_temp: Optional[Decimal],
     if last_command is not None and last_command.temp is not None:
         data['temperatures']['M']['command'] = {'S': last_command.temp}
 
-    post_url(url=config.STORAGE_ROOT_URL + 'addOne', data=data)
+    # Queued to DB and uploaded in batches by a background worker so that a slow or failing storage doesn't
+    # block the cycle or lose data
+    upload_queue.put(data)
+
+
+@pipe(consumes=('unit', 'target_inside_temp', 'inside_temp', 'outside_temp_ts', 'error', 'controller_output',
+                'controller', 'last_command'), serial=True)
+def store_cycle(unit: Unit, target_inside_temp: Decimal, inside_temp: Optional[Decimal], outside_temp_ts: TempTs,
+                error: Optional[Decimal], controller_output: Decimal, persistent_data: Dict, **kwargs):
+    controller = persistent_data.get('controller')
+    last_command = persistent_data.get('last_command')
+    p_term, i_term, d_term = controller.terms or (None, None, None)
+
+    record = CycleRecord(
+        ts=pipeline_context.now(),
+        inside_temp=inside_temp,
+        outside_temp=outside_temp_ts.temp,
+        target_inside_temp=target_inside_temp,
+        error=error,
+        p_term=p_term,
+        i_term=i_term,
+        d_term=d_term,
+        controller_output=controller_output,
+        command_temp=last_command.temp if last_command is not None else None,
+    )
+
+    try:
+        CycleLog(unit.cycle_log_file).append(record)
+    except IOError as e:
+        logger.exception(e)
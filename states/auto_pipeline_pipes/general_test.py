@@ -1,11 +1,16 @@
+import json
 import time
 from datetime import timedelta
 from decimal import Decimal
 
 from freezegun import freeze_time
 
-from poller_helpers import Commands
-from states.auto_pipeline_pipes.general import send_command
+from poller_helpers import Commands, SavedState, IRSendLog, db_session
+from states.auto_pipeline_pipes.general import send_command, save_state, get_controller, handle_payload
+from states.controller import Controller
+from units import default_unit
+
+UNIT = default_unit()
 
 
 def test_send_command_on_start(mocker):
@@ -16,16 +21,16 @@ def test_send_command_on_start(mocker):
         persistent_data={},
         next_command=Commands.off,
         error=Decimal('0.1'),
-        extra_info=[])[1]['last_command'] == Commands.off
+        extra_info=[], unit=UNIT)[1]['last_command'] == Commands.off
 
-    mock_send.assert_called_with(Commands.off)
+    mock_send.assert_called_with(Commands.off, 'ilp')
     assert mock_email.call_count == 1
 
     assert send_command(
         persistent_data={},
         next_command=Commands.heat8,
         error=Decimal('0.1'),
-        extra_info=[])[1]['last_command'] == Commands.heat8
+        extra_info=[], unit=UNIT)[1]['last_command'] == Commands.heat8
 
     assert mock_send.call_count == 2
     assert mock_email.call_count == 2
@@ -39,7 +44,7 @@ def test_send_command_after_first(mocker):
         persistent_data={'last_command': Commands.off},
         next_command=Commands.off,
         error=Decimal('0.1'),
-        extra_info=[])[1]['last_command'] == Commands.off
+        extra_info=[], unit=UNIT)[1]['last_command'] == Commands.off
 
     assert mock_send.call_count == 0
     assert mock_email.call_count == 0
@@ -48,17 +53,17 @@ def test_send_command_after_first(mocker):
         persistent_data={'last_command': Commands.off},
         next_command=Commands.heat8,
         error=Decimal('0.1'),
-        extra_info=[])[1]['last_command'] == Commands.heat8
+        extra_info=[], unit=UNIT)[1]['last_command'] == Commands.heat8
 
     assert mock_send.call_count == 1
-    mock_send.assert_called_with(Commands.heat8)
+    mock_send.assert_called_with(Commands.heat8, 'ilp')
     assert mock_email.call_count == 1
 
     assert send_command(
         persistent_data={'last_command': Commands.heat8},
         next_command=Commands.off,
         error=Decimal('0.1'),
-        extra_info=[])[1]['last_command'] == Commands.heat8
+        extra_info=[], unit=UNIT)[1]['last_command'] == Commands.heat8
 
     assert mock_send.call_count == 1
     assert mock_email.call_count == 1
@@ -67,17 +72,17 @@ def test_send_command_after_first(mocker):
         persistent_data={'last_command': Commands.heat8},
         next_command=Commands.heat10,
         error=Decimal(0),
-        extra_info=[])[1]['last_command'] == Commands.heat10
+        extra_info=[], unit=UNIT)[1]['last_command'] == Commands.heat10
 
     assert mock_send.call_count == 2
-    mock_send.assert_called_with(Commands.heat10)
+    mock_send.assert_called_with(Commands.heat10, 'ilp')
     assert mock_email.call_count == 1
 
     assert send_command(
         persistent_data={'last_command': Commands.heat10},
         next_command=Commands.heat10,
         error=Decimal(0),
-        extra_info=[])[1]['last_command'] == Commands.heat10
+        extra_info=[], unit=UNIT)[1]['last_command'] == Commands.heat10
 
     assert mock_send.call_count == 2
     assert mock_email.call_count == 1
@@ -89,10 +94,10 @@ def test_send_command_after_first(mocker):
             persistent_data={'last_command': Commands.heat8, 'heating_start_time': heating_start_time},
             next_command=Commands.off,
             error=Decimal('-0.1'),
-            extra_info=[])[1]['last_command'] == Commands.off
+            extra_info=[], unit=UNIT)[1]['last_command'] == Commands.off
 
     assert mock_send.call_count == 3
-    mock_send.assert_called_with(Commands.off)
+    mock_send.assert_called_with(Commands.off, 'ilp')
     assert mock_email.call_count == 2
 
 
@@ -106,11 +111,11 @@ def test_send_command_min_time_heating(mocker):
         persistent_data=persistent_data,
         next_command=Commands.heat22,
         error=Decimal('0.1'),
-        extra_info=[])
+        extra_info=[], unit=UNIT)
 
     assert new_persistent_data['last_command'] == Commands.heat22
     assert mock_send.call_count == 1
-    mock_send.assert_called_with(Commands.heat22)
+    mock_send.assert_called_with(Commands.heat22, 'ilp')
     assert mock_email.call_count == 1
 
     persistent_data.update(new_persistent_data)
@@ -119,7 +124,7 @@ def test_send_command_min_time_heating(mocker):
         persistent_data=persistent_data,
         next_command=Commands.off,
         error=Decimal('-0.1'),
-        extra_info=[])
+        extra_info=[], unit=UNIT)
 
     assert new_persistent_data['last_command'] == Commands.heat22
     assert mock_send.call_count == 1
@@ -132,11 +137,11 @@ def test_send_command_min_time_heating(mocker):
             persistent_data=persistent_data,
             next_command=Commands.off,
             error=Decimal('-0.1'),
-            extra_info=[])
+            extra_info=[], unit=UNIT)
 
     assert new_persistent_data['last_command'] == Commands.off
     assert mock_send.call_count == 2
-    mock_send.assert_called_with(Commands.off)
+    mock_send.assert_called_with(Commands.off, 'ilp')
     assert mock_email.call_count == 2
 
 
@@ -148,9 +153,106 @@ def test_send_command_error_none(mocker):
         persistent_data={'last_command': Commands.off},
         next_command=Commands.heat22,
         error=None,
-        extra_info=[])
+        extra_info=[], unit=UNIT)
 
     assert new_persistent_data['last_command'] == Commands.heat22
     assert mock_send.call_count == 1
-    mock_send.assert_called_with(Commands.heat22)
+    mock_send.assert_called_with(Commands.heat22, 'ilp')
     assert mock_email.call_count == 1
+
+
+def clear_saved_state():
+    with db_session:
+        SavedState.select().delete(bulk=True)
+        IRSendLog.select().delete(bulk=True)
+
+
+def heating_state() -> dict:
+    controller = Controller(Decimal(2), Decimal(2), Decimal(25))
+    for error in ('1.5', '1'):
+        controller.update(Decimal(error), Decimal(error))
+    controller.integral = Decimal('0.4')
+
+    return {
+        'controller': controller,
+        'last_command': Commands.heat20,
+        'heating_start_time': time.time() - 600,
+        'minimum_inside_temp': Decimal(7),
+        'last_status_email_sent': 'ok',
+    }
+
+
+def test_restart_restores_state(mocker):
+    mock_send = mocker.patch('states.auto_pipeline_pipes.general.send_ir_signal')
+    clear_saved_state()
+    persistent_data = heating_state()
+    with db_session:
+        IRSendLog(command=str(Commands.heat20))
+
+    _, new_persistent_data = save_state(unit=UNIT, persistent_data=persistent_data)
+    persistent_data.update(new_persistent_data)
+
+    # Nothing is written when nothing changed
+    assert save_state(unit=UNIT, persistent_data=persistent_data) is None
+
+    _, restored = get_controller(unit=UNIT, persistent_data={})
+
+    assert restored['last_command'] is Commands.heat20
+    assert restored['heating_start_time'] == persistent_data['heating_start_time']
+    assert restored['minimum_inside_temp'] == Decimal(7)
+    assert restored['last_status_email_sent'] == 'ok'
+    assert restored['controller'].integral == Decimal('0.4')
+    assert list(restored['controller'].past_errors) == list(persistent_data['controller'].past_errors)
+
+    # The same payload read again from DB after the restart keeps the D term
+    handle_payload(unit=UNIT, payload={'command': 'auto', 'param': {'min_inside_temp': 7}}, persistent_data=restored)
+    assert len(restored['controller'].past_errors) == 2
+
+    # Turning off within the minimum heating time and sending the same command again are not done
+    send_command(persistent_data=restored, next_command=Commands.off, error=Decimal('-0.1'), extra_info=[], unit=UNIT)
+    send_command(persistent_data=restored, next_command=Commands.heat20, error=Decimal('0.1'), extra_info=[], unit=UNIT)
+    assert mock_send.call_count == 0
+
+
+def test_restart_after_other_ir_send_resends_command():
+    clear_saved_state()
+    save_state(unit=UNIT, persistent_data=heating_state())
+    with db_session:
+        IRSendLog(command=str(Commands.off))
+
+    _, restored = get_controller(unit=UNIT, persistent_data={})
+
+    assert 'last_command' not in restored
+    assert restored['controller'].integral == Decimal('0.4')
+
+
+def test_restore_legacy_saved_state():
+    clear_saved_state()
+    with db_session:
+        SavedState(name='Auto.controller', json=json.dumps({'integral': '0.3'}))
+
+    _, restored = get_controller(unit=UNIT, persistent_data={})
+
+    assert list(restored) == ['controller']
+    assert restored['controller'].integral == Decimal('0.3')
+    assert restored['controller'].is_reset()
+
+
+def test_units_restore_their_own_state(mocker):
+    mock_popen = mocker.patch('poller_helpers.Popen')
+    mock_popen.return_value.communicate.return_value = ('', '')
+    mock_popen.return_value.returncode = 0
+    mocker.patch('poller_helpers.email')
+    clear_saved_state()
+    garage = UNIT._replace(name='garage', remote='garage')
+
+    send_command(unit=UNIT, persistent_data={}, next_command=Commands.heat20, error=None, extra_info=[])
+    send_command(unit=garage, persistent_data={}, next_command=Commands.heat8, error=None, extra_info=[])
+
+    house_state = heating_state()
+    garage_state = dict(heating_state(), last_command=Commands.heat8)
+    save_state(unit=UNIT, persistent_data=house_state)
+    save_state(unit=garage, persistent_data=garage_state)
+
+    assert get_controller(unit=UNIT, persistent_data={})[1]['last_command'] is Commands.heat20
+    assert get_controller(unit=garage, persistent_data={})[1]['last_command'] is Commands.heat8
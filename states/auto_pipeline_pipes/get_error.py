@@ -1,6 +1,8 @@
 from decimal import Decimal
 from typing import Optional
 
+from states.pipe_graph import pipe
+
 
 def calc_error(target_inside_temp: Decimal, inside_temp: Optional[Decimal], hyst: Decimal) -> Optional[Decimal]:
     if inside_temp is not None:
@@ -12,6 +14,7 @@ def calc_error(target_inside_temp: Decimal, inside_temp: Optional[Decimal], hyst
     return error
 
 
+@pipe(consumes=('target_inside_temp', 'inside_temp', 'hysteresis'), produces=('error', 'error_without_hysteresis'))
 def get_error(target_inside_temp, inside_temp, hysteresis, **kwargs):
     error = calc_error(target_inside_temp, inside_temp, hysteresis)
     error_without_hysteresis = calc_error(target_inside_temp, inside_temp, Decimal(0))
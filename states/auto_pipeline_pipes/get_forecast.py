@@ -1,18 +1,21 @@
 from decimal import Decimal
-from statistics import mean
 from typing import Union, Optional, Tuple, List
 
 import arrow
-import xmltodict
 
 import config
-from poller_helpers import Forecast, TempTs, decimal_round, timing, get_url, logger
+from poller_helpers import Forecast, TempTs, decimal_round, timing, get_url, logger, epoch_to_arrow
+from states import pipeline_context
+from states.auto_pipeline_pipes.fmi import iter_wfs_temps, WFS_PARSE_ERRORS
 from states.auto_pipeline_pipes.helpers import get_temp, caching, forecast_mean_temperature
+from states.pipe_graph import pipe
 
 
 @timing
 @caching(cache_name='yr.no')
 def receive_yr_no_forecast() -> Tuple[Optional[List[TempTs]], Optional[arrow.Arrow]]:
+    import xmltodict  # Only needed when yr.no is used
+
     temp, ts = None, None
 
     try:
@@ -39,17 +42,22 @@ def receive_yr_no_forecast() -> Tuple[Optional[List[TempTs]], Optional[arrow.Arr
             else:
                 if result.status_code != 200:
                     logger.error('%d: %s' % (result.status_code, result.content))
-                else:
+                elif temp:
                     d = xmltodict.parse(result.content)
                     timezone = d['weatherdata']['location']['timezone']['@id']
 
+                    tzinfo = temp[-1].ts.tzinfo
+                    last_epoch = temp[-1].ts.timestamp
+
                     for t in d['weatherdata']['forecast']['tabular']['time']:
-                        current_forecast_end_ts = arrow.get(t['@to']).replace(tzinfo=timezone)
-                        while current_forecast_end_ts > temp[-1].ts:
-                            temp.append(TempTs(Decimal(t['temperature']['@value']), temp[-1].ts.shift(hours=1)))
+                        current_forecast_end = arrow.get(t['@to']).replace(tzinfo=timezone).timestamp
+                        while current_forecast_end > last_epoch:
+                            last_epoch += 3600
+                            temp.append(TempTs(Decimal(t['temperature']['@value']),
+                                               arrow.Arrow.fromtimestamp(last_epoch, tzinfo)))
 
-            ts = arrow.now()
-            log_forecast('receive_yr_no_forecast', temp)
+            ts = epoch_to_arrow(pipeline_context.now())
+            log_forecast('receive_yr_no_forecast', Forecast(temp, ts))
 
     return temp, ts
 
@@ -60,7 +68,7 @@ def receive_fmi_forecast() -> Tuple[Optional[List[TempTs]], Optional[arrow.Arrow
     temp, ts = None, None
 
     try:
-        endtime = arrow.now().shift(hours=63).to('UTC').format('YYYY-MM-DDTHH:mm:ss') + 'Z'
+        endtime = arrow.get(pipeline_context.now() + 63 * 3600).format('YYYY-MM-DDTHH:mm:ss') + 'Z'
         result = get_url(
             'https://opendata.fmi.fi/wfs?request=getFeature&'
             'storedquery_id=fmi::forecast::harmonie::surface::point::simple&'
@@ -73,48 +81,41 @@ def receive_fmi_forecast() -> Tuple[Optional[List[TempTs]], Optional[arrow.Arrow
             logger.error('%d: %s' % (result.status_code, result.content))
         else:
             try:
-                wfs_member = xmltodict.parse(result.content).get('wfs:FeatureCollection', {}).get('wfs:member')
-
-                temp = [
-                    TempTs(
-                        Decimal(t['BsWfs:BsWfsElement']['BsWfs:ParameterValue']),
-                        arrow.get(t['BsWfs:BsWfsElement']['BsWfs:Time']).to(config.TIMEZONE)
-                    )
-                    for t
-                    in wfs_member
-                    if t['BsWfs:BsWfsElement']['BsWfs:ParameterValue'] != 'NaN'
-                ]
-
-                ts = arrow.now()
-                log_forecast('receive_fmi_forecast', temp)
-
-            except (KeyError, TypeError):
+                temp = list(iter_wfs_temps(result.content))
+
+                ts = epoch_to_arrow(pipeline_context.now())
+                log_forecast('receive_fmi_forecast', Forecast(temp, ts))
+
+            except WFS_PARSE_ERRORS as e:
+                logger.exception(e)
                 temp, ts = None, None
 
     return temp, ts
 
 
-def log_forecast(name, temp) -> None:
-    temps = [t.temp for t in temp]
-    if temps:
-        forecast_hours = (temp[-1].ts - temp[0].ts).total_seconds() / 3600.0
+def log_forecast(name, forecast: Forecast) -> None:
+    if len(forecast):
+        forecast_hours = (forecast.epochs[-1] - forecast.epochs[0]) / 3600.0
         logger.info('Forecast %s between %s %s (%s h) %s (mean %s) (mean 48h %s)',
-                    name, temp[0].ts, temp[-1].ts, forecast_hours, ' '.join(map(str, temps)), decimal_round(mean(temps)),
-                    decimal_round(mean(temps[:48])))
+                    name, forecast[0].ts, forecast[-1].ts, forecast_hours, ' '.join(map(str, forecast.values)),
+                    decimal_round(forecast.mean()), decimal_round(forecast.mean(0, 48)))
     else:
-        logger.info('No forecast from %s')
+        logger.info('No forecast from %s', name)
 
 
 def make_forecast(temps, ts, valid_time):
-    now = arrow.now()
-    return Forecast(temps=[TempTs(temp, ts) for temp, ts in temps if not valid_time or ts > now], ts=ts)
+    forecast = Forecast(temps, ts)
+    if valid_time:
+        return forecast.after(pipeline_context.now())
+    return forecast
 
 
+@pipe(consumes=('add_extra_info', 'have_valid_time'), produces=('forecast', 'mean_forecast'), appends=('extra_info',))
 def get_forecast(add_extra_info, have_valid_time, **kwargs):
-    f_temps, f_ts = get_temp([receive_fmi_forecast, receive_yr_no_forecast], max_ts_diff=48 * 60)
+    f_temps, f_ts = get_temp([receive_fmi_forecast, receive_yr_no_forecast], max_ts_diff=48 * 60, concurrent=True)
     if f_temps and f_ts:
         forecast = make_forecast(f_temps, f_ts, have_valid_time)
-        log_forecast('get_forecast', forecast.temps)
+        log_forecast('get_forecast', forecast)
     else:
         forecast = None
         logger.debug('Forecast %s', forecast)
@@ -1,10 +1,14 @@
-import config
 from poller_helpers import get_from_smartthings
 from states.auto_pipeline_pipes.helpers import get_temp
+from states.pipe_graph import pipe
+from units import Unit
 
 
-def get_inside(add_extra_info, **kwargs):
-    for device_id in config.SMARTTHINGS_INSIDE_DEVICE_IDS:
+@pipe(consumes=('unit', 'add_extra_info'), produces=('inside_temp',), appends=('extra_info',))
+def get_inside(unit: Unit, add_extra_info, **kwargs):
+    inside_temp = None
+
+    for device_id in unit.inside_device_ids:
         inside_temp = get_temp([get_from_smartthings], max_ts_diff=120, device_id=device_id)[0]
         if inside_temp:
             break
@@ -1,11 +1,13 @@
 from decimal import Decimal
 from typing import Optional
 
-import arrow
-
-from poller_helpers import Commands, TempTs, Command
+from poller_helpers import Commands, TempTs, Command, epoch_to_arrow
+from states import pipeline_context
+from states.pipe_graph import pipe
 
 
+@pipe(consumes=('have_valid_time', 'inside_temp', 'outside_temp_ts', 'valid_outside', 'target_inside_temp',
+                'controller_output'), produces=('next_command',))
 def get_next_command(have_valid_time: bool,
                      inside_temp: Optional[Decimal],
                      outside_temp_ts: TempTs,
@@ -17,7 +19,7 @@ def get_next_command(have_valid_time: bool,
     if inside_temp is not None:
         next_command = Commands.command_from_controller(controller_output, inside_temp, valid_outside and outside_temp_ts.temp)
     else:
-        is_summer = have_valid_time and 5 <= arrow.now().month <= 9
+        is_summer = have_valid_time and 5 <= epoch_to_arrow(pipeline_context.now()).month <= 9
 
         if valid_outside and outside_temp_ts.temp < target_inside_temp:
             next_command = command_without_inside_temp(outside_temp_ts.temp, target_inside_temp)
@@ -2,11 +2,13 @@ from decimal import Decimal
 from typing import Tuple, Optional
 
 import arrow
-import xmltodict
 
 import config
-from poller_helpers import TempTs, decimal_round, get_url, timing, logger, get_from_lambda_url
+from poller_helpers import TempTs, decimal_round, get_url, timing, logger, get_from_lambda_url, epoch_to_arrow
+from states import pipeline_context
+from states.auto_pipeline_pipes.fmi import fmi_observations
 from states.auto_pipeline_pipes.helpers import get_temp, caching
+from states.pipe_graph import pipe
 
 
 PREDEFINED_OUTSIDE_TEMP = Decimal(-10)
@@ -18,32 +20,13 @@ def receive_ulkoilma_temperature() -> Tuple[Optional[Decimal], Optional[arrow.Ar
 
 
 @timing
-@caching(cache_name='fmi')
 def receive_fmi_temperature() -> Tuple[Optional[Decimal], Optional[arrow.Arrow]]:
-    temp, ts = None, None
+    temps = fmi_observations('temperature')
 
-    try:
-        starttime = arrow.now().shift(hours=-1).to('UTC').format('YYYY-MM-DDTHH:mm:ss') + 'Z'
-        result = get_url(
-            'https://opendata.fmi.fi/wfs?request=getFeature&storedquery_id=fmi::observations::weather'
-            '::simple&place={place}&parameters=temperature&starttime={starttime}'.format(
-                place=config.FMI_LOCATION, starttime=starttime))
-    except Exception as e:
-        logger.exception(e)
+    if temps:
+        temp, ts = temps[-1]
     else:
-        if result.status_code != 200:
-            logger.error('%d: %s' % (result.status_code, result.content))
-        else:
-            try:
-                wfs_member = xmltodict.parse(result.content).get('wfs:FeatureCollection', {}).get('wfs:member')
-                temp_data = wfs_member[-1].get('BsWfs:BsWfsElement')
-                if temp_data and 'BsWfs:Time' in temp_data and 'BsWfs:ParameterValue' in temp_data:
-                    ts = arrow.get(temp_data['BsWfs:Time']).to(config.TIMEZONE)
-                    temp = Decimal(temp_data['BsWfs:ParameterValue'])
-                    if not temp.is_finite():
-                        raise TypeError()
-            except (KeyError, TypeError):
-                temp, ts = None, None
+        temp, ts = None, None
 
     logger.info('temp:%s ts:%s', temp, ts)
     return temp, ts
@@ -72,13 +55,22 @@ def receive_open_weather_map_temperature() -> Tuple[Optional[Decimal], Optional[
     return temp, ts
 
 
-def get_outside(add_extra_info, mean_forecast, **kwargs):
-    outside_temp, outside_ts = get_temp([
-        receive_ulkoilma_temperature, receive_fmi_temperature, receive_open_weather_map_temperature])
+@pipe(produces=('outside_measurement',))
+def get_outside_measurement(**kwargs):
+    outside_temp_ts = get_temp([
+        receive_ulkoilma_temperature, receive_fmi_temperature, receive_open_weather_map_temperature], concurrent=True)
+    return {'outside_measurement': outside_temp_ts}
+
+
+@pipe(consumes=('add_extra_info', 'mean_forecast', 'outside_measurement'),
+      produces=('outside_temp_ts', 'valid_outside'), appends=('extra_info',))
+def get_outside(add_extra_info, mean_forecast, outside_measurement, **kwargs):
+    # Falls back to the forecast when there is no measurement
+    outside_temp, outside_ts = outside_measurement
     add_extra_info('Outside temperature: %s' % outside_temp)
     if outside_temp is None:
         valid_outside = False
-        outside_ts = arrow.now()
+        outside_ts = epoch_to_arrow(pipeline_context.now())
         if mean_forecast is not None:
             outside_temp = mean_forecast
             add_extra_info('Using mean forecast as outside temp: %s' % decimal_round(mean_forecast))
@@ -1,12 +1,15 @@
+from array import array
 from decimal import Decimal
 from statistics import mean
-from typing import Union
+from typing import Union, List, Tuple
 
 import arrow
 
 import config
-from poller_helpers import decimal_round, Forecast, TempTs, logger
+from poller_helpers import decimal_round, Forecast, TempTs, logger, epoch_to_arrow
+from states import pipeline_context
 from states.auto_pipeline_pipes.helpers import forecast_mean_temperature
+from states.pipe_graph import pipe
 
 
 def cooling_time_buffer_resolved(cooling_time_buffer, outside_temp, forecast: Union[Forecast, None]) -> Decimal:
@@ -25,6 +28,8 @@ def cooling_time_buffer_resolved(cooling_time_buffer, outside_temp, forecast: Un
         return buffer
 
 
+@pipe(consumes=('add_extra_info', 'mean_forecast', 'outside_temp_ts', 'forecast', 'minimum_inside_temp'),
+      produces=('target_inside_temp',), appends=('extra_info',))
 def target_inside_temp(add_extra_info,
                        mean_forecast,
                        outside_temp_ts: TempTs,
@@ -35,9 +40,10 @@ def target_inside_temp(add_extra_info,
     minimum_inside_temp = persistent_data.get('minimum_inside_temp')
     allowed_min_inside_temp = config.ALLOWED_MINIMUM_INSIDE_TEMP
     cooling_time_buffer = config.COOLING_TIME_BUFFER
+    now = pipeline_context.now()
 
     if mean_forecast:
-        outside_for_target_calc = TempTs(mean_forecast, arrow.now())
+        outside_for_target_calc = TempTs(mean_forecast, epoch_to_arrow(now))
     else:
         outside_for_target_calc = outside_temp_ts
 
@@ -51,33 +57,36 @@ def target_inside_temp(add_extra_info,
     add_extra_info('Buffer is %s h at %s C' % (
         decimal_round(cooling_time_buffer_hours), decimal_round(outside_for_target_calc.temp)))
 
-    valid_forecast = []
+    if forecast:
+        forecast = forecast.after(outside_for_target_calc.ts.float_timestamp)
+
+    if config.TARGET_INSIDE_TEMP_FLOAT:
+        epochs, temps = forecast_arrays([outside_for_target_calc])
+        if forecast:
+            epochs.extend(forecast.epochs)
+            temps.extend(float(temp) for temp in forecast.values)
+        end_epoch = now + float(cooling_time_buffer_hours) * 3600.0
+        iteration_inside_temp = decimal_round(Decimal(inside_temp_at_start_float(
+            epochs, temps, end_epoch, float(allowed_min_inside_temp),
+            float(config.COOLING_RATE_PER_HOUR_PER_TEMPERATURE_DIFF))), 6)
+    else:
+        valid_forecast = [outside_for_target_calc] + (forecast.temps if forecast else [])
+        iteration_inside_temp = inside_temp_at_start(
+            valid_forecast, epoch_to_arrow(now + float(cooling_time_buffer_hours) * 3600.0), allowed_min_inside_temp)
 
-    if outside_for_target_calc:
-        valid_forecast.append(outside_for_target_calc)
+    return {'target_inside_temp': max(iteration_inside_temp, minimum_inside_temp)}
 
-    if forecast and forecast.temps:
-        for f in forecast.temps:
-            if f.ts > valid_forecast[-1].ts:
-                valid_forecast.append(f)
 
-    # if valid_forecast:
-    #     outside_after_forecast = mean(t.temp for t in valid_forecast)
-    #     while len(valid_forecast) < config.COOLING_TIME_BUFFER:
-    #         valid_forecast.append(TempTs(temp=outside_after_forecast, ts=valid_forecast[-1].ts.shift(hours=1)))
+def inside_temp_at_start(valid_forecast: List[TempTs], iteration_ts: arrow.Arrow,
+                         allowed_min_inside_temp: Decimal) -> Decimal:
+    # Walks backwards from the end of the cooling time buffer (when inside is allowed to be at minimum) to the
+    # start of the forecast and returns the inside temperature needed at the start.
 
     reversed_forecast = list(reversed(valid_forecast))
 
-    # pprint(reversed_forecast)
-    # pprint(reversed_forecast[-1].ts)
-
     iteration_inside_temp = allowed_min_inside_temp
-    iteration_ts = arrow.now().shift(hours=float(cooling_time_buffer_hours))
-    # print('iteration_ts', iteration_ts)
 
-    # if reversed_forecast[0].ts < iteration_ts:
     outside_after_forecast = mean(t.temp for t in reversed_forecast)
-    # print('outside_after_forecast', outside_after_forecast)
     while iteration_ts > reversed_forecast[0].ts:
         hours_to_forecast_start = Decimal((iteration_ts - reversed_forecast[0].ts).total_seconds() / 3600.0)
         assert hours_to_forecast_start >= 0, hours_to_forecast_start
@@ -93,30 +102,14 @@ def target_inside_temp(add_extra_info,
         iteration_inside_temp -= temp_drop
         iteration_ts = iteration_ts.shift(hours=float(-this_iteration_hours))
 
-        # from pprint import pprint
-        # pprint({
-        #     'iteration_ts': iteration_ts,
-        #     'temp_drop': temp_drop,
-        #     'iteration_inside_temp': iteration_inside_temp,
-        #     'this_iteration_hours': this_iteration_hours,
-        # })
-        # print('-' * 50)
-
         if iteration_inside_temp < allowed_min_inside_temp:
             iteration_inside_temp = allowed_min_inside_temp
-            # print('*' * 20)
-
-    # print('-' * 10, 'start forecast', iteration_ts, iteration_inside_temp)
 
     for fc in filter(lambda x: x.ts <= iteration_ts, reversed_forecast):
         this_iteration_hours = Decimal((iteration_ts - fc.ts).total_seconds() / 3600.0)
         assert this_iteration_hours >= 0, this_iteration_hours
         outside_inside_diff = fc.temp - iteration_inside_temp
         temp_drop = config.COOLING_RATE_PER_HOUR_PER_TEMPERATURE_DIFF * outside_inside_diff * this_iteration_hours
-        # if iteration_inside_temp - temp_drop > allowed_min_inside_temp:
-        #     iteration_inside_temp -= temp_drop
-        # else:
-        #     break
 
         if fc.temp <= -17:
             # When outside temp is about -17 or colder, then the pump heating power will decrease a lot
@@ -126,20 +119,55 @@ def target_inside_temp(add_extra_info,
         iteration_inside_temp -= temp_drop
         iteration_ts = fc.ts
 
-        # from pprint import pprint
-        # pprint({
-        #     'fc': fc,
-        #     'temp_drop': temp_drop,
-        #     'iteration_inside_temp': iteration_inside_temp,
-        #     'this_iteration_hours': this_iteration_hours,
-        # })
-        # print('-' * 50)
+        if iteration_inside_temp < allowed_min_inside_temp:
+            iteration_inside_temp = allowed_min_inside_temp
+
+    return iteration_inside_temp
+
+
+def forecast_arrays(valid_forecast: List[TempTs]) -> Tuple[array, array]:
+    epochs = array('d', (t.ts.float_timestamp for t in valid_forecast))
+    temps = array('d', (float(t.temp) for t in valid_forecast))
+    return epochs, temps
+
+
+def inside_temp_at_start_float(epochs: array, temps: array, end_epoch: float, allowed_min_inside_temp: float,
+                               cooling_rate: float) -> float:
+    # Same as inside_temp_at_start but with floats and epoch seconds. Result differs from the Decimal version
+    # by less than 1e-6 degrees.
+
+    n = len(temps)
+    last_epoch = epochs[n - 1]
+    outside_after_forecast = sum(temps) / n
+
+    if outside_after_forecast <= -17:
+        rate_after_forecast = cooling_rate * 2
+    else:
+        rate_after_forecast = cooling_rate
+
+    iteration_inside_temp = allowed_min_inside_temp
+    iteration_epoch = end_epoch
+
+    while iteration_epoch > last_epoch:
+        this_iteration_hours = min(1.0, (iteration_epoch - last_epoch) / 3600.0)
+        iteration_inside_temp -= rate_after_forecast * (outside_after_forecast - iteration_inside_temp) * \
+            this_iteration_hours
+        iteration_epoch -= this_iteration_hours * 3600.0
 
         if iteration_inside_temp < allowed_min_inside_temp:
             iteration_inside_temp = allowed_min_inside_temp
-            # print('!' * 20)
-            # assert False, iteration_inside_temp
 
-    # print('iteration_ts', iteration_ts)
-    # print('target_inside_temperature', iteration_inside_temp)
-    return {'target_inside_temp': max(iteration_inside_temp, minimum_inside_temp)}
+    for i in range(n - 1, -1, -1):
+        epoch = epochs[i]
+        if epoch > iteration_epoch:
+            continue
+
+        temp = temps[i]
+        rate = cooling_rate * 2 if temp <= -17 else cooling_rate
+        iteration_inside_temp -= rate * (temp - iteration_inside_temp) * (iteration_epoch - epoch) / 3600.0
+        iteration_epoch = epoch
+
+        if iteration_inside_temp < allowed_min_inside_temp:
+            iteration_inside_temp = allowed_min_inside_temp
+
+    return iteration_inside_temp
@@ -0,0 +1,36 @@
+from decimal import Decimal
+
+import arrow
+import pytest
+
+import config
+from poller_helpers import TempTs
+from states.auto_pipeline_pipes.get_target_inside_temperature import inside_temp_at_start, forecast_arrays, \
+    inside_temp_at_start_float
+
+
+def make_forecast(temps, start=None):
+    if start is None:
+        start = arrow.get('2018-11-25T12:00:00+02:00')
+    return [TempTs(Decimal(t), start.shift(hours=i)) for i, t in enumerate(temps)]
+
+
+@pytest.mark.parametrize('temps, buffer_hours', [
+    (['-5', '-6', '-7.5', '-8', '-6', '-3'], 38),
+    ([str(-10 - i * 0.25) for i in range(48)], 20),
+    ([str(-18 - i * 0.1) for i in range(30)], 10),
+    (['-20'] * 10 + ['-15'] * 10, 60),
+    (['5', '6', '7'], 5),
+])
+def test_inside_temp_at_start_float_equals_decimal(temps, buffer_hours):
+    valid_forecast = make_forecast(temps)
+    end_ts = valid_forecast[0].ts.shift(hours=buffer_hours)
+
+    decimal_result = inside_temp_at_start(valid_forecast, end_ts, config.ALLOWED_MINIMUM_INSIDE_TEMP)
+
+    epochs, float_temps = forecast_arrays(valid_forecast)
+    float_result = inside_temp_at_start_float(
+        epochs, float_temps, end_ts.float_timestamp, float(config.ALLOWED_MINIMUM_INSIDE_TEMP),
+        float(config.COOLING_RATE_PER_HOUR_PER_TEMPERATURE_DIFF))
+
+    assert abs(float(decimal_result) - float_result) < 1e-6
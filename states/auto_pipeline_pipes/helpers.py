@@ -1,12 +1,16 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 from decimal import Decimal
 from functools import wraps
-from statistics import mean
 from typing import Dict, Tuple, Any, Optional, Union
 
 import arrow
 
 import config
-from poller_helpers import median, logger, Forecast
+import metrics
+from poller_helpers import median, logger, Forecast, TempTs, CachedRequest, db_session
+from states import pipeline_context
 
 
 def func_name(func):
@@ -16,24 +20,59 @@ def func_name(func):
         return func._mock_name
 
 
-def get_temp(functions: list, max_ts_diff=None, **kwargs):
+_fetch_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='fetch')
+
+
+def _call_functions(functions: list, **kwargs) -> list:
+    return [func(**kwargs) for func in functions]
+
+
+def _call_functions_concurrently(functions: list, deadline, **kwargs) -> list:
+    futures = [_fetch_executor.submit(pipeline_context.bind(metrics.bind(func)), **kwargs) for func in functions]
+    done, not_done = wait(futures, timeout=deadline)
+
+    results = []
+
+    for func, future in zip(functions, futures):
+        if future in not_done:
+            # The call keeps running in the background and will fill the cache for the next cycle
+            logger.warning('Deadline of %s secs exceeded for %s', deadline, func_name(func))
+            results.append(None)
+        else:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logger.exception(e)
+                results.append(None)
+
+    return results
+
+
+def get_temp(functions: list, max_ts_diff=None, concurrent=False, deadline=None, **kwargs):
 
     MAX_TS_DIFF_MINUTES = 60
 
     if max_ts_diff is None:
         max_ts_diff = MAX_TS_DIFF_MINUTES
 
+    if concurrent:
+        if deadline is None:
+            deadline = config.FETCH_DEADLINE_SECONDS
+        results = _call_functions_concurrently(functions, deadline, **kwargs)
+    else:
+        results = _call_functions(functions, **kwargs)
+
     temperatures = []
+    now = pipeline_context.now()
 
-    for func in functions:
-        result = func(**kwargs)
+    for func, result in zip(functions, results):
         if result:
             temp, ts = result
             if temp is not None:
                 if ts is None:
                     temperatures.append((temp, ts))
                 else:
-                    seconds = (arrow.now() - ts).total_seconds()
+                    seconds = now - ts.timestamp
                     if abs(seconds) < 60 * max_ts_diff:
                         temperatures.append((temp, ts))
                     else:
@@ -42,67 +81,222 @@ def get_temp(functions: list, max_ts_diff=None, **kwargs):
     return median(temperatures)
 
 
+def _encode_cache_content(obj):
+    if isinstance(obj, Decimal):
+        return {'__decimal__': str(obj)}
+    elif isinstance(obj, arrow.Arrow):
+        return {'__arrow__': obj.isoformat()}
+    elif isinstance(obj, TempTs):
+        return {'__tempts__': [_encode_cache_content(obj.temp), _encode_cache_content(obj.ts)]}
+    elif isinstance(obj, tuple):
+        return {'__tuple__': [_encode_cache_content(o) for o in obj]}
+    elif isinstance(obj, list):
+        return [_encode_cache_content(o) for o in obj]
+    elif isinstance(obj, dict):
+        return {'__dict__': [[k, _encode_cache_content(v)] for k, v in obj.items()]}
+    else:
+        return obj
+
+
+def _decode_cache_content(obj):
+    if isinstance(obj, dict):
+        if '__decimal__' in obj:
+            return Decimal(obj['__decimal__'])
+        elif '__arrow__' in obj:
+            return arrow.get(obj['__arrow__']).to(config.TIMEZONE)
+        elif '__tempts__' in obj:
+            return TempTs(*[_decode_cache_content(o) for o in obj['__tempts__']])
+        elif '__tuple__' in obj:
+            return tuple(_decode_cache_content(o) for o in obj['__tuple__'])
+        elif '__dict__' in obj:
+            return {k: _decode_cache_content(v) for k, v in obj['__dict__']}
+    elif isinstance(obj, list):
+        return [_decode_cache_content(o) for o in obj]
+
+    return obj
+
+
+def dumps_cache_content(content) -> str:
+    return json.dumps(_encode_cache_content(content))
+
+
+def loads_cache_content(content: str):
+    return _decode_cache_content(json.loads(content))
+
+
 class RequestCache:
-    _cache: Dict[str, Tuple[arrow.Arrow, arrow.Arrow, Any]] = {}
+    # Entries are also stored to DB and loaded on first use so that a restart doesn't re-download them. Without
+    # db_session (e.g. in simulations) entries are only kept in memory. Stale times are epoch seconds.
+
+    def __init__(self, db_session=db_session) -> None:
+        self.db_session = db_session
+        self._cache: Dict[str, Tuple[int, int, Any]] = {}
+        self._loaded = False
+        self._lock = threading.RLock()
+        self._call_locks = {}
+
+    def load(self):
+        with self._lock:
+            now = pipeline_context.now()
+
+            with self.db_session:
+                for cached in CachedRequest.select():
+                    stale_after_if_failed = arrow.get(cached.stale_after_if_failed).timestamp
+
+                    if stale_after_if_failed < now:
+                        cached.delete()
+                        continue
+
+                    try:
+                        content = loads_cache_content(cached.content)
+                    except (ValueError, TypeError) as e:
+                        logger.exception(e)
+                        cached.delete()
+                        continue
+
+                    self._cache[cached.name] = (
+                        arrow.get(cached.stale_after_if_ok).timestamp, stale_after_if_failed, content)
+
+            self._loaded = True
+            logger.info('Loaded %d request cache entries', len(self._cache))
 
-    @classmethod
-    def put(cls, name, stale_after_if_ok, stale_after_if_failed, content):
-        cls._cache[name] = (stale_after_if_ok, stale_after_if_failed, content)
+    def _ensure_loaded(self):
+        if not self._loaded:
+            if self.db_session is None:
+                self._loaded = True
+                return
 
-    @classmethod
-    def get(cls, name, stale_check='ok') -> Optional[Any]:
-        if name in cls._cache:
-            stale_after_if_ok, stale_after_if_failed, content = cls._cache[name]
+            try:
+                self.load()
+            except Exception as e:
+                logger.exception(e)
+                self._loaded = True
 
-            if stale_check == 'ok' and arrow.now() <= stale_after_if_ok:
+    def put(self, name, stale_after_if_ok, stale_after_if_failed, content):
+        with self._lock:
+            self._ensure_loaded()
+            self._cache[name] = (stale_after_if_ok, stale_after_if_failed, content)
+            evicted = self._evict()
+
+            if self.db_session is None:
+                return
+
+            try:
+                self._store(name, stale_after_if_ok, stale_after_if_failed, content, evicted)
+            except Exception as e:
+                logger.exception(e)
+
+    def _evict(self) -> list:
+        now = pipeline_context.now()
+        evicted = [name for name, entry in self._cache.items() if entry[1] < now]
+
+        for name in evicted:
+            del self._cache[name]
+
+        max_entries = config.REQUEST_CACHE_MAX_ENTRIES
+        if len(self._cache) > max_entries:
+            by_staleness = sorted(self._cache.items(), key=lambda item: item[1][1])
+            for name, _ in by_staleness[:len(self._cache) - max_entries]:
+                del self._cache[name]
+                evicted.append(name)
+
+        if evicted:
+            logger.debug('Evicting request cache entries %s', evicted)
+
+        return evicted
+
+    def _store(self, name, stale_after_if_ok, stale_after_if_failed, content, evicted):
+        values = {
+            'stale_after_if_ok': arrow.get(stale_after_if_ok).isoformat(),
+            'stale_after_if_failed': arrow.get(stale_after_if_failed).isoformat(),
+            'content': dumps_cache_content(content),
+        }
+
+        with self.db_session:
+            cached = CachedRequest.get(name=name)
+            if cached:
+                cached.set(**values)
+            else:
+                CachedRequest(name=name, **values)
+
+            if evicted:
+                CachedRequest.select(lambda c: c.name in evicted).delete(bulk=True)
+
+    def get(self, name, stale_check='ok') -> Optional[Any]:
+        self._ensure_loaded()
+
+        if name in self._cache:
+            stale_after_if_ok, stale_after_if_failed, content = self._cache[name]
+            now = pipeline_context.now()
+
+            if stale_check == 'ok' and now <= stale_after_if_ok:
                 return content
-            elif stale_check == 'failed' and arrow.now() <= stale_after_if_failed:
+            elif stale_check == 'failed' and now <= stale_after_if_failed:
                 return content
 
         return None
 
-    @classmethod
-    def reset(cls):
-        cls._cache.clear()
+    def reset(self, persistent=False):
+        with self._lock:
+            self._cache.clear()
+            self._loaded = False
+
+            if persistent and self.db_session is not None:
+                with self.db_session:
+                    CachedRequest.select().delete(bulk=True)
+
+    def call_lock(self, name) -> threading.Lock:
+        # Concurrent callers wait for the one request in flight instead of making their own
+        with self._lock:
+            return self._call_locks.setdefault(name, threading.Lock())
+
+
+# Shared by all pipelines of the process unless their context has its own, see states.pipeline_context
+request_cache = RequestCache()
 
 
 def caching(cache_name):
     def caching_inner(f):
         @wraps(f)
         def caching_wrap(*args, **kw):
-            rq = RequestCache()
-            result = rq.get(cache_name)
-            if result:
-                logger.debug('func:%r args:[%r, %r] cache hit with result: %r' % (f.__name__, args, kw, result))
-            else:
-                logger.debug('func:%r args:[%r, %r] cache miss' % (f.__name__, args, kw))
-                try:
-                    result = f(*args, **kw)
-                except Exception as e:
-                    logger.exception(e)
-                    result = None
-                if result and result[1] is not None:  # result[1] == timestamp
-                    temp, ts = result
-                    logger.debug('func:%r args:[%r, %r] storing with result: %r' % (f.__name__, args, kw, result))
-                    stale_after_if_ok = ts.shift(
-                        minutes=config.CACHE_TIMES.get(cache_name, {}).get('if_ok', 60))
-                    stale_after_if_failed = ts.shift(
-                        minutes=config.CACHE_TIMES.get(cache_name, {}).get('if_failed', 120))
-                    rq.put(cache_name, stale_after_if_ok, stale_after_if_failed, result)
-                else:
-                    result = rq.get(cache_name, stale_check='failed')
-                    if result:
-                        logger.debug('func:%r args:[%r, %r] failed and returning old result: %r' % (
-                            f.__name__, args, kw, result))
-                    else:
-                        logger.debug('func:%r args:[%r, %r] failed and no result in cache' % (f.__name__, args, kw))
-            return result
+            cache = pipeline_context.current().request_cache
+            with cache.call_lock(cache_name):
+                return _caching_call(f, cache, cache_name, *args, **kw)
         return caching_wrap
     return caching_inner
 
 
+def _caching_call(f, rq: RequestCache, cache_name, *args, **kw):
+    result = rq.get(cache_name)
+    if result:
+        metrics.count('cache_hits')
+        logger.debug('func:%r args:[%r, %r] cache hit with result: %r' % (f.__name__, args, kw, result))
+    else:
+        metrics.count('cache_misses')
+        logger.debug('func:%r args:[%r, %r] cache miss' % (f.__name__, args, kw))
+        try:
+            result = f(*args, **kw)
+        except Exception as e:
+            logger.exception(e)
+            result = None
+        if result and result[1] is not None:  # result[1] == timestamp
+            temp, ts = result
+            logger.debug('func:%r args:[%r, %r] storing with result: %r' % (f.__name__, args, kw, result))
+            stale_after_if_ok = ts.timestamp + 60 * config.CACHE_TIMES.get(cache_name, {}).get('if_ok', 60)
+            stale_after_if_failed = ts.timestamp + 60 * config.CACHE_TIMES.get(cache_name, {}).get('if_failed', 120)
+            rq.put(cache_name, stale_after_if_ok, stale_after_if_failed, result)
+        else:
+            result = rq.get(cache_name, stale_check='failed')
+            if result:
+                logger.debug('func:%r args:[%r, %r] failed and returning old result: %r' % (
+                    f.__name__, args, kw, result))
+            else:
+                logger.debug('func:%r args:[%r, %r] failed and no result in cache' % (f.__name__, args, kw))
+    return result
+
+
 def forecast_mean_temperature(forecast: Forecast, hours: Union[int, Decimal] = 24) -> Optional[Decimal]:
-    if forecast and forecast.temps:
-        return mean(t.temp for t in forecast.temps[:int(hours)])
+    if forecast:
+        return forecast.mean(0, int(hours))
     else:
         return None
@@ -0,0 +1,162 @@
+import time
+from decimal import Decimal
+
+import arrow
+
+from poller_helpers import TempTs
+from states.auto_pipeline_pipes.helpers import get_temp, RequestCache, request_cache
+
+
+def test_get_temp_concurrent():
+    def fast1():
+        return Decimal(10), arrow.now()
+
+    def fast2():
+        time.sleep(0.1)
+        return Decimal(12), arrow.now()
+
+    def slow():
+        time.sleep(1)
+        return Decimal(100), arrow.now()
+
+    def failing():
+        raise ValueError()
+
+    start = time.time()
+    temp, ts = get_temp([fast1, slow, fast2, failing], concurrent=True, deadline=0.5)
+
+    assert time.time() - start < 1
+    assert temp == Decimal(11)
+    assert ts is not None
+
+
+def test_get_temp_concurrent_none_in_time():
+    def slow():
+        time.sleep(0.5)
+        return Decimal(100), arrow.now()
+
+    assert get_temp([slow], concurrent=True, deadline=0.1) == (None, None)
+
+
+def test_request_cache_survives_restart():
+    request_cache.reset(persistent=True)
+
+    now = arrow.now()
+    content = ([TempTs(Decimal('1.5'), now), TempTs(Decimal('-2'), now.shift(hours=1))], now)
+    request_cache.put('test', now.timestamp + 60 * 10, now.timestamp + 60 * 20, content)
+
+    request_cache.reset()
+
+    cached_temps, cached_ts = request_cache.get('test')
+    assert cached_temps == content[0]
+    assert isinstance(cached_temps[0], TempTs)
+    assert cached_ts == now
+
+    request_cache.reset(persistent=True)
+    assert request_cache.get('test') is None
+
+
+def test_request_cache_eviction(mocker):
+    mocker.patch('config.REQUEST_CACHE_MAX_ENTRIES', 2)
+    request_cache.reset(persistent=True)
+
+    now = arrow.now()
+    for i in range(3):
+        request_cache.put('test%d' % i, now.timestamp + 60 * 10, now.timestamp + 60 * (20 + i), (Decimal(i), now))
+
+    request_cache.reset()
+
+    assert request_cache.get('test0') is None
+    assert request_cache.get('test1') == (Decimal(1), now)
+    assert request_cache.get('test2') == (Decimal(2), now)
+
+    request_cache.reset(persistent=True)
+
+
+def test_request_cache_evicts_when_db_fails(mocker):
+    mocker.patch('config.REQUEST_CACHE_MAX_ENTRIES', 2)
+    mocker.patch.object(request_cache, '_store', side_effect=IOError())
+    request_cache.reset(persistent=True)
+
+    now = arrow.now()
+    request_cache.put('expired', now.timestamp - 60 * 20, now.timestamp - 60 * 10, (Decimal(0), now))
+    for i in range(3):
+        request_cache.put('test%d' % i, now.timestamp + 60 * 10, now.timestamp + 60 * (20 + i), (Decimal(i), now))
+
+    assert sorted(request_cache._cache) == ['test1', 'test2']
+
+    request_cache.reset(persistent=True)
+
+
+def test_caching_single_request_in_flight():
+    from concurrent.futures import ThreadPoolExecutor
+    from states.auto_pipeline_pipes.helpers import caching
+
+    request_cache.reset(persistent=True)
+    calls = []
+
+    @caching(cache_name='test')
+    def fetch():
+        calls.append(1)
+        time.sleep(0.1)
+        return Decimal(1), arrow.now()
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = list(executor.map(lambda _: fetch(), range(2)))
+
+    assert len(calls) == 1
+    assert results[0] == results[1]
+
+    request_cache.reset(persistent=True)
+
+
+def test_caching_uses_request_cache_of_current_context():
+    from states import pipeline_context
+    from states.auto_pipeline_pipes.helpers import caching
+
+    calls = []
+
+    @caching(cache_name='test')
+    def fetch():
+        calls.append(1)
+        return Decimal(len(calls)), arrow.now()
+
+    first = pipeline_context.PipelineContext(request_cache=RequestCache(db_session=None))
+    second = pipeline_context.PipelineContext(request_cache=RequestCache(db_session=None))
+
+    with pipeline_context.use(first):
+        assert fetch()[0] == Decimal(1)
+        assert fetch()[0] == Decimal(1)
+        # Concurrent fetches use the cache of the pipeline that started them
+        assert get_temp([fetch], concurrent=True, deadline=1)[0] == Decimal(1)
+
+    with pipeline_context.use(second):
+        assert fetch()[0] == Decimal(2)
+
+    assert len(calls) == 2
+    assert request_cache.get('test') is None
+
+
+def test_request_cache_uses_time_of_cycle():
+    from states import pipeline_context
+
+    clock_reads = []
+
+    def clock():
+        clock_reads.append(1)
+        return 1000.0 + 1000 * len(clock_reads)
+
+    cache = RequestCache(db_session=None)
+    context = pipeline_context.PipelineContext(request_cache=cache, clock=clock)
+
+    with pipeline_context.use(context), context.cycle() as now:
+        assert now == 2000
+        cache.put('test', now + 600, now + 1200, (Decimal(1), now))
+        assert cache.get('test') == (Decimal(1), now)
+        assert pipeline_context.now() == now
+        assert len(clock_reads) == 1
+
+    with pipeline_context.use(context):
+        # Clock is read again outside of a cycle
+        assert cache.get('test') is None
+        assert len(clock_reads) == 2
@@ -0,0 +1,69 @@
+from decimal import Decimal
+from typing import Optional
+
+import config
+from poller_helpers import Forecast, Commands
+from states import pipeline_context
+from states.pipe_graph import pipe
+
+
+def forecast_change(forecast: Optional[Forecast], hours: int) -> Optional[Decimal]:
+    if not forecast:
+        return None
+
+    temps = forecast.values[:forecast.index_after(pipeline_context.now() + hours * 3600)]
+
+    if not temps:
+        return None
+
+    return max(temps) - min(temps)
+
+
+def next_cycle_seconds(controller_output: Optional[Decimal], error_slope_per_hour: Optional[Decimal],
+                       heating: bool, forecast_change_temp: Optional[Decimal], kp: Optional[Decimal] = None) -> int:
+    # Next cycle at half of the estimated time until the controller output crosses the on/off boundary
+
+    if kp is None:
+        kp = config.CONTROLLER_P
+
+    if controller_output is None or error_slope_per_hour is None:
+        return config.AUTO_CYCLE_SECONDS
+
+    distance = max(abs(controller_output) - config.AUTO_CYCLE_TRANSITION_BAND, Decimal(0))
+    output_change_per_hour = abs(kp * error_slope_per_hour)
+
+    if distance == 0:
+        seconds = 0
+    elif output_change_per_hour > 0:
+        seconds = int(distance / output_change_per_hour * 3600 / 2)
+    else:
+        seconds = config.AUTO_CYCLE_MAX_SECONDS
+
+    if heating:
+        max_seconds = config.AUTO_CYCLE_HEATING_MAX_SECONDS
+    elif forecast_change_temp is None or forecast_change_temp >= config.AUTO_CYCLE_FLAT_FORECAST_CHANGE:
+        max_seconds = config.AUTO_CYCLE_SECONDS * 2
+    else:
+        max_seconds = config.AUTO_CYCLE_MAX_SECONDS
+
+    return min(max(seconds, config.AUTO_CYCLE_MIN_SECONDS), max_seconds)
+
+
+@pipe(consumes=('add_extra_info', 'error', 'controller_output', 'forecast', 'controller', 'last_command'),
+      produces=('next_cycle_seconds',), appends=('extra_info',))
+def schedule_next_cycle(add_extra_info, error, controller_output, forecast, persistent_data, **kwargs):
+    controller = persistent_data.get('controller')
+    last_command = persistent_data.get('last_command')
+
+    if error is not None and controller is not None:
+        error_slope_per_hour = controller.error_slope_per_hour()
+    else:
+        error_slope_per_hour = None
+
+    heating = last_command is not None and last_command != Commands.off
+
+    seconds = next_cycle_seconds(controller_output, error_slope_per_hour, heating, forecast_change(forecast, 6),
+                                 kp=controller.kp if controller is not None else None)
+    add_extra_info('Next cycle in %d min' % (seconds // 60))
+
+    return {'next_cycle_seconds': seconds}
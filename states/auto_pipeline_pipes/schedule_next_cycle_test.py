@@ -0,0 +1,34 @@
+from decimal import Decimal
+
+import arrow
+
+import config
+from poller_helpers import Forecast, TempTs
+from states.auto_pipeline_pipes.schedule_next_cycle import next_cycle_seconds, forecast_change
+
+
+def test_next_cycle_seconds():
+    assert next_cycle_seconds(None, None, False, None) == config.AUTO_CYCLE_SECONDS
+
+    # Near on/off boundary
+    assert next_cycle_seconds(Decimal('0.05'), Decimal(0), False, Decimal(0)) == config.AUTO_CYCLE_MIN_SECONDS
+    # Output reaches the boundary in 1 hour
+    assert next_cycle_seconds(Decimal('-2.1'), Decimal(1), False, Decimal(0)) == 30 * 60
+
+    # Stable
+    assert next_cycle_seconds(Decimal('-2'), Decimal(0), False, Decimal(1)) == config.AUTO_CYCLE_MAX_SECONDS
+    assert next_cycle_seconds(Decimal('-2'), Decimal(0), False, Decimal(5)) == config.AUTO_CYCLE_SECONDS * 2
+    assert next_cycle_seconds(Decimal('-2'), Decimal(0), False, None) == config.AUTO_CYCLE_SECONDS * 2
+    assert next_cycle_seconds(Decimal(2), Decimal(0), True, Decimal(1)) == config.AUTO_CYCLE_HEATING_MAX_SECONDS
+
+
+def test_forecast_change():
+    now = arrow.now()
+    forecast = Forecast(temps=[
+        TempTs(Decimal(1), now.shift(hours=1)),
+        TempTs(Decimal(-2), now.shift(hours=3)),
+        TempTs(Decimal(-10), now.shift(hours=8)),
+    ], ts=now)
+
+    assert forecast_change(forecast, 6) == Decimal(3)
+    assert forecast_change(None, 6) is None
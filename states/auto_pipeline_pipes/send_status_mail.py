@@ -1,6 +1,8 @@
 from typing import List
 
 from poller_helpers import email
+from states.pipe_graph import pipe
+from units import Unit
 
 
 def log_status(add_extra_info, valid_time: bool, forecast, valid_outside: bool, inside_temp,
@@ -31,7 +33,10 @@ def log_status(add_extra_info, valid_time: bool, forecast, valid_outside: bool,
     return status_str
 
 
-def send_status_mail(add_extra_info, have_valid_time, forecast, valid_outside, inside_temp,
+@pipe(consumes=('unit', 'add_extra_info', 'have_valid_time', 'forecast', 'valid_outside', 'inside_temp',
+                'target_inside_temp', 'controller', 'last_status_email_sent'),
+      produces=('last_status_email_sent',), appends=('extra_info',), serial=True)
+def send_status_mail(unit: Unit, add_extra_info, have_valid_time, forecast, valid_outside, inside_temp,
                      target_inside_temp, persistent_data, **kwargs):
 
     controller = persistent_data.get('controller')
@@ -42,7 +47,7 @@ def send_status_mail(add_extra_info, have_valid_time, forecast, valid_outside, i
 
     if last_status_email_sent != status:
         if last_status_email_sent is not None:
-            email('Status', status)
+            email('Status %s' % unit.name if unit.name else 'Status', status)
         last_status_email_sent = status
 
     return {}, {'last_status_email_sent': last_status_email_sent}
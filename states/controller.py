@@ -1,12 +1,74 @@
 import time
+from collections import deque
 from decimal import Decimal
-from typing import List, Tuple, Optional
+from typing import Tuple, Optional, Callable, Deque
 
 from poller_helpers import logger, decimal_round
 
 
+class SlidingRegression:
+    # Least squares slope over a time window with running sums. Times are kept relative to the oldest sample so
+    # that the sums stay small and exact in Decimal. Adding a sample is O(1) and removing old samples is O(1) each.
+
+    def __init__(self, window_seconds: Decimal) -> None:
+        self.window_seconds = window_seconds
+        self.samples: Deque[Tuple[Decimal, Decimal]] = deque()  # time and value
+        self.reset()
+
+    def reset(self):
+        self.samples.clear()
+        self.origin: Optional[Decimal] = None
+        self.sum_x = Decimal(0)
+        self.sum_y = Decimal(0)
+        self.sum_xy = Decimal(0)
+        self.sum_x2 = Decimal(0)
+
+    def add(self, ts: Decimal, value: Decimal):
+        if self.origin is None:
+            self.origin = ts
+
+        x = ts - self.origin
+        self.samples.append((ts, value))
+        self.sum_x += x
+        self.sum_y += value
+        self.sum_xy += x * value
+        self.sum_x2 += x * x
+
+        time_limit = ts - self.window_seconds
+        while self.samples[0][0] < time_limit:
+            self._remove_oldest()
+
+        self._move_origin(self.samples[0][0])
+
+    def _remove_oldest(self):
+        ts, value = self.samples.popleft()
+        x = ts - self.origin
+        self.sum_x -= x
+        self.sum_y -= value
+        self.sum_xy -= x * value
+        self.sum_x2 -= x * x
+
+    def _move_origin(self, new_origin: Decimal):
+        c = new_origin - self.origin
+        if c == 0:
+            return
+
+        n = len(self.samples)
+        self.sum_x2 += -2 * c * self.sum_x + n * c * c
+        self.sum_xy -= c * self.sum_y
+        self.sum_x -= n * c
+        self.origin = new_origin
+
+    def slope(self) -> Decimal:
+        n = Decimal(len(self.samples))
+        divider = (n * self.sum_x2 - self.sum_x * self.sum_x)
+        if divider == 0:
+            return Decimal(0)
+        return (n * self.sum_xy - self.sum_x * self.sum_y) / divider
+
+
 class Controller:
-    def __init__(self, kp: Decimal, ki: Decimal, kd: Decimal) -> None:
+    def __init__(self, kp: Decimal, ki: Decimal, kd: Decimal, clock: Optional[Callable[[], float]] = None) -> None:
         self.kp = kp
         self.ki = ki
         self.kd = kd
@@ -14,7 +76,14 @@ class Controller:
         self.i_low_limit = Decimal(0)
         self.integral = Decimal(0)
         self.current_time: float = None
-        self.past_errors: List[Tuple[Decimal, Decimal]] = []  # time and error
+        self.past_error_regression = SlidingRegression(window_seconds=Decimal(3600) * Decimal(2))
+        self.terms: Optional[Tuple[Decimal, Decimal, Decimal]] = None  # p, i and d terms of the last update
+        self.clock = clock
+
+    def now(self) -> float:
+        if self.clock:
+            return self.clock()
+        return time.time()
 
     def reset(self):
         self.integral = Decimal(0)
@@ -22,11 +91,34 @@ class Controller:
         self.reset_past_errors()
 
     def reset_past_errors(self):
-        self.past_errors: List[Tuple[Decimal, Decimal]] = []  # time and error
+        self.past_error_regression.reset()
+
+    @property
+    def past_errors(self) -> Deque[Tuple[Decimal, Decimal]]:
+        return self.past_error_regression.samples  # time and error
 
     def is_reset(self):
         return self.current_time is None
 
+    def state(self) -> dict:
+        # JSON serializable state for restoring the controller after a restart
+        return {
+            'integral': str(self.integral),
+            'current_time': self.current_time,
+            'past_errors': [[str(ts), str(error)] for ts, error in self.past_errors],
+        }
+
+    def restore(self, state: dict):
+        self.integral = Decimal(state['integral'])
+
+        # Time and past errors older than the D term window would only distort the next I and D terms
+        current_time = state.get('current_time')
+        if current_time is not None and \
+                Decimal(self.now() - current_time) <= self.past_error_regression.window_seconds:
+            self.current_time = current_time
+            for ts, error in state.get('past_errors', []):
+                self.past_error_regression.add(Decimal(ts), Decimal(error))
+
     def set_i_low_limit(self, value):
         logger.debug('controller set i low limit %.4f', value)
         self.i_low_limit = value
@@ -40,28 +132,14 @@ class Controller:
         logger.debug('controller integral low limit %.4f', self.i_low_limit)
 
     def _update_past_errors(self, error: Decimal):
-        self.past_errors.append((Decimal(time.time()), error))
-
-        hours = Decimal(3600) * Decimal(2)
-        past_error_time_limit = Decimal(time.time()) - hours
-
-        self.past_errors = [
-            past_error
-            for past_error
-            in self.past_errors
-            if past_error[0] >= past_error_time_limit
-        ]
+        # Milliseconds are enough and keep the regression sums exact
+        self.past_error_regression.add(decimal_round(Decimal(self.now()), 3), error)
 
     def _past_error_slope_per_second(self) -> Decimal:
-        n = Decimal(len(self.past_errors))
-        sum_xy = Decimal(sum(p[0] * p[1] for p in self.past_errors))
-        sum_x = Decimal(sum(p[0] for p in self.past_errors))
-        sum_y = Decimal(sum(p[1] for p in self.past_errors))
-        sum_x2 = Decimal(sum(p[0] * p[0] for p in self.past_errors))
-        divider = (n * sum_x2 - sum_x * sum_x)
-        if divider == 0:
-            return Decimal(0)
-        return (n * sum_xy - sum_x * sum_y) / divider
+        return self.past_error_regression.slope()
+
+    def error_slope_per_hour(self) -> Decimal:
+        return self._past_error_slope_per_second() * Decimal(3600)
 
     def update(self, error: Optional[Decimal], error_without_hysteresis: Optional[Decimal]) -> Tuple[Decimal, str]:
         if error is None:
@@ -73,10 +151,9 @@ class Controller:
 
         p_term = self.kp * error
 
-        new_time = time.time()
+        new_time = self.now()
 
-        error_slope_per_second = self._past_error_slope_per_second()
-        error_slope_per_hour = error_slope_per_second * Decimal(3600)
+        error_slope_per_hour = self.error_slope_per_hour()
 
         error_slope_per_hour = min(error_slope_per_hour, Decimal('0.5'))
         error_slope_per_hour = max(error_slope_per_hour, Decimal('-0.5'))
@@ -111,6 +188,7 @@ class Controller:
         logger.debug('controller past errors %s', past_errors_for_log)
 
         output = p_term + i_term + d_term
+        self.terms = (p_term, i_term, d_term)
 
         logger.debug('controller output %.4f', output)
         return output, self.log(error, p_term, i_term, d_term, error_slope_per_hour, self.i_low_limit, self.i_high_limit, output)
@@ -0,0 +1,79 @@
+import json
+import random
+from decimal import Decimal
+
+from states.controller import SlidingRegression, Controller
+
+
+def full_slope(points):
+    n = Decimal(len(points))
+    sum_xy = sum(p[0] * p[1] for p in points)
+    sum_x = sum(p[0] for p in points)
+    sum_y = sum(p[1] for p in points)
+    sum_x2 = sum(p[0] * p[0] for p in points)
+    divider = (n * sum_x2 - sum_x * sum_x)
+    if divider == 0:
+        return Decimal(0)
+    return (n * sum_xy - sum_x * sum_y) / divider
+
+
+def test_sliding_regression_matches_full_regression():
+    rnd = random.Random(1)
+    window = Decimal(7200)
+    regression = SlidingRegression(window)
+    points = []
+
+    ts = Decimal('1700000000.123')
+    for _ in range(500):
+        ts += Decimal(rnd.randint(60, 1200))
+        error = Decimal(rnd.randint(-300, 300)) / 100
+        regression.add(ts, error)
+
+        points = [p for p in points + [(ts, error)] if p[0] >= ts - window]
+
+        assert list(regression.samples) == points
+        # Full regression is done with times relative to the window start to avoid losing significance
+        origin = points[0][0]
+        expected = full_slope([(p[0] - origin, p[1]) for p in points])
+        assert abs(regression.slope() - expected) < Decimal('1e-20')
+
+
+def test_controller_slope():
+    now = [Decimal(1700000000)]
+    controller = Controller(Decimal(2), Decimal(2), Decimal(25), clock=lambda: float(now[0]))
+
+    for error in ('0', '0.5', '1', '1.5'):
+        controller.update(Decimal(error), Decimal(error))
+        now[0] += 900
+
+    assert controller._past_error_slope_per_second() * 3600 == Decimal(2)
+
+    controller.reset_past_errors()
+    assert controller._past_error_slope_per_second() == 0
+    assert len(controller.past_errors) == 0
+
+
+def test_controller_restore():
+    now = [Decimal(1700000000)]
+    controller = Controller(Decimal(2), Decimal(2), Decimal(25), clock=lambda: float(now[0]))
+
+    for error in ('0', '0.5', '1', '1.5'):
+        controller.update(Decimal(error), Decimal(error))
+        now[0] += 900
+
+    restored = Controller(Decimal(2), Decimal(2), Decimal(25), clock=lambda: float(now[0]))
+    restored.restore(json.loads(json.dumps(controller.state())))
+
+    assert restored.integral == controller.integral
+    assert restored.current_time == controller.current_time
+    assert list(restored.past_errors) == list(controller.past_errors)
+    assert restored.error_slope_per_hour() == Decimal(2)
+
+    # Stale past errors are not restored
+    now[0] += 3 * 3600
+    stale = Controller(Decimal(2), Decimal(2), Decimal(25), clock=lambda: float(now[0]))
+    stale.restore(controller.state())
+
+    assert stale.integral == controller.integral
+    assert stale.is_reset()
+    assert len(stale.past_errors) == 0
@@ -1,5 +1,6 @@
 # coding=utf-8
-from poller_helpers import Commands, send_ir_signal, write_log_to_sheet, Command
+from poller_helpers import Commands, send_ir_signal, Command
+from sheet_worker import write_log_to_sheet
 from states import State
 
 
@@ -0,0 +1,190 @@
+# coding=utf-8
+# Pipes declare the data and persistent data keys they consume and produce. PipeGraph orders the pipes by those
+# declarations and runs pipes that don't depend on each other in parallel. Serial pipes (the ones with side
+# effects, e.g. sending commands) run one at a time in the calling thread in pipeline order. Pipes without a
+# declaration are barriers: they run serially after every earlier pipe and before every later one.
+#
+# Pipes that append to a key without consuming it (e.g. extra_info) may run in parallel. Each of them appends to
+# its own list and the lists are merged in pipeline order, so the order doesn't depend on which pipe finishes first.
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import NamedTuple, Tuple, List, Set, Optional, Callable
+
+PipeSpec = NamedTuple('PipeSpec', [
+    ('consumes', Tuple[str, ...]),
+    ('produces', Tuple[str, ...]),
+    ('appends', Tuple[str, ...]),  # keys of mutable values that are appended to, e.g. extra_info
+    ('serial', bool),
+])
+
+
+def pipe(consumes=(), produces=(), appends=(), serial=False):
+    def pipe_inner(f):
+        f.pipe_spec = PipeSpec(tuple(consumes), tuple(produces), tuple(appends), serial)
+        return f
+    return pipe_inner
+
+
+class Appender:
+    # Callable that appends to the list of data[key], e.g. add_extra_info. PipeGraph binds it to the list of the
+    # pipe that calls it.
+
+    def __init__(self, key: str, target: list, callback: Optional[Callable] = None) -> None:
+        self.key = key
+        self.target = target
+        self.callback = callback
+
+    def __call__(self, value):
+        if self.callback:
+            self.callback(value)
+        self.target.append(value)
+
+    def bind(self, target: list) -> 'Appender':
+        return Appender(self.key, target, self.callback)
+
+
+def pipe_spec(p) -> Optional[PipeSpec]:
+    return getattr(p, 'pipe_spec', None)
+
+
+def pipe_dependencies(pipes: list) -> List[Set[int]]:
+    # Index of each pipe that must be finished before the pipe can start
+    dependencies = []
+    last_barrier = None
+    last_serial = None
+
+    for i, p in enumerate(pipes):
+        spec = pipe_spec(p)
+        deps = set()
+
+        if spec is None:
+            deps.update(range(i))
+        else:
+            if last_barrier is not None:
+                deps.add(last_barrier)
+            if spec.serial and last_serial is not None:
+                deps.add(last_serial)
+
+            for j in range(last_barrier + 1 if last_barrier is not None else 0, i):
+                earlier = pipe_spec(pipes[j])
+                earlier_writes = set(earlier.produces) | set(earlier.appends)
+
+                if (set(spec.consumes) & earlier_writes  # read after write or append
+                        or set(spec.produces) & (earlier_writes | set(earlier.consumes))  # write after any access
+                        or set(spec.appends) & (set(earlier.produces) | set(earlier.consumes))):
+                    deps.add(j)
+
+        if spec is None:
+            last_barrier = i
+        if spec is None or spec.serial:
+            last_serial = i
+
+        dependencies.append(deps)
+
+    return dependencies
+
+
+def critical_path(pipes: list, durations: List[float]) -> float:
+    # Length of the longest dependency chain with the given pipe durations
+    dependencies = pipe_dependencies(pipes)
+    finish = []
+
+    for i, deps in enumerate(dependencies):
+        finish.append(max([finish[j] for j in deps], default=0.0) + durations[i])
+
+    return max(finish, default=0.0)
+
+
+class PipeGraph:
+    def __init__(self, pipes: list, executor: Optional[ThreadPoolExecutor]) -> None:
+        # Without an executor all pipes run in pipeline order in the calling thread
+        self.pipes = pipes
+        self.dependencies = pipe_dependencies(pipes)
+        self.executor = executor
+
+        # Pipes that append to each key, in pipeline order
+        self.appenders = {}
+        for i, p in enumerate(pipes):
+            spec = pipe_spec(p)
+            for key in spec.appends if spec else ():
+                self.appenders.setdefault(key, []).append(i)
+
+    def buffered_keys(self, i: int) -> Tuple[str, ...]:
+        # Pipes that also consume a key have no parallel appenders (see pipe_dependencies) and use the list itself
+        spec = pipe_spec(self.pipes[i])
+        if spec is None:
+            return ()
+        return tuple(key for key in spec.appends if key not in spec.consumes)
+
+    def pipe_data(self, i: int, data: dict, buffers: dict) -> dict:
+        pipe_data = dict(data)
+        keys = self.buffered_keys(i)
+
+        if keys:
+            buffers[i] = {key: [] for key in keys}
+            for name, value in data.items():
+                if isinstance(value, Appender) and value.key in keys:
+                    pipe_data[name] = value.bind(buffers[i][value.key])
+            pipe_data.update(buffers[i])
+
+        return pipe_data
+
+    def run(self, data: dict, persistent_data: dict, call_pipe: Callable[[Callable, dict], object]):
+        # call_pipe(pipe, data) calls the pipe and returns its result. Results are merged to data and
+        # persistent_data in the calling thread.
+        pending = list(range(len(self.pipes)))
+        done = set()
+        running = {}
+        buffers = {}
+        merged_appenders = {key: 0 for key in self.appenders}
+
+        def merge(i, result):
+            if result:
+                if isinstance(result, tuple):
+                    new_data, new_persistent_data = result
+                else:
+                    new_data, new_persistent_data = result, {}
+
+                data.update((key, value) for key, value in new_data.items() if key not in self.buffered_keys(i))
+                persistent_data.update(new_persistent_data)
+
+            done.add(i)
+
+            # Appended values of the finished pipes are merged in pipeline order
+            for key, indexes in self.appenders.items():
+                while merged_appenders[key] < len(indexes) and indexes[merged_appenders[key]] in done:
+                    values = buffers.get(indexes[merged_appenders[key]], {}).get(key)
+                    if values:
+                        data.setdefault(key, []).extend(values)
+                    merged_appenders[key] += 1
+
+        try:
+            while pending or running:
+                started = True
+
+                while started:
+                    started = False
+
+                    for i in list(pending):
+                        if not self.dependencies[i] <= done:
+                            continue
+
+                        pending.remove(i)
+                        p = self.pipes[i]
+                        spec = pipe_spec(p)
+
+                        if spec is None or spec.serial or self.executor is None:
+                            merge(i, call_pipe(p, self.pipe_data(i, data, buffers)))
+                            started = True
+                            break
+                        else:
+                            running[self.executor.submit(call_pipe, p, self.pipe_data(i, data, buffers))] = i
+
+                if running:
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        i = running.pop(future)
+                        merge(i, future.result())
+        finally:
+            # Pipes started before an exception are let finish but their results are not used
+            for future in running:
+                future.cancel()
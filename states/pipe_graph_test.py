@@ -0,0 +1,118 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from states.auto_pipeline import AutoPipeline
+from states.auto_pipeline_pipes import general
+from states.auto_pipeline_pipes.adjust_target_with_rh import get_dew_point
+from states.auto_pipeline_pipes.get_forecast import get_forecast
+from states.auto_pipeline_pipes.get_inside import get_inside
+from states.auto_pipeline_pipes.get_outside import get_outside_measurement
+from states.pipe_graph import PipeGraph, pipe, pipe_dependencies, critical_path, Appender
+
+
+def call_pipe(p, data):
+    return p(**data)
+
+
+def test_auto_pipeline_dependencies():
+    pipes = AutoPipeline().pipeline()
+    dependencies = pipe_dependencies(pipes)
+
+    def depends(a, b):
+        # a depends on b directly or indirectly
+        deps = set(dependencies[pipes.index(a)])
+        while deps:
+            if pipes.index(b) in deps:
+                return True
+            deps = set.union(*(dependencies[d] for d in deps))
+        return False
+
+    fetchers = [get_outside_measurement, get_dew_point, get_inside, get_forecast]
+    for a in fetchers:
+        for b in fetchers:
+            assert not depends(a, b)
+
+    assert depends(general.send_command, general.update_controller)
+    assert depends(general.write_log, general.send_command)
+    assert depends(general.save_state, general.store_cycle)
+
+    # Sequentially the fetchers would take 4 units
+    assert critical_path(pipes, [1.0 if p in fetchers else 0.0 for p in pipes]) == 1.0
+
+
+def test_pipe_graph_runs_independent_pipes_in_parallel():
+    calls = []
+
+    @pipe(produces=('a',))
+    def slow_a(**kwargs):
+        time.sleep(0.2)
+        return {'a': 1}
+
+    @pipe(produces=('b',))
+    def slow_b(**kwargs):
+        time.sleep(0.2)
+        return {'b': 2}
+
+    @pipe(consumes=('a', 'b'), produces=('c',), serial=True)
+    def side_effect(a, b, **kwargs):
+        calls.append('side_effect')
+        return {'c': a + b}, {'persisted': True}
+
+    def undeclared(c, **kwargs):
+        calls.append('undeclared')
+
+    data = {}
+    persistent_data = {}
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        PipeGraph([slow_a, slow_b, side_effect, undeclared], executor).run(data, persistent_data, call_pipe)
+
+    assert time.time() - start < 0.35
+    assert data == {'a': 1, 'b': 2, 'c': 3}
+    assert persistent_data == {'persisted': True}
+    assert calls == ['side_effect', 'undeclared']
+
+
+def test_pipe_graph_without_executor():
+    order = []
+
+    @pipe(produces=('a',))
+    def first(**kwargs):
+        order.append('first')
+
+    @pipe(produces=('b',))
+    def second(**kwargs):
+        order.append('second')
+
+    PipeGraph([first, second], None).run({}, {}, call_pipe)
+
+    assert order == ['first', 'second']
+
+
+def test_pipe_graph_merges_appends_in_pipeline_order():
+    @pipe(produces=('add_info', 'info'))
+    def make_info(**kwargs):
+        info = []
+        return {'add_info': Appender('info', info), 'info': info}
+
+    @pipe(consumes=('add_info',), produces=('a',), appends=('info',))
+    def slow(add_info, **kwargs):
+        time.sleep(0.2)
+        add_info('slow')
+        return {'a': 1}
+
+    @pipe(consumes=('add_info',), produces=('b',), appends=('info',))
+    def fast(add_info, info, **kwargs):
+        info.append('fast')
+        return {'b': 2, 'info': info}
+
+    @pipe(consumes=('a', 'b', 'info'), appends=('info',), serial=True)
+    def last(info, **kwargs):
+        info.append('last %d' % len(info))
+
+    data = {}
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        PipeGraph([make_info, slow, fast, last], executor).run(data, {}, call_pipe)
+
+    assert data['info'] == ['slow', 'fast', 'last 2']
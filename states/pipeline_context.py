@@ -0,0 +1,97 @@
+# coding=utf-8
+# Everything one pipeline instance owns: persistent data, request cache, DB session, sheet worker and clock.
+# AutoPipeline makes its context current while a pipe runs, also in the threads the pipe uses (see bind), so that
+# helpers deep in the pipes use the context of the pipeline that called them. Outside of pipelines the process
+# default context is current.
+#
+# Pipes use now() for the time as integer epoch seconds. The clock is read once per cycle so that all pipes of a
+# cycle see the same time. Arrow objects are only made at the edges, e.g. for emails, the sheet and logs.
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Optional, Callable
+
+
+def wall_clock() -> float:
+    # Looks up time.time on every call so that freezegun can patch it
+    return time.time()
+
+
+class PipelineContext:
+    def __init__(self, persistent_data: Optional[dict] = None, request_cache=None, db_session=None,
+                 sheet_worker=None, clock: Callable[[], float] = wall_clock) -> None:
+        self.persistent_data = persistent_data if persistent_data is not None else {}
+        self.request_cache = request_cache
+        self.db_session = db_session
+        self.sheet_worker = sheet_worker
+        self.clock = clock
+        self.cycle_now: Optional[int] = None
+
+    @contextmanager
+    def cycle(self):
+        self.cycle_now = int(self.clock())
+        try:
+            yield self.cycle_now
+        finally:
+            self.cycle_now = None
+
+    def now(self) -> int:
+        if self.cycle_now is None:
+            return int(self.clock())
+        return self.cycle_now
+
+    def new_pipeline(self) -> 'PipelineContext':
+        # Context with its own persistent data that shares the other resources, e.g. for another unit
+        return PipelineContext(None, self.request_cache, self.db_session, self.sheet_worker, self.clock)
+
+
+_local = threading.local()
+_default = None
+_default_lock = threading.Lock()
+
+
+def default_context() -> PipelineContext:
+    global _default
+
+    with _default_lock:
+        if _default is None:
+            from poller_helpers import db_session
+            from sheet_worker import sheet_worker
+            from states.auto_pipeline_pipes.helpers import request_cache
+
+            _default = PipelineContext(None, request_cache, db_session, sheet_worker)
+
+        return _default
+
+
+def current() -> PipelineContext:
+    context = getattr(_local, 'context', None)
+    if context is None:
+        return default_context()
+    return context
+
+
+def now() -> int:
+    return current().now()
+
+
+@contextmanager
+def use(context: PipelineContext):
+    previous, _local.context = getattr(_local, 'context', None), context
+    try:
+        yield context
+    finally:
+        _local.context = previous
+
+
+def bind(func):
+    # Runs func with the context that is current when bind is called, also in other threads
+    context = current()
+
+    @wraps(func)
+    def bound(*args, **kwargs):
+        with use(context):
+            return func(*args, **kwargs)
+
+    return bound
@@ -3,13 +3,13 @@ from json import JSONDecodeError
 
 from pony import orm
 
-from poller_helpers import CommandLog
+from poller_helpers import CommandLog, db_session
 from states import State
 
 
 class ReadLastMessageFromDB(State):
     def run(self, payload):
-        with orm.db_session:
+        with db_session:
             first = orm.select(c for c in CommandLog).order_by(orm.desc(CommandLog.ts)).first()
             if first:
                 as_dict = first.to_dict()
@@ -1,4 +1,4 @@
-from poller_helpers import get_most_recent_message
+from sheet_worker import get_most_recent_message
 from states import State
 
 
@@ -0,0 +1,105 @@
+# coding=utf-8
+# Parameter sweep for controller tuning. Every parameter combination is replayed (see replay.py) against the
+# same recording in a process pool and scored.
+#
+# Usage: python sweep.py outside.csv --param CONTROLLER_P=1,2,3 --param CONTROLLER_D=10,25 [--samples 20]
+import argparse
+import itertools
+import os
+import random
+from decimal import Decimal
+from multiprocessing import Pool
+from typing import NamedTuple, List, Dict, Optional
+
+import config
+from replay import Recording, Replay, ReplayResult, load_series
+
+Score = NamedTuple('Score', [
+    ('energy', Decimal),  # heating hours weighted by command temperature
+    ('min_temp_violations', int),  # cycles with inside temperature below minimum inside temperature
+    ('ir_commands', int),
+    ('compressor_starts', int),
+])
+
+_recording: Optional[Recording] = None
+_replay_kwargs: dict = {}
+
+
+def score(result: ReplayResult, interval_minutes: int, minimum_inside_temp: Decimal) -> Score:
+    interval_hours = Decimal(interval_minutes) / Decimal(60)
+
+    energy = sum(
+        (c.command.temp * interval_hours for c in result.cycles if c.command is not None and c.command.temp),
+        Decimal(0))
+    violations = sum(1 for c in result.cycles if c.inside_temp is not None and c.inside_temp < minimum_inside_temp)
+
+    return Score(energy, violations, len(result.commands), result.compressor_starts)
+
+
+def _init_worker(recording: Recording, replay_kwargs: dict) -> None:
+    global _recording, _replay_kwargs
+    _recording = recording
+    _replay_kwargs = replay_kwargs
+
+
+def evaluate(params: Dict[str, Decimal]):
+    result = Replay(_recording, params=params, **_replay_kwargs).run()
+    interval_minutes = _replay_kwargs.get('interval_minutes', 15)
+    minimum_inside_temp = params.get('MINIMUM_INSIDE_TEMP', config.MINIMUM_INSIDE_TEMP)
+    return params, score(result, interval_minutes, minimum_inside_temp)
+
+
+def parameter_combinations(grid: Dict[str, List[Decimal]], samples: Optional[int] = None,
+                           seed: Optional[int] = None) -> List[Dict[str, Decimal]]:
+    names = sorted(grid)
+    combinations = [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+    if samples is not None and samples < len(combinations):
+        combinations = random.Random(seed).sample(combinations, samples)
+
+    return combinations
+
+
+def sweep(recording: Recording, combinations: List[Dict[str, Decimal]], processes: Optional[int] = None,
+          **replay_kwargs) -> list:
+    with Pool(processes or os.cpu_count(), initializer=_init_worker, initargs=(recording, replay_kwargs)) as pool:
+        results = pool.map(evaluate, combinations)
+
+    return sorted(results, key=lambda r: (r[1].min_temp_violations, r[1].energy, r[1].ir_commands))
+
+
+def parse_param(value: str):
+    name, values = value.split('=', 1)
+    return name, [Decimal(v) for v in values.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sweep controller parameters against recorded temperatures')
+    parser.add_argument('outside', help='CSV of outside temperatures')
+    parser.add_argument('--inside', help='CSV of inside temperatures')
+    parser.add_argument('--forecast', help='CSV of forecast temperatures')
+    parser.add_argument('--param', action='append', type=parse_param, default=[],
+                        help='NAME=v1,v2,... config value to sweep, e.g. CONTROLLER_P=1,2,3')
+    parser.add_argument('--samples', type=int, help='Evaluate a random sample of the grid')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--processes', type=int)
+    parser.add_argument('--interval', type=int, default=15, help='Cycle interval in minutes')
+    args = parser.parse_args()
+
+    recording = Recording(
+        outside=load_series(args.outside),
+        inside=load_series(args.inside) if args.inside else None,
+        forecast=load_series(args.forecast) if args.forecast else None,
+    )
+
+    combinations = parameter_combinations(dict(args.param), args.samples, args.seed)
+    results = sweep(recording, combinations, args.processes, interval_minutes=args.interval)
+
+    for params, s in results:
+        print('%s energy %.1f, min temp violations %d, IR commands %d, compressor starts %d' % (
+            ' '.join('%s=%s' % item for item in sorted(params.items())),
+            s.energy, s.min_temp_violations, s.ir_commands, s.compressor_starts))
+
+
+if __name__ == '__main__':
+    main()
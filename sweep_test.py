@@ -0,0 +1,39 @@
+from decimal import Decimal
+
+from replay import Recording
+from replay_test import make_outside
+import sweep as sweep_module
+from sweep import parameter_combinations, sweep
+
+
+def test_parameter_combinations():
+    grid = {'CONTROLLER_P': [Decimal(1), Decimal(2)], 'CONTROLLER_D': [Decimal(10), Decimal(25), Decimal(40)]}
+
+    assert len(parameter_combinations(grid)) == 6
+    assert {'CONTROLLER_P': Decimal(2), 'CONTROLLER_D': Decimal(40)} in parameter_combinations(grid)
+
+    sample = parameter_combinations(grid, samples=4, seed=1)
+    assert len(sample) == 4
+    assert sample == parameter_combinations(grid, samples=4, seed=1)
+
+
+def test_sweep():
+    recording = Recording(outside=make_outside(1), inside=None, forecast=None)
+    combinations = parameter_combinations({'CONTROLLER_P': [Decimal(1), Decimal(4)]})
+
+    results = sweep(recording, combinations, processes=2, initial_inside_temp=Decimal(6))
+
+    assert sorted(params['CONTROLLER_P'] for params, score in results) == [Decimal(1), Decimal(4)]
+    for params, score in results:
+        assert score.energy >= 0
+        assert score.ir_commands >= score.compressor_starts
+
+
+def test_evaluate_scores_against_swept_minimum(mocker):
+    mock_score = mocker.patch('sweep.score')
+    mocker.patch('sweep.Replay')
+    sweep_module._init_worker(Recording(outside=make_outside(1), inside=None, forecast=None), {})
+
+    sweep_module.evaluate({'MINIMUM_INSIDE_TEMP': Decimal(12)})
+
+    assert mock_score.call_args[0][2] == Decimal(12)
@@ -0,0 +1,92 @@
+# coding=utf-8
+# Append-only log of pipeline cycles. Every record is a fixed size struct so that the file can be searched by
+# time with a binary search without parsing it.
+import math
+import mmap
+import os
+import struct
+from typing import NamedTuple, Optional, List, Iterator
+
+CycleRecord = NamedTuple('CycleRecord', [
+    ('ts', int),  # epoch seconds
+    ('inside_temp', Optional[float]),
+    ('outside_temp', Optional[float]),
+    ('target_inside_temp', Optional[float]),
+    ('error', Optional[float]),
+    ('p_term', Optional[float]),
+    ('i_term', Optional[float]),
+    ('d_term', Optional[float]),
+    ('controller_output', Optional[float]),
+    ('command_temp', Optional[float]),  # None when the command is off
+])
+
+RECORD_STRUCT = struct.Struct('<q9d')
+TS_STRUCT = struct.Struct('<q')
+
+
+def _to_float(value) -> float:
+    if value is None:
+        return math.nan
+    return float(value)
+
+
+def _from_float(value: float) -> Optional[float]:
+    if math.isnan(value):
+        return None
+    return value
+
+
+def pack(record: CycleRecord) -> bytes:
+    return RECORD_STRUCT.pack(int(record.ts), *(_to_float(v) for v in record[1:]))
+
+
+def unpack(data, offset: int = 0) -> CycleRecord:
+    values = RECORD_STRUCT.unpack_from(data, offset)
+    return CycleRecord(values[0], *(_from_float(v) for v in values[1:]))
+
+
+class CycleLog:
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def append(self, record: CycleRecord) -> None:
+        with open(self.path, 'ab') as f:
+            # Drop a partial record left by a crash in the middle of a write
+            size = f.tell()
+            if size % RECORD_STRUCT.size:
+                f.truncate(size - size % RECORD_STRUCT.size)
+            f.write(pack(record))
+
+    def __len__(self) -> int:
+        try:
+            return os.path.getsize(self.path) // RECORD_STRUCT.size
+        except FileNotFoundError:
+            return 0
+
+    def range(self, start_ts: Optional[int] = None, end_ts: Optional[int] = None) -> List[CycleRecord]:
+        # Records with start_ts <= ts < end_ts
+        return list(self.iter_range(start_ts, end_ts))
+
+    def iter_range(self, start_ts: Optional[int] = None, end_ts: Optional[int] = None) -> Iterator[CycleRecord]:
+        count = len(self)
+        if count == 0:
+            return
+
+        with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            first = 0 if start_ts is None else self._bisect(data, count, start_ts)
+            last = count if end_ts is None else self._bisect(data, count, end_ts)
+
+            for i in range(first, last):
+                yield unpack(data, i * RECORD_STRUCT.size)
+
+    @staticmethod
+    def _bisect(data, count: int, ts: int) -> int:
+        # Index of the first record with record ts >= ts
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if TS_STRUCT.unpack_from(data, middle * RECORD_STRUCT.size)[0] < ts:
+                low = middle + 1
+            else:
+                high = middle
+        return low
@@ -0,0 +1,46 @@
+from decimal import Decimal
+
+from timeseries import CycleLog, CycleRecord, RECORD_STRUCT
+
+
+def make_record(ts, inside=Decimal('5.5')):
+    return CycleRecord(ts, inside, Decimal('-10.1'), Decimal('4.8'), Decimal('-0.7'), Decimal('-1.4'),
+                       Decimal('0.2'), Decimal(0), Decimal('-1.2'), None)
+
+
+def test_cycle_log_range(tmpdir):
+    log = CycleLog(str(tmpdir.join('cycles.bin')))
+
+    assert log.range() == []
+
+    for ts in range(1000, 2000, 100):
+        log.append(make_record(ts))
+    log.append(make_record(2000, inside=None))
+
+    assert len(log) == 11
+
+    records = log.range(1250, 1500)
+    assert [r.ts for r in records] == [1300, 1400]
+    assert records[0].inside_temp == 5.5
+    assert records[0].command_temp is None
+
+    assert [r.ts for r in log.range(start_ts=1900)] == [1900, 2000]
+    assert log.range(start_ts=2000)[0].inside_temp is None
+    assert [r.ts for r in log.range(end_ts=1100)] == [1000]
+    assert log.range(3000, 4000) == []
+
+
+def test_cycle_log_partial_record(tmpdir):
+    path = str(tmpdir.join('cycles.bin'))
+    log = CycleLog(path)
+    log.append(make_record(1000))
+
+    with open(path, 'ab') as f:
+        f.write(b'\x00' * 10)
+
+    assert len(log) == 1
+    log.append(make_record(1100))
+
+    assert [r.ts for r in log.range()] == [1000, 1100]
+    with open(path, 'rb') as f:
+        assert len(f.read()) == 2 * RECORD_STRUCT.size
@@ -0,0 +1,63 @@
+# coding=utf-8
+import time
+from typing import List
+
+from poller_helpers import logger
+from sheet_worker import get_most_recent_message
+from states.auto_pipeline import AutoPipeline
+from states.pipeline_context import default_context
+from units import Unit
+
+
+class UnitScheduler:
+    # Runs the auto pipelines of several units in one process. Each unit runs when its own pipeline has
+    # scheduled the next cycle. Weather requests are shared through the request cache so they don't grow with the
+    # number of units. Only auto messages are supported: a message goes to the unit named in param 'unit', or to
+    # all units.
+
+    def __init__(self, units: List[Unit]) -> None:
+        self.units = units
+        # Own persistent data for each unit, the request cache and other resources are shared
+        self.contexts = {unit.name: default_context().new_pipeline() for unit in units}
+        self.next_run_at = {unit.name: 0.0 for unit in units}
+        self.payloads = {}
+
+    def run_due(self) -> float:
+        # Runs the units that are due and returns the seconds until the next unit is due
+        for unit in self.units:
+            if self.next_run_at[unit.name] > time.time():
+                continue
+
+            payload = self.payloads.pop(unit.name, None)
+
+            try:
+                data = AutoPipeline(unit, self.contexts[unit.name]).run_cycle(payload)
+            except Exception as e:
+                logger.exception(e)
+                data = {}
+
+            next_cycle_seconds = data.get('next_cycle_seconds') or 60 * 15
+            self.next_run_at[unit.name] = time.time() + next_cycle_seconds
+            logger.info('Unit %s next cycle in %d secs', unit.name, next_cycle_seconds)
+
+        return max(min(self.next_run_at.values()) - time.time(), 0)
+
+    def handle_message(self, message: dict):
+        if message.get('command') != 'auto':
+            logger.warning('Only auto messages are supported with several units: %s', message)
+            return
+
+        unit_name = (message.get('param') or {}).get('unit')
+
+        for unit in self.units:
+            if unit_name is None or unit_name == unit.name:
+                self.payloads[unit.name] = message
+                self.next_run_at[unit.name] = 0.0
+
+    def run(self):
+        while True:
+            wait_seconds = self.run_due()
+
+            message = get_most_recent_message(once=True, wait_seconds=wait_seconds)
+            if message:
+                self.handle_message(message)
@@ -0,0 +1,48 @@
+from unit_scheduler import UnitScheduler
+from units import default_unit
+
+
+def test_units_run_on_their_own_schedule(mocker):
+    now = mocker.patch('unit_scheduler.time.time', return_value=1000.0)
+    runs = []
+
+    def run_cycle(self, payload):
+        runs.append((self.unit.name, payload))
+        return {'next_cycle_seconds': 300 if self.unit.name == 'house' else 900}
+
+    mocker.patch('unit_scheduler.AutoPipeline.run_cycle', run_cycle)
+
+    house = default_unit()._replace(name='house')
+    garage = default_unit()._replace(name='garage', remote='garage')
+    scheduler = UnitScheduler([house, garage])
+
+    def run_due(at):
+        now.return_value = at
+        return scheduler.run_due()
+
+    assert run_due(1000.0) == 300
+    assert runs == [('house', None), ('garage', None)]
+
+    assert run_due(1300.0) == 300
+    assert runs[2:] == [('house', None)]
+
+    message = {'command': 'auto', 'param': {'min_inside_temp': 5, 'unit': 'garage'}}
+    scheduler.handle_message(message)
+    scheduler.handle_message({'command': 'turn off'})
+
+    assert run_due(1301.0) == 299
+    assert runs[3:] == [('garage', message)]
+
+    scheduler.handle_message({'command': 'auto'})
+    run_due(1302.0)
+    assert runs[4:] == [('house', {'command': 'auto'}), ('garage', {'command': 'auto'})]
+
+
+def test_units_have_own_persistent_data():
+    scheduler = UnitScheduler([default_unit()._replace(name='house'), default_unit()._replace(name='garage')])
+    house, garage = scheduler.contexts['house'], scheduler.contexts['garage']
+
+    house.persistent_data['last_command'] = 'off'
+
+    assert 'last_command' not in garage.persistent_data
+    assert house.request_cache is garage.request_cache
@@ -0,0 +1,54 @@
+# coding=utf-8
+# Heat pump units driven by one process. Without UNITS in config there is one unit configured by the top level
+# config values. Weather settings (locations, endpoints) are process wide so all units share the weather requests.
+import os
+from decimal import Decimal
+from typing import NamedTuple, List, Tuple
+
+import config
+
+Unit = NamedTuple('Unit', [
+    ('name', str),  # empty in single unit mode
+    ('remote', str),  # lirc remote name
+    ('inside_device_ids', Tuple[str, ...]),
+    ('minimum_inside_temp', Decimal),
+    ('controller_p', Decimal),
+    ('controller_i', Decimal),
+    ('controller_d', Decimal),
+    ('cycle_log_file', str),
+])
+
+
+def default_unit() -> Unit:
+    return Unit(
+        name='',
+        remote=config.IR_REMOTE,
+        inside_device_ids=tuple(config.SMARTTHINGS_INSIDE_DEVICE_IDS),
+        minimum_inside_temp=config.MINIMUM_INSIDE_TEMP,
+        controller_p=config.CONTROLLER_P,
+        controller_i=config.CONTROLLER_I,
+        controller_d=config.CONTROLLER_D,
+        cycle_log_file=config.CYCLE_LOG_FILE,
+    )
+
+
+def configured_units() -> List[Unit]:
+    if not config.UNITS:
+        return [default_unit()]
+
+    units = []
+
+    for unit_config in config.UNITS:
+        name = unit_config.get('name')
+        if not name or name in [unit.name for unit in units]:
+            raise ValueError('Unit name missing or not unique: %r' % name)
+
+        unknown = set(unit_config) - set(Unit._fields)
+        if unknown:
+            raise ValueError('Unknown unit config %s' % sorted(unknown))
+
+        directory, file_name = os.path.split(config.CYCLE_LOG_FILE)
+        unit = default_unit()._replace(cycle_log_file=os.path.join(directory, '%s-%s' % (name, file_name)))
+        units.append(unit._replace(**unit_config))
+
+    return units
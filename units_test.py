@@ -0,0 +1,42 @@
+from decimal import Decimal
+
+import pytest
+
+from units import configured_units, default_unit
+
+
+def test_single_unit(mocker):
+    mocker.patch('config.UNITS', [])
+
+    assert configured_units() == [default_unit()]
+    assert default_unit().name == ''
+
+
+def test_units_default_to_top_level_config(mocker):
+    mocker.patch('config.UNITS', [
+        {'name': 'house', 'inside_device_ids': ('a',)},
+        {'name': 'garage', 'remote': 'garage', 'minimum_inside_temp': Decimal(5), 'controller_p': Decimal(1)},
+    ])
+    mocker.patch('config.CYCLE_LOG_FILE', 'logs/cycles.bin')
+
+    house, garage = configured_units()
+
+    assert house.remote == default_unit().remote
+    assert house.inside_device_ids == ('a',)
+    assert house.cycle_log_file == 'logs/house-cycles.bin'
+    assert garage.remote == 'garage'
+    assert garage.minimum_inside_temp == Decimal(5)
+    assert garage.controller_p == Decimal(1)
+    assert garage.controller_i == default_unit().controller_i
+
+
+def test_unit_names_must_be_unique(mocker):
+    mocker.patch('config.UNITS', [{'name': 'a'}, {'name': 'a'}])
+
+    with pytest.raises(ValueError):
+        configured_units()
+
+    mocker.patch('config.UNITS', [{'name': 'a', 'unknown': 1}])
+
+    with pytest.raises(ValueError):
+        configured_units()
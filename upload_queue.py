@@ -0,0 +1,110 @@
+# coding=utf-8
+import json
+from typing import Optional
+
+from pony import orm
+
+import config
+from poller_helpers import UploadItem, logger, post_url, json_dumps, db_session
+from workers import BackgroundWorker
+
+
+class UploadQueue(BackgroundWorker):
+    # Durable queue of storage uploads. Items are stored to DB before upload so they survive failures and
+    # restarts. The worker uploads them in batches to the addMany endpoint, or one by one to addOne if the storage
+    # doesn't support addMany. At most STORAGE_QUEUE_MAX_ITEMS are kept.
+
+    name = 'upload-queue'
+    min_backoff = 30
+    max_backoff = 60 * 30
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.backoff = 0
+        self.add_many = True
+
+    def put(self, data):
+        with db_session:
+            UploadItem(data=json_dumps(data))
+            self.drop_overflow()
+
+        self.start()
+        if not self.backoff:
+            # While backing off the worker retries on its own schedule
+            self.wake()
+
+    def drop_overflow(self):
+        overflow = orm.count(i for i in UploadItem) - config.STORAGE_QUEUE_MAX_ITEMS
+        if overflow > 0:
+            ids = [i.id for i in orm.select(i for i in UploadItem).order_by(UploadItem.id)[:overflow]]
+            UploadItem.select(lambda i: i.id in ids).delete(bulk=True)
+            logger.warning('Upload queue full, dropped %d oldest items', overflow)
+
+    def work(self):
+        uploaded = self.upload_batch()
+
+        if uploaded is None:
+            self.backoff = min(max(self.backoff * 2, self.min_backoff), self.max_backoff)
+            logger.info('Upload failed, retrying in %d secs', self.backoff)
+            return self.backoff
+
+        self.backoff = 0
+
+        if uploaded == config.STORAGE_BATCH_SIZE:
+            # There may be more items
+            return 0
+
+        return None
+
+    def upload_batch(self):
+        # Returns the number of uploaded items or None if upload failed
+        with db_session:
+            items = list(orm.select(i for i in UploadItem).order_by(UploadItem.id)[:config.STORAGE_BATCH_SIZE])
+            if not items:
+                return 0
+
+            ids = [item.id for item in items]
+            batch = [json.loads(item.data) for item in items]
+
+        if self.add_many:
+            status_code = self.post('addMany', batch)
+            if status_code in (400, 404):
+                logger.warning('Storage does not support addMany, uploading items one by one')
+                self.add_many = False
+            elif status_code != 200:
+                return None
+            else:
+                uploaded_ids = ids
+
+        if not self.add_many:
+            uploaded_ids = []
+            for item_id, data in zip(ids, batch):
+                if self.post('addOne', data) != 200:
+                    break
+                uploaded_ids.append(item_id)
+
+        if uploaded_ids:
+            with db_session:
+                UploadItem.select(lambda i: i.id in uploaded_ids).delete(bulk=True)
+            logger.debug('Uploaded %d items', len(uploaded_ids))
+
+        if len(uploaded_ids) < len(ids):
+            return None
+
+        return len(ids)
+
+    def post(self, endpoint, data) -> Optional[int]:
+        # Returns the status code or None if the request failed
+        try:
+            result = post_url(url=config.STORAGE_ROOT_URL + endpoint, data=data)
+        except Exception as e:
+            logger.exception(e)
+            return None
+
+        if result.status_code != 200:
+            logger.error('%d: %s' % (result.status_code, result.content))
+
+        return result.status_code
+
+
+upload_queue = UploadQueue()
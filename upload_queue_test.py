@@ -0,0 +1,97 @@
+from decimal import Decimal
+from unittest.mock import Mock
+
+from pony import orm
+
+import config
+from poller_helpers import UploadItem, db_session
+from upload_queue import UploadQueue
+
+
+def clear_queue():
+    with db_session:
+        UploadItem.select().delete(bulk=True)
+
+
+def queue_count():
+    with db_session:
+        return orm.count(i for i in UploadItem)
+
+
+def test_upload_batches(mocker):
+    mocker.patch('config.STORAGE_BATCH_SIZE', 2)
+    mock_post = mocker.patch('upload_queue.post_url', return_value=Mock(status_code=200))
+    mocker.patch('upload_queue.UploadQueue.start')
+    clear_queue()
+
+    queue = UploadQueue()
+    for i in range(3):
+        queue.put({'temp': Decimal(i)})
+
+    assert queue.work() == 0
+    assert queue.work() is None
+    assert queue_count() == 0
+
+    assert mock_post.call_count == 2
+    assert mock_post.call_args_list[0][1]['data'] == [{'temp': '0'}, {'temp': '1'}]
+    assert mock_post.call_args_list[1][1]['data'] == [{'temp': '2'}]
+
+
+def test_upload_failure_keeps_items(mocker):
+    mock_post = mocker.patch('upload_queue.post_url', return_value=Mock(status_code=500))
+    mocker.patch('upload_queue.UploadQueue.start')
+    clear_queue()
+
+    queue = UploadQueue()
+    queue.put({'temp': '1'})
+
+    assert queue.work() == UploadQueue.min_backoff
+    assert queue.work() == UploadQueue.min_backoff * 2
+    assert queue_count() == 1
+
+    mock_post.return_value = Mock(status_code=200)
+    assert queue.work() is None
+    assert queue.backoff == 0
+    assert queue_count() == 0
+
+
+def test_upload_falls_back_to_add_one(mocker):
+    mocker.patch('config.STORAGE_BATCH_SIZE', 2)
+    mock_post = mocker.patch('upload_queue.post_url', side_effect=lambda url, data: Mock(
+        status_code=404 if url.endswith('addMany') else 200))
+    mocker.patch('upload_queue.UploadQueue.start')
+    clear_queue()
+
+    queue = UploadQueue()
+    for i in range(3):
+        queue.put({'temp': Decimal(i)})
+
+    assert queue.work() == 0
+    assert queue.work() is None
+    assert queue_count() == 0
+
+    endpoints = [c[1]['url'].replace(config.STORAGE_ROOT_URL, '') for c in mock_post.call_args_list]
+    assert endpoints == ['addMany', 'addOne', 'addOne', 'addOne']
+    assert mock_post.call_args_list[-1][1]['data'] == {'temp': '2'}
+
+
+def test_queue_is_capped_and_put_does_not_cut_backoff(mocker):
+    mocker.patch('config.STORAGE_QUEUE_MAX_ITEMS', 2)
+    mocker.patch('upload_queue.post_url', return_value=Mock(status_code=500))
+    mocker.patch('upload_queue.UploadQueue.start')
+    mock_wake = mocker.patch('upload_queue.UploadQueue.wake')
+    clear_queue()
+
+    queue = UploadQueue()
+    queue.put({'temp': '1'})
+    assert mock_wake.call_count == 1
+    assert queue.work() == UploadQueue.min_backoff
+
+    queue.put({'temp': '2'})
+    queue.put({'temp': '3'})
+    assert mock_wake.call_count == 1
+
+    with db_session:
+        assert [i.data for i in orm.select(i for i in UploadItem).order_by(UploadItem.id)] == [
+            '{"temp": "2"}', '{"temp": "3"}']
+    clear_queue()
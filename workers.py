@@ -0,0 +1,54 @@
+# coding=utf-8
+import threading
+from typing import Optional
+
+from poller_helpers import logger
+
+
+class BackgroundWorker:
+    # Daemon thread that calls work() whenever it is woken up or when the previous work() asks to be called
+    # again after a delay. work() returns the number of seconds to wait before the next call, or None to wait
+    # until woken up.
+
+    name = 'worker'
+
+    def __init__(self) -> None:
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def wake(self):
+        self._wake.set()
+
+    def _run(self):
+        logger.info('Starting %s', self.name)
+
+        while not self._stop.is_set():
+            self._wake.clear()
+
+            try:
+                wait_time = self.work()
+            except Exception as e:
+                logger.exception(e)
+                wait_time = 60
+
+            self._wake.wait(wait_time)
+
+        logger.info('Stopped %s', self.name)
+
+    def work(self) -> Optional[float]:
+        assert 0, "work not implemented"